@@ -0,0 +1,276 @@
+import constants as const
+from codec import REGS_LIST
+import pdu
+import asyncio
+
+
+class AsyncModbusClient:
+    """Modbus TCP client for asyncio
+
+    Same modbus functions as ModbusClient, as coroutines. Concurrent calls on the same client
+    are pipelined on its connection (responses are matched by transaction ID).
+    Functions return None on error, timeout included.
+    With a server which enable subscriptions, subscribe() register a callback for pushed
+    changes of a range (report-by-exception instead of polling).
+    """
+
+    def __init__(self, host='localhost', port=const.MODBUS_PORT, unit_id=1, timeout=30.0,
+                 packed_bits=False, debug=False, regs_as=REGS_LIST):
+        # public
+        self.host = host
+        self.port = port
+        self.unit_id = unit_id
+        self.timeout = timeout  # default timeout of connect and modbus functions
+        self.packed_bits = packed_bits  # return read bits as BitList
+        self.regs_as = regs_as  # format of read registers (see ModbusClient.regs_as())
+        self.debug = debug
+        # private
+        self._reader = None
+        self._writer = None
+        self._rx_task = None
+        self._hd_tr_id = 0
+        self._pending = {}  # transaction ID -> future of response PDU
+        self._subscriptions = []  # (space, address, number, callback)
+        self._last_except = 0
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    @property
+    def last_except(self):
+        """Last except code returned by the server"""
+        return self._last_except
+
+    async def open(self, timeout=None):
+        """Connect to modbus server (open TCP connection)
+        """
+        # restart TCP if already open
+        if self.is_open():
+            await self.close()
+        try:
+            self._reader, self._writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port), self._timeout(timeout))
+        except (OSError, asyncio.TimeoutError):
+            self._debug_msg('connect error')
+            return False
+        self._rx_task = asyncio.get_running_loop().create_task(self._rx_loop())
+        return True
+
+    def is_open(self):
+        """Get status of TCP connection
+        """
+        return self._writer is not None
+
+    async def close(self):
+        """Close TCP connection
+        """
+        if not self.is_open():
+            return None
+        writer = self._writer
+        self._drop_link()
+        if self._rx_task is not asyncio.current_task():
+            self._rx_task.cancel()
+        try:
+            await writer.wait_closed()
+        except (OSError, asyncio.CancelledError):
+            pass
+        return True
+
+    async def read_coils(self, bit_addr, bit_nb=1, timeout=None):
+        """Modbus function READ_COILS (0x01)
+        """
+        return await self._transact(self._build('read_coils', bit_addr, bit_nb), timeout)
+
+    async def read_discrete_inputs(self, bit_addr, bit_nb=1, timeout=None):
+        """Modbus function READ_DISCRETE_INPUTS (0x02)
+        """
+        return await self._transact(self._build('read_discrete_inputs', bit_addr, bit_nb), timeout)
+
+    async def read_holding_registers(self, reg_addr, reg_nb=1, timeout=None):
+        """Modbus function READ_HOLDING_REGISTERS (0x03)
+        """
+        return await self._transact(self._build('read_holding_registers', reg_addr, reg_nb), timeout)
+
+    async def read_input_registers(self, reg_addr, reg_nb=1, timeout=None):
+        """Modbus function READ_INPUT_REGISTERS (0x04)
+        """
+        return await self._transact(self._build('read_input_registers', reg_addr, reg_nb), timeout)
+
+    async def write_single_coil(self, bit_addr, bit_value, timeout=None):
+        """Modbus function WRITE_SINGLE_COIL (0x05)
+        """
+        return await self._transact(self._build('write_single_coil', bit_addr, bit_value), timeout)
+
+    async def write_single_register(self, reg_addr, reg_value, timeout=None):
+        """Modbus function WRITE_SINGLE_REGISTER (0x06)
+        """
+        return await self._transact(self._build('write_single_register', reg_addr, reg_value), timeout)
+
+    async def write_multiple_coils(self, bits_addr, bits_value, timeout=None):
+        """Modbus function WRITE_MULTIPLE_COILS (0x0F)
+        """
+        return await self._transact(self._build('write_multiple_coils', bits_addr, bits_value), timeout)
+
+    async def write_multiple_registers(self, regs_addr, regs_value, timeout=None):
+        """Modbus function WRITE_MULTIPLE_REGISTERS (0x10)
+        """
+        return await self._transact(self._build('write_multiple_registers', regs_addr, regs_value), timeout)
+
+    async def write_read_multiple_registers(self, write_addr, write_values, read_addr, read_nb=1,
+                                            timeout=None):
+        """Modbus function READ_WRITE_MULTIPLE_REGISTERS (0x17): write then read in one transaction
+        """
+        return await self._transact(self._build('write_read_multiple_registers', write_addr, write_values,
+                                                read_addr, read_nb), timeout)
+
+    async def subscribe(self, space, address, number, callback, timeout=None):
+        """Custom function SUBSCRIBE (0x41): callback(space, address, values) on pushed changes
+
+        space is 'bits' (coils/discrete inputs) or 'words' (registers), callback run in the
+        receive task (asyncio.Queue.put_nowait is a good one). Return True, None on error.
+        """
+        if number == 0:
+            return None
+        # the server can push a change before its response: callback must be there first
+        subscription = (space, address, number, callback)
+        self._subscriptions.append(subscription)
+        if not await self._transact(self._build('subscribe', space, address, number), timeout):
+            if subscription in self._subscriptions:
+                self._subscriptions.remove(subscription)
+            return None
+        return True
+
+    async def unsubscribe(self, space, timeout=None):
+        """Cancel the subscriptions to space
+        """
+        self._subscriptions = [s for s in self._subscriptions if s[0] != space]
+        return await self._transact(self._build('subscribe', space, 0, 0), timeout)
+
+    def _timeout(self, timeout):
+        return self.timeout if timeout is None else timeout
+
+    def _build(self, name, *args):
+        """Build request of modbus function name, return None if args are invalid"""
+        try:
+            if name in pdu.BITS_READ_FUNCTIONS:
+                return pdu.FUNCTIONS[name](*args, packed=self.packed_bits)
+            if name in pdu.REGS_READ_FUNCTIONS:
+                return pdu.FUNCTIONS[name](*args, regs_as=self.regs_as)
+            if name == 'subscribe':
+                return pdu.subscribe(*args)
+            return pdu.FUNCTIONS[name](*args)
+        except pdu.PduError as e:
+            self._debug_msg(str(e))
+            return None
+
+    async def _transact(self, request, timeout):
+        """Send a request and wait for its response"""
+        if request is None:
+            return None
+        if not self.is_open():
+            self._debug_msg('call on close socket')
+            return None
+        # transaction ID increase for each request: unique for all pending requests
+        # (PUSH_TR_ID is skipped, it's the ID of pushed changes)
+        self._hd_tr_id = self._hd_tr_id % 0xFFFF + 1
+        tr_id = self._hd_tr_id
+        future = asyncio.get_running_loop().create_future()
+        self._pending[tr_id] = future
+        try:
+            # send request
+            self._writer.write(pdu.mbap_frame(tr_id, self.unit_id, request.fc, request.body))
+            # wait response
+            rx_pdu = await asyncio.wait_for(self._drain_and_wait(future), self._timeout(timeout))
+        except asyncio.TimeoutError:
+            # a late response will be ignored, the link stay open
+            self._debug_msg('timeout error')
+            return None
+        except OSError:
+            self._debug_msg('_send error')
+            await self.close()
+            return None
+        finally:
+            self._pending.pop(tr_id, None)
+        # link closed before response
+        if rx_pdu is None:
+            return None
+        # check except
+        exp_code = pdu.except_code(rx_pdu)
+        if exp_code is not None:
+            self._last_except = exp_code
+            self._debug_msg('except (code ' + str(exp_code) + ')')
+            return None
+        try:
+            return request.decode(rx_pdu[1:])
+        except pdu.PduError as e:
+            self._debug_msg(str(e))
+            await self.close()
+            return None
+
+    async def _drain_and_wait(self, future):
+        await self._writer.drain()
+        return await future
+
+    async def _rx_loop(self):
+        """Receive responses and dispatch them to pending requests"""
+        try:
+            while True:
+                # 7 bytes header (mbap)
+                rx_head = await self._reader.readexactly(7)
+                mbap = pdu.decode_mbap(rx_head, self.unit_id)
+                if mbap is None:
+                    self._debug_msg('MBAP format error')
+                    break
+                (rx_hd_tr_id, rx_hd_length) = mbap
+                # end of frame
+                rx_pdu = await self._reader.readexactly(rx_hd_length - 1)
+                if rx_hd_tr_id == const.PUSH_TR_ID and rx_pdu[0] == const.SUBSCRIBE:
+                    self._dispatch_push(rx_pdu)
+                    continue
+                future = self._pending.get(rx_hd_tr_id)
+                # unknown ID: response of a timed out request
+                if future is not None and not future.done():
+                    future.set_result(rx_pdu)
+        except (asyncio.IncompleteReadError, OSError):
+            self._debug_msg('_recv error')
+        finally:
+            # drop link on any end of the loop: pending requests get their None response
+            # (not after a reopen: the link is the one of a new receive task)
+            if self._rx_task is asyncio.current_task():
+                self._drop_link()
+
+    def _dispatch_push(self, rx_pdu):
+        """Call the callbacks of subscriptions overlapping a pushed change"""
+        try:
+            (space, address, values) = pdu.decode_push(rx_pdu)
+        except pdu.PduError as e:
+            self._debug_msg(str(e))
+            return
+        for (s_space, s_address, s_number, callback) in self._subscriptions:
+            if s_space == space and address < s_address + s_number and s_address < address + len(values):
+                # a bad callback must not end the receive loop
+                try:
+                    callback(space, address, values)
+                except Exception as e:
+                    self._debug_msg('subscription callback error: %r' % e)
+
+    def _drop_link(self):
+        """Close the link, pending requests get a None response"""
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = None
+        self._writer = None
+        pending, self._pending = self._pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_result(None)
+
+    def _debug_msg(self, msg):
+        """Print debug message if debug mode is on
+        """
+        if self.debug:
+            print(msg)
@@ -0,0 +1,195 @@
+"""Load generation benchmark of ModbusServer/ModbusClient
+
+Start a local ModbusServer on a loopback port and drive it with ModbusClient connections
+(--clients threads in each of --procs processes, one connection by thread) for --duration s.
+Requests follow the function mix --mix (name:weight items) with --size registers or --bits
+bits by request. Print requests/s and p50/p99/p999 latency by function, optionally save them
+as a JSON baseline (--save) or compare them with one (--baseline, exit code 1 on regression).
+
+usage: python bench.py [--engine thread] [--procs 1] [--clients 4] [--duration 5]
+                       [--mix read_holding_registers:80,write_multiple_registers:20]
+                       [--no-delay on] [--metrics off] [--save base.json] [--baseline base.json]
+"""
+
+import argparse
+import constants as const
+from client import ModbusClient
+import json
+from metrics import ServerMetrics
+import multiprocessing
+import random
+from server import ModbusServer
+import sys
+from threading import Thread
+import time
+
+# default function mix
+DEFAULT_MIX = 'read_holding_registers:60,write_multiple_registers:20,read_coils:10,write_single_coil:10'
+# address range of requests
+ADDRESS_SPAN = 1000
+
+
+def request_args(name, rand, size, bits):
+    """Return args of a request of function name"""
+    address = rand.randrange(ADDRESS_SPAN)
+    if name in ('read_coils', 'read_discrete_inputs'):
+        return address, bits
+    if name in ('read_holding_registers', 'read_input_registers'):
+        return address, size
+    if name == 'write_single_coil':
+        return address, True
+    if name == 'write_single_register':
+        return address, address
+    if name == 'write_multiple_coils':
+        return address, [True] * bits
+    if name == 'write_multiple_registers':
+        return address, list(range(size))
+    if name == 'write_read_multiple_registers':
+        return address, list(range(min(size, 121))), address, size
+    raise ValueError('unknown function %r' % name)
+
+
+def parse_mix(mix):
+    """Return (names, weights) of a name:weight,... function mix"""
+    names, weights = [], []
+    for item in mix.split(','):
+        name, weight = item.split(':')
+        request_args(name, random.Random(), 1, 1)
+        names.append(name)
+        weights.append(float(weight))
+    return names, weights
+
+
+def _client_thread(port, names, weights, size, bits, deadline, seed, latencies, errors):
+    rand = random.Random(seed)
+    client = ModbusClient(host='127.0.0.1', port=port, timeout=5.0)
+    if not client.open():
+        errors.append('connect')
+        return
+    while time.monotonic() < deadline:
+        name = rand.choices(names, weights)[0]
+        args = request_args(name, rand, size, bits)
+        t_start = time.perf_counter()
+        result = getattr(client, name)(*args)
+        latencies[name].append(time.perf_counter() - t_start)
+        if result is None:
+            errors.append(name)
+            if not client.is_open():
+                client.open()
+    client.close()
+
+
+def _client_process(params):
+    """Run the client threads of a process, return ({function: latencies}, errors number)"""
+    (port, names, weights, size, bits, duration, clients, seed) = params
+    latencies = {name: [] for name in names}
+    errors = []
+    deadline = time.monotonic() + duration
+    threads = [Thread(target=_client_thread,
+                      args=(port, names, weights, size, bits, deadline, seed * 1000 + i, latencies, errors))
+               for i in range(clients)]
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join()
+    return latencies, len(errors)
+
+
+def percentile(values, q):
+    """Return the q (0.0 to 1.0) percentile of sorted values"""
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def run(args):
+    """Run a benchmark, return its results as a dict"""
+    names, weights = parse_mix(args.mix)
+    server = ModbusServer(host='127.0.0.1', port=args.port, no_block=True, engine=args.engine,
+                          processes=args.server_procs, no_delay=args.no_delay == 'on',
+                          metrics=ServerMetrics() if args.metrics == 'on' else None)
+    server.start()
+    try:
+        # wait server ready
+        probe = ModbusClient(host='127.0.0.1', port=args.port)
+        for _ in range(50):
+            if probe.open():
+                probe.close()
+                break
+            time.sleep(0.1)
+        params = [(args.port, names, weights, args.size, args.bits, args.duration, args.clients, seed)
+                  for seed in range(args.procs)]
+        with multiprocessing.get_context('fork').Pool(args.procs) as pool:
+            outputs = pool.map(_client_process, params)
+    finally:
+        server.stop()
+    results = {}
+    for name in names:
+        values = sorted(v for latencies, n_errors in outputs for v in latencies[name])
+        if not values:
+            continue
+        results[name] = {
+            'requests': len(values),
+            'rps': len(values) / args.duration,
+            'p50_us': percentile(values, 0.50) * 1e6,
+            'p99_us': percentile(values, 0.99) * 1e6,
+            'p999_us': percentile(values, 0.999) * 1e6,
+        }
+    errors = sum(n_errors for latencies, n_errors in outputs)
+    config = {key: getattr(args, key) for key in ('engine', 'server_procs', 'procs', 'clients', 'duration',
+                                                 'mix', 'size', 'bits', 'no_delay', 'metrics')}
+    return {'config': config, 'results': results, 'errors': errors,
+            'total_rps': sum(r['rps'] for r in results.values())}
+
+
+def show(report):
+    print('%-26s %10s %10s %10s %10s %10s' % ('function', 'requests', 'req/s', 'p50 us', 'p99 us', 'p999 us'))
+    for name, r in report['results'].items():
+        print('%-26s %10d %10.0f %10.1f %10.1f %10.1f' %
+              (name, r['requests'], r['rps'], r['p50_us'], r['p99_us'], r['p999_us']))
+    print('total %.0f req/s, %d errors' % (report['total_rps'], report['errors']))
+
+
+def compare(report, baseline, tolerance):
+    """Print changes from baseline, return False if a function regress over tolerance (%)"""
+    ok = True
+    print('%-26s %12s %12s' % ('vs baseline', 'req/s', 'p99'))
+    for name, r in report['results'].items():
+        b = baseline['results'].get(name)
+        if b is None:
+            continue
+        d_rps = 100.0 * (r['rps'] - b['rps']) / b['rps']
+        d_p99 = 100.0 * (r['p99_us'] - b['p99_us']) / b['p99_us']
+        regress = d_rps < -tolerance
+        ok = ok and not regress
+        print('%-26s %+11.1f%% %+11.1f%%%s' % (name, d_rps, d_p99, '  REGRESSION' if regress else ''))
+    return ok
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--engine', choices=(const.ENGINE_THREAD, const.ENGINE_ASYNCIO), default=const.ENGINE_THREAD)
+    parser.add_argument('--server-procs', type=int, default=1, help='server processes')
+    parser.add_argument('--procs', type=int, default=1, help='client processes')
+    parser.add_argument('--clients', type=int, default=4, help='connections (threads) by client process')
+    parser.add_argument('--duration', type=float, default=5.0)
+    parser.add_argument('--mix', default=DEFAULT_MIX)
+    parser.add_argument('--size', type=int, default=10, help='registers by request')
+    parser.add_argument('--bits', type=int, default=80, help='bits by request')
+    parser.add_argument('--no-delay', choices=('on', 'off'), default='on', help='server TCP_NODELAY')
+    parser.add_argument('--metrics', choices=('on', 'off'), default='off', help='server metrics')
+    parser.add_argument('--port', type=int, default=15502)
+    parser.add_argument('--save', help='save results as JSON baseline')
+    parser.add_argument('--baseline', help='compare with a JSON baseline')
+    parser.add_argument('--tolerance', type=float, default=10.0, help='req/s regression tolerance (%%)')
+    args = parser.parse_args()
+    if args.metrics == 'on' and args.server_procs > 1:
+        parser.error('--metrics on need --server-procs 1')
+    report = run(args)
+    show(report)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if not compare(report, baseline, args.tolerance):
+            sys.exit(1)
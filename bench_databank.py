@@ -0,0 +1,76 @@
+"""DataBank contention benchmark
+
+Reader threads read 125 words blocks (one block by thread) while writer threads write 10 words
+blocks, on a DataBank with striped locks and lock free reads, then on a DataBank with one lock
+around every access (as before the lock striping). Print reads/s and writes/s of each run.
+
+usage: python bench_databank.py [--readers 8] [--writers 2] [--duration 2.0]
+"""
+
+import argparse
+from databank import DataBank
+import random
+from threading import Event, Lock, Thread
+import time
+
+
+class GlobalLockBank(DataBank):
+    """DataBank with one lock for every words access (reads included)"""
+
+    def __init__(self):
+        super().__init__()
+        self.words_lock = Lock()
+
+    def get_words(self, address, number=1):
+        with self.words_lock:
+            return super().get_words(address, number)
+
+    def set_words(self, address, word_list):
+        with self.words_lock:
+            return super().set_words(address, word_list)
+
+
+def run(data_bank, readers, writers, duration):
+    """Return (reads/s, writes/s) of a run"""
+    stop = Event()
+    counts = [0] * (readers + writers)
+
+    def reader(i):
+        address = i * 1024
+        n = 0
+        while not stop.is_set():
+            data_bank.get_words(address, 125)
+            n += 1
+        counts[i] = n
+
+    def writer(i):
+        rand = random.Random(i)
+        n = 0
+        while not stop.is_set():
+            data_bank.set_words(rand.randrange(0, max(readers, 1) * 1024), [n & 0xFFFF] * 10)
+            n += 1
+        counts[i] = n
+
+    threads = [Thread(target=reader, args=(i,)) for i in range(readers)]
+    threads += [Thread(target=writer, args=(i,)) for i in range(readers, readers + writers)]
+    for th in threads:
+        th.start()
+    time.sleep(duration)
+    stop.set()
+    for th in threads:
+        th.join()
+    return sum(counts[:readers]) / duration, sum(counts[readers:]) / duration
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--writers', type=int, default=2)
+    parser.add_argument('--duration', type=float, default=2.0)
+    args = parser.parse_args()
+    for name, data_bank in (('striped', DataBank()), ('global lock', GlobalLockBank())):
+        # allocate storage before the run
+        data_bank.set_words(0, [1])
+        reads, writes = run(data_bank, args.readers, args.writers, args.duration)
+        print('%-12s readers=%d writers=%d: %10.0f reads/s %10.0f writes/s' %
+              (name, args.readers, args.writers, reads, writes))
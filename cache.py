@@ -0,0 +1,187 @@
+import constants as const
+from codec import unpack_bits
+from collections import OrderedDict
+import pdu
+import struct
+from threading import Lock
+import time
+
+# function code -> table it read or write
+FC_TABLES = {
+    const.READ_COILS: 'coil',
+    const.READ_DISCRETE_INPUTS: 'discrete_input',
+    const.READ_HOLDING_REGISTERS: 'holding_register',
+    const.READ_INPUT_REGISTERS: 'input_register',
+    const.WRITE_SINGLE_COIL: 'coil',
+    const.WRITE_SINGLE_REGISTER: 'holding_register',
+    const.WRITE_MULTIPLE_COILS: 'coil',
+    const.WRITE_MULTIPLE_REGISTERS: 'holding_register',
+    const.READ_WRITE_MULTIPLE_REGISTERS: 'holding_register',
+}
+READ_FUNCTIONS = (const.READ_COILS, const.READ_DISCRETE_INPUTS,
+                  const.READ_HOLDING_REGISTERS, const.READ_INPUT_REGISTERS)
+
+
+class RegisterCache:
+    """Client side cache of coils and registers values, with TTL and LRU eviction
+
+    Reads fully covered by fresh items are served from the cache, successful writes update it
+    (write-through). ttls is a list of ((table, first address, last address), ttl) items for
+    ranges which need another TTL than the default one. A cache can be shared by several
+    clients (ex: clients of a pool) of the same server: items are stored by unit ID.
+    """
+
+    def __init__(self, max_items=65536, ttl=1.0, ttls=None):
+        self.max_items = max_items
+        self.ttl = ttl
+        self.ttls = list(ttls or [])
+        # (unit ID, table, address) -> (value, expire time), least recently used first
+        self._items = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, table, address, number, unit_id=1):
+        """Return number values at address of table, None if one of them is missing or expired"""
+        now = time.monotonic()
+        with self._lock:
+            values = []
+            for key in [(unit_id, table, addr) for addr in range(address, address + number)]:
+                item = self._items.get(key)
+                if item is None or item[1] <= now:
+                    self.misses += 1
+                    return None
+                values.append(item[0])
+            # recently used go at the end
+            for addr in range(address, address + number):
+                self._items.move_to_end((unit_id, table, addr))
+            self.hits += 1
+            return values
+
+    def put(self, table, address, values, unit_id=1):
+        """Store values at address of table"""
+        expire = time.monotonic() + self.ttl_of(table, address)
+        with self._lock:
+            for addr, value in enumerate(values, address):
+                self._items[(unit_id, table, addr)] = (value, expire)
+                self._items.move_to_end((unit_id, table, addr))
+            # LRU eviction
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+    def invalidate(self, table=None, address=0, number=0x10000, unit_id=1):
+        """Drop items of a range of table (all items if table is None)"""
+        with self._lock:
+            if table is None:
+                self._items.clear()
+                return
+            for addr in range(address, address + number):
+                self._items.pop((unit_id, table, addr), None)
+
+    def ttl_of(self, table, address):
+        """TTL of an item"""
+        for (r_table, first, last), ttl in self.ttls:
+            if r_table == table and first <= address <= last:
+                return ttl
+        return self.ttl
+
+    def stats(self):
+        """Return hits, misses and items counters as a dict"""
+        return {'hits': self.hits, 'misses': self.misses, 'items': len(self._items)}
+
+    def lookup(self, request, unit_id=1):
+        """Return cached values of a read request, None if it's not a read or not cached"""
+        if request.fc not in READ_FUNCTIONS:
+            return None
+        (address, number) = pdu.ADDR_COUNT.unpack(request.body)
+        return self.get(FC_TABLES[request.fc], address, number, unit_id)
+
+    def update(self, request, result, unit_id=1):
+        """Update cache with the result of a request (None on error)"""
+        table = FC_TABLES.get(request.fc)
+        if table is None:
+            return
+        if request.fc == const.READ_WRITE_MULTIPLE_REGISTERS:
+            self._update_write_read(request, result, unit_id)
+            return
+        (address, values) = _request_items(request, result)
+        if result is None:
+            # failed write: server state unknown
+            if request.fc not in READ_FUNCTIONS:
+                self.invalidate(table, address, len(values), unit_id)
+        else:
+            self.put(table, address, values, unit_id)
+
+    def begin_write(self, request, unit_id=1):
+        """Drop items a write request is about to change (values are unknown until its response)"""
+        w_range = request_write_range(request)
+        if w_range is not None:
+            self.invalidate(*w_range, unit_id=unit_id)
+
+    def _update_write_read(self, request, result, unit_id):
+        """Update cache with the result of a write/read request (written range, then read one)"""
+        (r_address, r_number, w_address, w_number, bytes_nb) = pdu.READ_WRITE_HEAD.unpack_from(request.body)
+        if result is None:
+            # failed write: server state unknown
+            self.invalidate('holding_register', w_address, w_number, unit_id)
+            return
+        data = request.body[pdu.READ_WRITE_HEAD.size:]
+        self.put('holding_register', w_address, list(struct.unpack('>%dH' % w_number, data)), unit_id)
+        self.put('holding_register', r_address, result.tolist() if hasattr(result, 'tolist') else list(result),
+                 unit_id)
+
+
+def request_read_range(request):
+    """Return (table, address, number) read by a read request, None for other requests"""
+    if request.fc not in READ_FUNCTIONS:
+        return None
+    (address, number) = pdu.ADDR_COUNT.unpack(request.body)
+    return FC_TABLES[request.fc], address, number
+
+
+def request_write_range(request):
+    """Return (table, address, number) written by a write request, None for other requests"""
+    fc = request.fc
+    if fc not in FC_TABLES or fc in READ_FUNCTIONS:
+        return None
+    if fc in (const.WRITE_SINGLE_COIL, const.WRITE_SINGLE_REGISTER):
+        (address, value) = pdu.ADDR_COUNT.unpack_from(request.body)
+        return FC_TABLES[fc], address, 1
+    if fc == const.READ_WRITE_MULTIPLE_REGISTERS:
+        (r_address, r_number, address, number, bytes_nb) = pdu.READ_WRITE_HEAD.unpack_from(request.body)
+        return FC_TABLES[fc], address, number
+    (address, number) = pdu.ADDR_COUNT.unpack_from(request.body)
+    return FC_TABLES[fc], address, number
+
+
+def ranges_overlap(range_a, range_b):
+    """Check if two (table, address, number) ranges have common items"""
+    (table_a, address_a, number_a) = range_a
+    (table_b, address_b, number_b) = range_b
+    return table_a == table_b and address_a < address_b + number_b and address_b < address_a + number_a
+
+
+def _request_items(request, result):
+    """Return (address, values) of a read result or a write request"""
+    fc = request.fc
+    body = request.body
+    if fc in READ_FUNCTIONS:
+        (address, number) = pdu.ADDR_COUNT.unpack(body)
+        if result is None:
+            return address, [None] * number
+        # list, BitList, array or numpy array
+        return address, result.tolist() if hasattr(result, 'tolist') else list(result)
+    if fc == const.WRITE_SINGLE_COIL:
+        (address, value, padding) = pdu.COIL_VALUE.unpack(body)
+        return address, [value == 0xFF]
+    if fc == const.WRITE_SINGLE_REGISTER:
+        (address, value) = pdu.ADDR_COUNT.unpack(body)
+        return address, [value]
+    (address, number, bytes_nb) = pdu.ADDR_COUNT_BYTES.unpack_from(body)
+    data = body[pdu.ADDR_COUNT_BYTES.size:]
+    if fc == const.WRITE_MULTIPLE_COILS:
+        return address, unpack_bits(data, number)
+    return address, list(struct.unpack('>%dH' % number, data))
@@ -1,17 +1,54 @@
-from tkinter import *
 import constants as const
-from interface import Interface
-from utils import set_bit
+from codec import BitList, REGS_ARRAY, REGS_LIST, REGS_NUMPY, join_results, pack_bits
+import codec
+from cache import ranges_overlap, request_read_range, request_write_range
+import pdu
+from concurrent.futures import Future
+from metrics import CallTrace
+import re
 import socket
-import select
-import struct
-import random
+from time import perf_counter
+
+# receive buffer size (many pipelined responses, a frame is at most 261 bytes)
+RX_BUFFER_SIZE = 4096
+# transmit buffer size (a request frame)
+TX_BUFFER_SIZE = 261
+# a label of a DNS hostname
+HOST_LABEL = re.compile(r'^(?!-)[A-Za-z0-9-]{1,63}(?<!-)$')
+# range functions: name -> (modbus function of its chunks, max items by chunk)
+RANGE_FUNCTIONS = {
+    'read_coils_range': ('read_coils', 2000),
+    'read_discrete_inputs_range': ('read_discrete_inputs', 2000),
+    'read_holding_range': ('read_holding_registers', 125),
+    'read_input_range': ('read_input_registers', 125),
+    'write_coils_range': ('write_multiple_coils', 1968),
+    'write_registers_range': ('write_multiple_registers', 123),
+}
+
+
+def is_host(hostname):
+    """Check if hostname is an IPv4 or IPv6 address or a valid DNS hostname (not resolved)"""
+    if not isinstance(hostname, str):
+        return False
+    # IPv6 link-local address can have a %zone suffix
+    for family, address in ((socket.AF_INET, hostname), (socket.AF_INET6, hostname.partition('%')[0])):
+        try:
+            socket.inet_pton(family, address)
+            return True
+        except (socket.error, ValueError):
+            pass
+    # hostname: dot separated labels, end dot is allowed
+    if len(hostname) > 253:
+        return False
+    labels = hostname[:-1].split('.') if hostname.endswith('.') else hostname.split('.')
+    return all(HOST_LABEL.match(label) for label in labels)
 
 
 class ModbusClient:
     """Modbus TCP client"""
 
-    def __init__(self, host=None, port=None, timeout=None, debug=None):
+    def __init__(self, host=None, port=None, timeout=None, debug=None, cache=None, unit_id=None,
+                 tracer=None):
         self.__hostname = 'localhost'
         self.__port = const.MODBUS_PORT
         self.__unit_id = 1
@@ -20,20 +57,42 @@ class ModbusClient:
         self.__sock = None  # socket handle
         self.__hd_tr_id = 0  # store transaction ID
         self.__last_except = 0  # last expect code
+        self.__packed_bits = False  # return read bits as BitList
+        self.__regs_as = REGS_LIST  # format of read registers
+        self.__max_in_flight = 16  # max outstanding requests in pipelined mode
+        self.__pending = {}  # pipelined requests: transaction ID -> (request, future, trace)
+        self.__cache = cache  # optional RegisterCache
+        self.__tracer = tracer  # optional metrics.Tracer
+        self.__trace = None  # CallTrace of the request just built (tracer on)
+        self.__rx_buffer = bytearray(RX_BUFFER_SIZE)  # responses are decoded in place
+        self.__rx_view = memoryview(self.__rx_buffer)
+        self.__rx_start = 0  # first byte not decoded in rx buffer
+        self.__rx_end = 0  # end of received bytes in rx buffer
+        self.__tx_buffer = bytearray(TX_BUFFER_SIZE)  # request frames are built in it
+        self.__tx_view = memoryview(self.__tx_buffer)
+        # constructor params
+        if host is not None and self.host(host) is None:
+            raise ValueError('host must be an IPv4/IPv6 address or a hostname')
+        if port is not None:
+            self.port(port)
+        if unit_id is not None:
+            self.unit_id(unit_id)
+        if timeout is not None:
+            self.__timeout = float(timeout)
+        if debug is not None:
+            self.__debug = bool(debug)
 
     def host(self, hostname=None):
-        """Get or set host (IPv4)
+        """Get or set host (IPv4, IPv6 or hostname), return None if hostname is invalid
         """
         if (hostname is None) or (hostname == self.__hostname):
             return self.__hostname
+        if not is_host(hostname):
+            return None
         # when hostname change ensure old socket is close
         self.close()
-        try:
-            socket.inet_pton(socket.AF_INET, hostname)
-            self.__hostname = hostname
-            return self.__hostname
-        except socket.error:
-            pass
+        self.__hostname = hostname
+        return self.__hostname
 
     def port(self, port=None):
         """Get or set TCP port
@@ -49,6 +108,69 @@ class ModbusClient:
         else:
             return None
 
+    def unit_id(self, unit_id=None):
+        """Get or set unit ID (slave device behind a gateway)
+        """
+        if (unit_id is None) or (unit_id == self.__unit_id):
+            return self.__unit_id
+        # responses of pending requests are from the previous unit
+        self.flush()
+        # valid unit ID ?
+        if 0 <= int(unit_id) <= 255:
+            self.__unit_id = int(unit_id)
+            return self.__unit_id
+        else:
+            return None
+
+    def packed_bits(self, state=None):
+        """Get or set packed bits mode
+
+        When on, read_coils() and read_discrete_inputs() return a compact BitList
+        (packed bytes, int bitmask) instead of a list of bool.
+        """
+        if state is None:
+            return self.__packed_bits
+        self.__packed_bits = bool(state)
+        return self.__packed_bits
+
+    def regs_as(self, regs_as=None):
+        """Get or set the format of read registers
+
+        REGS_LIST (list of int, default), REGS_ARRAY (array('H')) or REGS_NUMPY (numpy uint16
+        array): array formats are decoded in one step, see codec.regs_to_values() to
+        reinterpret them as int32, float32... values.
+        """
+        if regs_as is None:
+            return self.__regs_as
+        if regs_as not in (REGS_LIST, REGS_ARRAY, REGS_NUMPY):
+            return None
+        if regs_as == REGS_NUMPY and not codec.has_numpy():
+            self.__debug_msg('numpy registers require numpy')
+            return None
+        self.__regs_as = regs_as
+        return self.__regs_as
+
+    def cache(self):
+        """Get the RegisterCache of the client (None if cache is off)
+        """
+        return self.__cache
+
+    def tracer(self):
+        """Get the Tracer of the client (None if tracing is off)
+        """
+        return self.__tracer
+
+    def max_in_flight(self, depth=None):
+        """Get or set the max number of outstanding requests in pipelined mode
+        """
+        if depth is None:
+            return self.__max_in_flight
+        if 1 <= int(depth) <= 256:
+            self.__max_in_flight = int(depth)
+            return self.__max_in_flight
+        else:
+            return None
+
     def open(self):
         """Connect to modbus server (open TCP connection)
         """
@@ -60,6 +182,7 @@ class ModbusClient:
         # AF_xxx : AF_INET -> IPv4, AF_INET6 -> IPv6,
         #          AF_UNSPEC -> IPv6 (priority on some system) or 4
         # list available socket on target host
+        t_start = perf_counter()
         for res in socket.getaddrinfo(self.__hostname, self.__port,
                                       socket.AF_UNSPEC, socket.SOCK_STREAM):
             af, sock_type, proto, canon_name, sa = res
@@ -76,6 +199,9 @@ class ModbusClient:
                 self.__sock = None
                 continue
             break
+        if self.__tracer is not None:
+            self.__tracer.on_connect(self.__hostname, self.__port, perf_counter() - t_start,
+                                     self.__sock is not None)
         # check connect status
         if self.__sock is not None:
             return True
@@ -88,12 +214,43 @@ class ModbusClient:
         """
         return self.__sock is not None
 
+    def is_alive(self):
+        """Check (without blocking, no request sent) that an open TCP connection is still up
+
+        Return False if the server closed it (FIN), on socket error or if unexpected data wait
+        on it (no request is pending: the link is out of sync).
+        """
+        if self.__sock is None:
+            return False
+        if self.__pending or self.__rx_start != self.__rx_end:
+            return True
+        try:
+            self.__sock.setblocking(False)
+            try:
+                # b'' is the FIN of the server
+                self.__sock.recv(1, socket.MSG_PEEK)
+                return False
+            finally:
+                self.__sock.settimeout(self.__timeout)
+        except (BlockingIOError, socket.timeout):
+            # nothing to read: link is up
+            return True
+        except OSError:
+            return False
+
     def close(self):
         """Close TCP connection
         """
         if self.__sock:
             self.__sock.close()
             self.__sock = None
+            # received bytes are from the closed link
+            self.__rx_start = self.__rx_end = 0
+            # pipelined requests will never get a response
+            pending, self.__pending = self.__pending, {}
+            for request, future, trace in pending.values():
+                self._end_trace(trace, None)
+                future.set_result(None)
             return True
         else:
             return None
@@ -101,375 +258,290 @@ class ModbusClient:
     def read_coils(self, bit_addr, bit_nb=1):
         """Modbus function READ_COILS (0x01)
         """
-        # check params
-        if not (0 <= int(bit_addr) <= 65535):
-            self.__debug_msg('read_coils(): bit_addr out of range')
-            return None
-        if not (1 <= int(bit_nb) <= 2000):
-            self.__debug_msg('read_coils(): bit_nb out of range')
-            return None
-        if (int(bit_addr) + int(bit_nb)) > 65536:
-            self.__debug_msg('read_coils(): read after ad 65535')
-            return None
-        # build frame
-        tx_buffer = self._mbus_frame(const.READ_COILS, struct.pack('>HH', bit_addr, bit_nb))
-        # send request
-        s_send = self._send_mbus(tx_buffer)
-        # check error
-        if not s_send:
-            return None
-        # receive
-        f_body = self._recv_mbus()
-        # check error
-        if not f_body:
-            return None
-        # check min frame body size
-        if len(f_body) < 2:
-            self.__debug_msg('read_coils(): rx frame under min size')
-            self.close()
-            return None
-        # extract field "byte count"
-        rx_byte_count = struct.unpack("B", f_body[0:1])[0]
-        # frame with bits value -> bits[] list
-        f_bits = bytearray(f_body[1:])
-        # check rx_byte_count: match nb of bits request and check buffer size
-        if not ((rx_byte_count >= int((bit_nb + 7) / 8)) and
-                (rx_byte_count == len(f_bits))):
-            self.__debug_msg('read_coils(): rx byte count mismatch')
-            self.close()
-            return None
-        # allocate a bit_nb size list
-        bits = [None] * bit_nb
-        # fill bits list with bit items
-        for i, item in enumerate(bits):
-            bits[i] = bool(f_bits[int(i / 8)] >> (i % 8) & 0x01)
-        # return bits list
-        return bits
+        return self._transact(self._build('read_coils', bit_addr, bit_nb))
 
     def read_discrete_inputs(self, bit_addr, bit_nb=1):
         """Modbus function READ_DISCRETE_INPUTS (0x02)
         """
-        # check params
-        if not (0 <= int(bit_addr) <= 65535):
-            self.__debug_msg('read_discrete_inputs(): bit_addr out of range')
-            return None
-        if not (1 <= int(bit_nb) <= 2000):
-            self.__debug_msg('read_discrete_inputs(): bit_nb out of range')
-            return None
-        if (int(bit_addr) + int(bit_nb)) > 65536:
-            self.__debug_msg('read_discrete_inputs(): read after ad 65535')
-            return None
-        # build frame
-        tx_buffer = self._mbus_frame(const.READ_DISCRETE_INPUTS, struct.pack('>HH', bit_addr, bit_nb))
-        # send request
-        s_send = self._send_mbus(tx_buffer)
-        # check error
-        if not s_send:
-            return None
-        # receive
-        f_body = self._recv_mbus()
-        # check error
-        if not f_body:
-            return None
-        # check min frame body size
-        if len(f_body) < 2:
-            self.__debug_msg('read_discrete_inputs(): rx frame under min size')
-            self.close()
-            return None
-        # extract field "byte count"
-        rx_byte_count = struct.unpack("B", f_body[0:1])[0]
-        # frame with bits value -> bits[] list
-        f_bits = bytearray(f_body[1:])
-        # check rx_byte_count: match nb of bits request and check buffer size
-        if not ((rx_byte_count >= int((bit_nb + 7) / 8)) and
-                (rx_byte_count == len(f_bits))):
-            self.__debug_msg('read_discrete_inputs(): rx byte count mismatch')
-            self.close()
-            return None
-        # allocate a bit_nb size list
-        bits = [None] * bit_nb
-        # fill bits list with bit items
-        for i, item in enumerate(bits):
-            bits[i] = bool(f_bits[int(i / 8)] >> (i % 8) & 0x01)
-        # return bits list
-        return bits
+        return self._transact(self._build('read_discrete_inputs', bit_addr, bit_nb))
 
     def read_holding_registers(self, reg_addr, reg_nb=1):
         """Modbus function READ_HOLDING_REGISTERS (0x03)
         """
-        # check params
-        if not (0 <= int(reg_addr) <= 65535):
-            self.__debug_msg('read_holding_registers(): reg_addr out of range')
-            return None
-        if not (1 <= int(reg_nb) <= 125):
-            self.__debug_msg('read_holding_registers(): reg_nb out of range')
-            return None
-        if (int(reg_addr) + int(reg_nb)) > 65536:
-            self.__debug_msg('read_holding_registers(): read after ad 65535')
-            return None
-        # build frame
-        tx_buffer = self._mbus_frame(const.READ_HOLDING_REGISTERS, struct.pack('>HH', reg_addr, reg_nb))
-        # send request
-        s_send = self._send_mbus(tx_buffer)
-        # check error
-        if not s_send:
-            return None
-        # receive
-        f_body = self._recv_mbus()
-        # check error
-        if not f_body:
-            return None
-        # check min frame body size
-        if len(f_body) < 2:
-            self.__debug_msg('read_holding_registers(): rx frame under min size')
-            self.close()
-            return None
-        # extract field "byte count"
-        rx_byte_count = struct.unpack('B', f_body[0:1])[0]
-        # frame with regs value
-        f_regs = f_body[1:]
-        # check rx_byte_count: buffer size must be consistent and have at least the requested number of registers
-        if not ((rx_byte_count >= 2 * reg_nb) and
-                (rx_byte_count == len(f_regs))):
-            self.__debug_msg('read_holding_registers(): rx byte count mismatch')
-            self.close()
-            return None
-        # allocate a reg_nb size list
-        registers = [None] * reg_nb
-        # fill registers list with register items
-        for i, item in enumerate(registers):
-            registers[i] = struct.unpack('>H', f_regs[i * 2:i * 2 + 2])[0]
-        # return registers list
-        return registers
+        return self._transact(self._build('read_holding_registers', reg_addr, reg_nb))
 
     def read_input_registers(self, reg_addr, reg_nb=1):
         """Modbus function READ_INPUT_REGISTERS (0x04)
         """
-        # check params
-        if not (0x0000 <= int(reg_addr) <= 0xffff):
-            self.__debug_msg('read_input_registers(): reg_addr out of range')
-            return None
-        if not (0x0001 <= int(reg_nb) <= 0x007d):
-            self.__debug_msg('read_input_registers(): reg_nb out of range')
-            return None
-        if (int(reg_addr) + int(reg_nb)) > 0x10000:
-            self.__debug_msg('read_input_registers(): read after ad 65535')
-            return None
-        # build frame
-        tx_buffer = self._mbus_frame(const.READ_INPUT_REGISTERS, struct.pack('>HH', reg_addr, reg_nb))
-        # send request
-        s_send = self._send_mbus(tx_buffer)
-        # check error
-        if not s_send:
-            return None
-        # receive
-        f_body = self._recv_mbus()
-        # check error
-        if not f_body:
-            return None
-        # check min frame body size
-        if len(f_body) < 2:
-            self.__debug_msg('read_input_registers(): rx frame under min size')
-            self.close()
-            return None
-        # extract field "byte count"
-        rx_byte_count = struct.unpack('B', f_body[0:1])[0]
-        # frame with regs value
-        f_regs = f_body[1:]
-        # check rx_byte_count: buffer size must be consistent and have at least the requested number of registers
-        if not ((rx_byte_count >= 2 * reg_nb) and
-                (rx_byte_count == len(f_regs))):
-            self.__debug_msg('read_input_registers(): rx byte count mismatch')
-            self.close()
-            return None
-        # allocate a reg_nb size list
-        registers = [None] * reg_nb
-        # fill registers list with register items
-        for i, item in enumerate(registers):
-            registers[i] = struct.unpack('>H', f_regs[i * 2:i * 2 + 2])[0]
-        # return registers list
-        return registers
+        return self._transact(self._build('read_input_registers', reg_addr, reg_nb))
 
     def write_single_coil(self, bit_addr, bit_value):
         """Modbus function WRITE_SINGLE_COIL (0x05)"""
-        # check params
-        if not (0 <= int(bit_addr) <= 65535):
-            self.__debug_msg('write_single_coil(): bit_addr out of range')
-            return None
-        # build frame
-        bit_value = 0xFF if bit_value else 0x00
-        tx_buffer = self._mbus_frame(const.WRITE_SINGLE_COIL, struct.pack('>HBB', bit_addr, bit_value, 0))
-        # send request
-        s_send = self._send_mbus(tx_buffer)
-        # check error
-        if not s_send:
-            return None
-        # receive
-        f_body = self._recv_mbus()
-        # check error
-        if not f_body:
-            return None
-        # check fix frame size
-        if len(f_body) != 4:
-            self.__debug_msg('write_single_coil(): rx frame size error')
-            self.close()
-            return None
-        # register extract
-        (rx_bit_addr, rx_bit_value, rx_padding) = struct.unpack('>HBB', f_body[:4])
-        # check bit write
-        is_ok = (rx_bit_addr == bit_addr) and (rx_bit_value == bit_value)
-        return True if is_ok else None
+        return self._transact(self._build('write_single_coil', bit_addr, bit_value))
 
     def write_single_register(self, reg_addr, reg_value):
         """Modbus function WRITE_SINGLE_REGISTER (0x06)
         """
-        # check params
-        if not (0 <= int(reg_addr) <= 65535):
-            self.__debug_msg('write_single_register(): reg_addr out of range')
-            return None
-        if not (0 <= int(reg_value) <= 65535):
-            self.__debug_msg('write_single_register(): reg_value out of range')
-            return None
-        # build frame
-        tx_buffer = self._mbus_frame(const.WRITE_SINGLE_REGISTER,
-                                     struct.pack('>HH', reg_addr, reg_value))
-        # send request
-        s_send = self._send_mbus(tx_buffer)
-        # check error
-        if not s_send:
-            return None
-        # receive
-        f_body = self._recv_mbus()
-        # check error
-        if not f_body:
-            return None
-        # check fix frame size
-        if len(f_body) != 4:
-            self.__debug_msg('write_single_register(): rx frame size error')
-            self.close()
-            return None
-        # register extract
-        rx_reg_addr, rx_reg_value = struct.unpack('>HH', f_body)
-        # check register write
-        is_ok = (rx_reg_addr == reg_addr) and (rx_reg_value == reg_value)
-        return True if is_ok else None
+        return self._transact(self._build('write_single_register', reg_addr, reg_value))
 
     def write_multiple_coils(self, bits_addr, bits_value):
         """Modbus function WRITE_MULTIPLE_COILS (0x0F)
         """
-        # number of bits to write
-        bits_nb = len(bits_value)
-        # check params
-        if not (0x0000 <= int(bits_addr) <= 0xffff):
-            self.__debug_msg('write_multiple_coils(): bits_addr out of range')
-            return None
-        if not (0x0001 <= int(bits_nb) <= 0x07b0):
-            self.__debug_msg('write_multiple_coils(): number of bits out of range')
-            return None
-        if (int(bits_addr) + int(bits_nb)) > 0x10000:
-            self.__debug_msg('write_multiple_coils(): write after ad 65535')
-            return None
-        # build frame
-        # format bits value string
-        bits_val_str = b''
-        # allocate bytes list
-        b_size = int(bits_nb / 8)
-        b_size += 1 if (bits_nb % 8) else 0
-        bytes_l = [0] * b_size
-        # populate bytes list with bits_value
-        for i, item in enumerate(bits_value):
-            if item:
-                byte_i = int(i / 8)
-                bytes_l[byte_i] = set_bit(bytes_l[byte_i], i % 8)
-        # format bits_val_str
-        for byte in bytes_l:
-            bits_val_str += struct.pack('B', byte)
-        bytes_nb = len(bits_val_str)
-        # format modbus frame body
-        body = struct.pack('>HHB', bits_addr, bits_nb, bytes_nb) + bits_val_str
-        tx_buffer = self._mbus_frame(const.WRITE_MULTIPLE_COILS, body)
-        # send request
-        s_send = self._send_mbus(tx_buffer)
-        # check error
-        if not s_send:
-            return None
-        # receive
-        f_body = self._recv_mbus()
-        # check error
-        if not f_body:
-            return None
-        # check fix frame size
-        if len(f_body) != 4:
-            self.__debug_msg('write_multiple_coils(): rx frame size error')
-            self.close()
-            return None
-        # register extract
-        (rx_bit_addr, rx_bit_nb) = struct.unpack('>HH', f_body[:4])
-        # check regs write
-        is_ok = (rx_bit_addr == bits_addr)
-        return True if is_ok else None
+        return self._transact(self._build('write_multiple_coils', bits_addr, bits_value))
 
     def write_multiple_registers(self, regs_addr, regs_value):
         """Modbus function WRITE_MULTIPLE_REGISTERS (0x10)
         """
-        # number of registers to write
-        regs_nb = len(regs_value)
-        # check params
-        if not (0x0000 <= int(regs_addr) <= 0xffff):
-            self.__debug_msg('write_multiple_registers(): regs_addr out of range')
-            return None
-        if not (0x0001 <= int(regs_nb) <= 0x00ff):
-            self.__debug_msg('write_multiple_registers(): number of registers out of range')
+        return self._transact(self._build('write_multiple_registers', regs_addr, regs_value))
+
+    def write_read_multiple_registers(self, write_addr, write_values, read_addr, read_nb=1):
+        """Modbus function READ_WRITE_MULTIPLE_REGISTERS (0x17)
+
+        Write write_values at write_addr then read read_nb registers at read_addr in one
+        transaction, return the registers read.
+        """
+        return self._transact(self._build('write_read_multiple_registers', write_addr, write_values,
+                                          read_addr, read_nb))
+
+    def read_coils_range(self, bit_addr, bit_nb):
+        """Read bit_nb coils (any number up to address 65535) with pipelined requests
+
+        Return one list of bits (a BitList in packed bits mode), None on error.
+        """
+        return self._read_range('read_coils_range', bit_addr, bit_nb)
+
+    def read_discrete_inputs_range(self, bit_addr, bit_nb):
+        """Read bit_nb discrete inputs (any number up to address 65535) with pipelined requests
+        """
+        return self._read_range('read_discrete_inputs_range', bit_addr, bit_nb)
+
+    def read_holding_range(self, reg_addr, reg_nb):
+        """Read reg_nb holding registers (any number up to address 65535) with pipelined requests
+
+        Return the registers in one list (or array, see regs_as()), None on error.
+        """
+        return self._read_range('read_holding_range', reg_addr, reg_nb)
+
+    def read_input_range(self, reg_addr, reg_nb):
+        """Read reg_nb input registers (any number up to address 65535) with pipelined requests
+        """
+        return self._read_range('read_input_range', reg_addr, reg_nb)
+
+    def write_coils_range(self, bits_addr, bits_value):
+        """Write any number of coils with pipelined requests, return True (None on error)
+        """
+        return self._write_range('write_coils_range', bits_addr, bits_value)
+
+    def write_registers_range(self, regs_addr, regs_value):
+        """Write any number of registers with pipelined requests, return True (None on error)
+
+        Requests are applied in address order, but not as one atomic write.
+        """
+        return self._write_range('write_registers_range', regs_addr, regs_value)
+
+    def submit(self, name, *args):
+        """Send a request without waiting for its response (pipelined mode)
+
+        name is a modbus function of the client (ex: 'read_holding_registers') and args its
+        arguments. Up to max_in_flight() requests are kept outstanding on the link, responses
+        are matched by transaction ID so they can come back in any order.
+        Return a future, its result() is the value the function would have returned.
+        """
+        future = PipelineFuture(self)
+        request = self._build(name, *args)
+        if request is None:
+            future.set_result(None)
+            return future
+        trace, self.__trace = self.__trace, None
+        # served by the cache
+        cached = self._cache_lookup(request)
+        if cached is not None:
+            self._end_trace(trace, cached, cached=True)
+            future.set_result(cached)
+            return future
+        # cached values of the written range are stale from now
+        if self.__cache is not None:
+            self.__cache.begin_write(request, self.__unit_id)
+        # wait for a free slot
+        t_slot = perf_counter() if trace is not None else None
+        while len(self.__pending) >= self.__max_in_flight:
+            if not self._pump():
+                break
+        if trace is not None:
+            # slot wait is not serialize time
+            trace.start += perf_counter() - t_slot
+        # send request (wait of a pipelined request include its queue behind previous ones)
+        if not self._send_traced(request, trace):
+            self._end_trace(trace, None)
+            future.set_result(None)
+            return future
+        self.__pending[self.__hd_tr_id] = (request, future, trace)
+        return future
+
+    def batch(self, requests):
+        """Run a list of (name, *args) requests pipelined, return the list of their results
+        """
+        futures = [self.submit(*request) for request in requests]
+        return [future.result() for future in futures]
+
+    def flush(self):
+        """Wait for the responses of all pipelined requests
+        """
+        while self.__pending:
+            if not self._pump():
+                break
+
+    def _read_range(self, range_name, address, number):
+        """Run a range read as requests of max size (kept in flight), join their results"""
+        (name, max_nb) = RANGE_FUNCTIONS[range_name]
+        if not (0 <= int(address) and 1 <= int(number) and int(address) + int(number) <= 0x10000):
+            self.__debug_msg(range_name + '(): range out of address space')
+            return None
+        futures = [self.submit(name, chunk_addr, chunk_nb)
+                   for chunk_addr, chunk_nb in split_range(address, number, max_nb)]
+        return join_results([future.result() for future in futures])
+
+    def _write_range(self, range_name, address, values):
+        """Run a range write as requests of max size (kept in flight)"""
+        (name, max_nb) = RANGE_FUNCTIONS[range_name]
+        if not (0 <= int(address) and 1 <= len(values) and int(address) + len(values) <= 0x10000):
+            self.__debug_msg(range_name + '(): range out of address space')
+            return None
+        futures = [self.submit(name, chunk_addr, values[chunk_addr - address:chunk_addr - address + chunk_nb])
+                   for chunk_addr, chunk_nb in split_range(address, len(values), max_nb)]
+        return True if all([future.result() for future in futures]) else None
+
+    def _build(self, name, *args):
+        """Build request of modbus function name, return None if args are invalid"""
+        t_start = perf_counter() if self.__tracer is not None else None
+        try:
+            if name in pdu.BITS_READ_FUNCTIONS:
+                request = pdu.FUNCTIONS[name](*args, packed=self.__packed_bits)
+            elif name in pdu.REGS_READ_FUNCTIONS:
+                request = pdu.FUNCTIONS[name](*args, regs_as=self.__regs_as)
+            else:
+                request = pdu.FUNCTIONS[name](*args)
+        except pdu.PduError as e:
+            self.__debug_msg(str(e))
+            return None
+        if t_start is not None:
+            self.__trace = CallTrace(name, request.fc, t_start)
+        return request
+
+    def _decode(self, request, f_body):
+        """Decode response data of request, return None on error"""
+        # check error
+        if not f_body:
             return None
-        if (int(regs_addr) + int(regs_nb)) > 0x10000:
-            self.__debug_msg('write_multiple_registers(): write after ad 65535')
+        try:
+            return request.decode(f_body)
+        except pdu.PduError as e:
+            self.__debug_msg(str(e))
+            self.close()
             return None
-        # build frame
-        # format reg value string
-        regs_val_str = b""
-        for reg in regs_value:
-            # check current register value
-            if not (0 <= int(reg) <= 0xffff):
-                self.__debug_msg('write_multiple_registers(): regs_value out of range')
-                return None
-            # pack register for build frame
-            regs_val_str += struct.pack('>H', int(reg))
-        bytes_nb = len(regs_val_str)
-        # format modbus frame body
-        body = struct.pack('>HHB', regs_addr, regs_nb, bytes_nb) + regs_val_str
-        tx_buffer = self._mbus_frame(const.WRITE_MULTIPLE_REGISTERS, body)
+
+    def _transact(self, request):
+        """Send a request and wait for its response"""
+        if request is None:
+            return None
+        trace, self.__trace = self.__trace, None
+        # served by the cache
+        cached = self._cache_lookup(request)
+        if cached is not None:
+            self._end_trace(trace, cached, cached=True)
+            return cached
+        # cached values of the written range are stale from now
+        if self.__cache is not None:
+            self.__cache.begin_write(request, self.__unit_id)
+        # responses of pipelined requests come first
+        self.flush()
         # send request
-        s_send = self._send_mbus(tx_buffer)
+        s_send = self._send_traced(request, trace)
         # check error
         if not s_send:
+            self._end_trace(trace, None)
             return None
         # receive
         f_body = self._recv_mbus()
-        # check error
-        if not f_body:
+        if trace is not None:
+            trace.received = perf_counter()
+            # an except response keep the link open, other errors close it
+            if f_body is None and self.__sock is not None:
+                trace.exp_code = self.__last_except
+        result = self._decode(request, f_body)
+        # write-through or store read result
+        if self.__cache is not None:
+            self.__cache.update(request, result, self.__unit_id)
+        self._end_trace(trace, result)
+        return result
+
+    def _send_traced(self, request, trace):
+        """Frame and send request, timestamp its trace (if any)"""
+        frame = self._mbus_frame(request.fc, request.body)
+        if trace is None:
+            return self._send_mbus(frame)
+        trace.serialized = perf_counter()
+        s_send = self._send_mbus(frame)
+        trace.sent = perf_counter()
+        return s_send
+
+    def _end_trace(self, trace, result, cached=False):
+        """Close the trace of a call and pass it to the tracer"""
+        if trace is None:
+            return
+        trace.done = perf_counter()
+        trace.cached = cached
+        trace.ok = result is not None
+        self.__tracer.on_call(trace)
+
+    def _cache_lookup(self, request):
+        """Return the result of a read request served by the cache, None on miss"""
+        if self.__cache is None:
             return None
-        # check fix frame size
-        if len(f_body) != 4:
-            self.__debug_msg('write_multiple_registers(): rx frame size error')
-            self.close()
+        # a pipelined write of the range is not done: cached values may be stale
+        r_range = request_read_range(request)
+        if r_range is None:
             return None
-        # register extract
-        (rx_reg_addr, rx_reg_nb) = struct.unpack('>HH', f_body[:4])
-        # check regs write
-        is_ok = (rx_reg_addr == regs_addr)
-        return True if is_ok else None
+        for (p_request, future, trace) in self.__pending.values():
+            w_range = request_write_range(p_request)
+            if w_range is not None and ranges_overlap(r_range, w_range):
+                return None
+        values = self.__cache.lookup(request, self.__unit_id)
+        if values is not None and self.__packed_bits and request.fc in (const.READ_COILS,
+                                                                        const.READ_DISCRETE_INPUTS):
+            return BitList(pack_bits(values), len(values))
+        if values is not None and self.__regs_as != REGS_LIST and request.fc in (const.READ_HOLDING_REGISTERS,
+                                                                                 const.READ_INPUT_REGISTERS):
+            return codec.encode_regs(values, self.__regs_as)
+        return values
 
-    def _can_read(self):
-        """Wait data available for socket read
-        """
-        if self.__sock is None:
-            return None
-        if select.select([self.__sock], [], [], self.__timeout)[0]:
-            return True
-        else:
-            self.__debug_msg('timeout error')
+    def _wait(self, future):
+        """Receive pipelined responses until future is done"""
+        while not future.done():
+            if not self._pump():
+                break
+
+    def _pump(self):
+        """Receive one pipelined response and complete its future"""
+        frame = self._recv_frame()
+        if frame is None:
+            return False
+        (rx_hd_tr_id, rx_pdu) = frame
+        entry = self.__pending.pop(rx_hd_tr_id, None)
+        if entry is None:
+            self.__debug_msg('MBAP transaction ID error')
             self.close()
-            return None
+            return False
+        (request, future, trace) = entry
+        if trace is not None:
+            trace.received = perf_counter()
+            trace.exp_code = pdu.except_code(rx_pdu)
+        result = self._decode(request, self._pdu_data(rx_pdu))
+        if self.__cache is not None:
+            self.__cache.update(request, result, self.__unit_id)
+        self._end_trace(trace, result)
+        future.set_result(result)
+        return True
 
     def _send(self, data):
         """Send data over current socket"""
@@ -477,47 +549,43 @@ class ModbusClient:
         if self.__sock is None:
             self.__debug_msg('call _send on close socket')
             return None
-        # send
-        data_l = len(data)
+        # send (all bytes in one call)
         try:
-            send_l = self.__sock.send(data)
+            self.__sock.sendall(data)
         except socket.error:
-            send_l = None
-        # handle send error
-        if (send_l is None) or (send_l != data_l):
+            # handle send error
             self.__debug_msg('_send error')
             self.close()
             return None
-        else:
-            return send_l
+        return len(data)
 
-    def _recv(self, max_size):
-        """Receive data over current socket"""
-        # wait for read
-        if not self._can_read():
-            self.close()
-            return None
-        # recv
-        try:
-            r_buffer = self.__sock.recv(max_size)
-        except socket.error:
-            r_buffer = None
-        # handle recv error
-        if not r_buffer:
-            self.__debug_msg('_recv error')
-            self.close()
-            return None
-        return r_buffer
-
-    def _recv_all(self, size):
-        """Receive data over current socket, loop until all bytes is receive (avoid TCP frag)"""
-        r_buffer = bytes()
-        while len(r_buffer) < size:
-            r_packet = self._recv(size - len(r_buffer))
-            if not r_packet:
-                return None
-            r_buffer += r_packet
-        return r_buffer
+    def _fill(self, size):
+        """Receive until size bytes are buffered from rx start, return False on error"""
+        # check link
+        if self.__sock is None:
+            return False
+        while self.__rx_end - self.__rx_start < size:
+            if self.__rx_start + size > RX_BUFFER_SIZE:
+                # move the partial frame at the beginning
+                pending = self.__rx_end - self.__rx_start
+                self.__rx_buffer[:pending] = self.__rx_buffer[self.__rx_start:self.__rx_end]
+                self.__rx_start, self.__rx_end = 0, pending
+            # recv all available (socket timeout is set: no select before)
+            try:
+                count = self.__sock.recv_into(self.__rx_view[self.__rx_end:])
+            except socket.timeout:
+                self.__debug_msg('timeout error')
+                self.close()
+                return False
+            except socket.error:
+                count = 0
+            # handle recv error
+            if not count:
+                self.__debug_msg('_recv error')
+                self.close()
+                return False
+            self.__rx_end += count
+        return True
 
     def _send_mbus(self, frame):
         """Send modbus frame"""
@@ -530,72 +598,77 @@ class ModbusClient:
         else:
             return None
 
-    def _recv_mbus(self):
-        """Receive a modbus frame"""
-        # receive
+    def _recv_frame(self):
+        """Receive a modbus frame, return (transaction ID, PDU) or None
+
+        PDU is a memoryview on the receive buffer: only valid until the next receive.
+        """
+        # buffer empty: restart at its beginning
+        if self.__rx_start == self.__rx_end:
+            self.__rx_start = self.__rx_end = 0
         # modbus TCP receive
         # 7 bytes header (mbap)
-        rx_buffer = self._recv_all(7)
-        # check recv
-        if not (rx_buffer and len(rx_buffer) == 7):
+        if not self._fill(7):
             self.__debug_msg('_recv MBAP error')
             self.close()
             return None
-        rx_frame = rx_buffer
-        # decode header
-        (rx_hd_tr_id, rx_hd_pr_id,
-         rx_hd_length, rx_hd_unit_id) = struct.unpack('>HHHB', rx_frame)
-        # check header
-        if not ((rx_hd_tr_id == self.__hd_tr_id) and
-                (rx_hd_pr_id == 0) and
-                (rx_hd_length < 256) and
-                (rx_hd_unit_id == self.__unit_id)):
+        # decode and check header
+        mbap = pdu.decode_mbap(self.__rx_buffer, self.__unit_id, self.__rx_start)
+        if mbap is None:
             self.__debug_msg('MBAP format error')
             if self.__debug:
-                rx_frame += self._recv_all(rx_hd_length - 1)
-                self._pretty_dump('Rx', rx_frame)
+                self._pretty_dump('Rx', self.__rx_view[self.__rx_start:self.__rx_end])
             self.close()
             return None
+        (rx_hd_tr_id, rx_hd_length) = mbap
         # end of frame
-        rx_buffer = self._recv_all(rx_hd_length - 1)
-        if not (rx_buffer and
-                (len(rx_buffer) == rx_hd_length - 1) and
-                (len(rx_buffer) >= 2)):
+        if not self._fill(6 + rx_hd_length):
             self.__debug_msg('_recv frame body error')
             self.close()
             return None
-        # adaugam in MBAP si PDU
-        rx_frame += rx_buffer
+        # (the partial frame may have moved)
+        start = self.__rx_start
+        end = self.__rx_start = start + 6 + rx_hd_length
         # dump frame
         if self.__debug:
-            self._pretty_dump('Rx', rx_frame)
-        # body decode
-        rx_bd_fc = struct.unpack('B', rx_buffer[0:1])[0]
-        f_body = rx_buffer[1:]
+            self._pretty_dump('Rx', self.__rx_view[start:end])
+        return rx_hd_tr_id, self.__rx_view[start + 7:end]
+
+    def _recv_mbus(self):
+        """Receive the modbus frame of the last request, return its data (after function code)"""
+        frame = self._recv_frame()
+        if frame is None:
+            return None
+        (rx_hd_tr_id, rx_pdu) = frame
+        # check transaction ID
+        if rx_hd_tr_id != self.__hd_tr_id:
+            self.__debug_msg('MBAP transaction ID error')
+            self.close()
+            return None
+        return self._pdu_data(rx_pdu)
+
+    def _pdu_data(self, rx_pdu):
+        """Return data of a response PDU, None if it is an except"""
         # check except
-        if rx_bd_fc > 0x80:
-            # except code
-            exp_code = struct.unpack('B', f_body[0:1])[0]
+        exp_code = pdu.except_code(rx_pdu)
+        if exp_code is not None:
             self.__last_except = exp_code
             self.__debug_msg('except (code ' + str(exp_code) + ')')
             return None
         else:
-            # return
-            return f_body
+            # return data after function code
+            return rx_pdu[1:]
 
     def _mbus_frame(self, fc, body):
         """Build modbus frame (add MBAP for Modbus/TCP, slave AD + CRC for RTU)
         """
-        # build frame body
-        f_body = struct.pack('B', fc) + body
         # modbus/TCP
-        # build frame ModBus Application Protocol header (mbap)
-        self.__hd_tr_id = random.randint(0, 65535)
-        tx_hd_pr_id = 0
-        tx_hd_length = len(f_body) + 1
-        f_mbap = struct.pack('>HHHB', self.__hd_tr_id, tx_hd_pr_id,
-                             tx_hd_length, self.__unit_id)
-        return f_mbap + f_body
+        # build frame ModBus Application Protocol header (mbap) and body in the tx buffer,
+        # the returned view is valid until the next frame
+        # transaction ID increase for each request: unique for all pipelined requests
+        self.__hd_tr_id = (self.__hd_tr_id + 1) & 0xFFFF
+        size = pdu.mbap_frame_into(self.__tx_buffer, self.__hd_tr_id, self.__unit_id, fc, body)
+        return self.__tx_view[:size]
 
     def _pretty_dump(self, label, data):
         """Print modbus/TCP frame ('[header]body') on stdout
@@ -620,7 +693,29 @@ class ModbusClient:
             print(msg)
 
 
+def split_range(address, number, max_nb):
+    """Split a range in (address, number) chunks of at most max_nb items"""
+    return [(chunk_addr, min(max_nb, address + number - chunk_addr))
+            for chunk_addr in range(address, address + number, max_nb)]
+
+
+class PipelineFuture(Future):
+    """Future of a pipelined request: result() receive responses until this one is done"""
+
+    def __init__(self, client):
+        super().__init__()
+        self._client = client
+
+    def result(self, timeout=None):
+        if not self.done():
+            self._client._wait(self)
+        return super().result(timeout)
+
+
 if __name__ == "__main__":
+    from tkinter import *
+    from interface import Interface
+
     SERVER_HOST = "localhost"
     SERVER_PORT = 502
 
@@ -0,0 +1,311 @@
+from array import array
+from itertools import chain
+import struct
+import sys
+
+# numpy is optional and slow to import: only imported by the numpy paths (see _numpy())
+
+
+def _numpy():
+    """Return the numpy module (imported on first call), None if it's not installed"""
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+def has_numpy():
+    """Check if numpy is installed"""
+    return _numpy() is not None
+
+
+def _is_ndarray(obj):
+    """Check if obj is a numpy array (without importing numpy: no numpy module, no arrays)"""
+    np = sys.modules.get('numpy')
+    return np is not None and isinstance(obj, np.ndarray)
+
+##################################
+# coils/discrete inputs bits codec
+##################################
+# bits are packed LSB first, as in Modbus frames: bit i is bit (i % 8) of byte (i // 8)
+
+# byte value -> tuple of its 8 bits
+_UNPACK_TABLE = tuple(tuple(bool(byte >> i & 0x01) for i in range(8)) for byte in range(256))
+# byte with a bit value (0 or any non zero) -> ascii '0' or '1'
+_ASCII_TABLE = b'0' + b'1' * 255
+
+
+def pack_bits(bits):
+    """Pack a sequence of bits to bytes"""
+    if isinstance(bits, BitList):
+        return bits.tobytes()
+    if _is_ndarray(bits):
+        np = _numpy()
+        return np.packbits(bits.astype(bool), bitorder='little').tobytes()
+    try:
+        bits_b = bytes(bits)
+    except (TypeError, ValueError):
+        # not 0/1 or bool items: normalize them
+        bits_b = bytes(map(bool, bits))
+    if not bits_b:
+        return b''
+    # '0'/'1' string with bit 0 at the end -> int -> little endian bytes
+    value = int(bits_b.translate(_ASCII_TABLE)[::-1], 2)
+    return value.to_bytes((len(bits_b) + 7) // 8, 'little')
+
+
+def unpack_bits(data, number=None, offset=0):
+    """Unpack number bits of data starting at bit offset to a list of bool"""
+    if number is None:
+        number = len(data) * 8 - offset
+    first = offset >> 3
+    last = (offset + number + 7) >> 3
+    bits = list(chain.from_iterable(map(_UNPACK_TABLE.__getitem__, data[first:last])))
+    shift = offset & 7
+    return bits[shift:shift + number]
+
+
+def read_bitset(bitset, address, number):
+    """Return number bits at address of a bitset (bytearray) as packed bytes"""
+    first = address >> 3
+    last = (address + number + 7) >> 3
+    value = int.from_bytes(bitset[first:last], 'little') >> (address & 7)
+    value &= (1 << number) - 1
+    return value.to_bytes((number + 7) // 8, 'little')
+
+
+def write_bitset(bitset, address, data, number):
+    """Write number packed bits of data at address of a bitset (bytearray)"""
+    first = address >> 3
+    last = (address + number + 7) >> 3
+    shift = address & 7
+    mask = ((1 << number) - 1) << shift
+    value = (int.from_bytes(data, 'little') << shift) & mask
+    old = int.from_bytes(bitset[first:last], 'little')
+    bitset[first:last] = ((old & ~mask) | value).to_bytes(last - first, 'little')
+
+
+class BitList:
+    """Compact read-only sequence of bits (packed bytes) returned by the client in packed bits mode
+
+    Support len(), indexing, iteration and comparison with a list of bool.
+    """
+
+    __slots__ = ('_value', '_number')
+
+    def __init__(self, data, number=None):
+        if number is None:
+            number = len(data) * 8
+        self._number = number
+        self._value = int.from_bytes(data, 'little') & ((1 << number) - 1)
+
+    def __len__(self):
+        return self._number
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.tolist()[index]
+        if index < 0:
+            index += self._number
+        if not (0 <= index < self._number):
+            raise IndexError('bit index out of range')
+        return bool(self._value >> index & 0x01)
+
+    def __iter__(self):
+        return iter(self.tolist())
+
+    def __eq__(self, other):
+        if isinstance(other, BitList):
+            return (self._number, self._value) == (other._number, other._value)
+        try:
+            return self.tolist() == list(other)
+        except TypeError:
+            return NotImplemented
+
+    def __repr__(self):
+        return 'BitList(%r, %d)' % (self.tobytes(), self._number)
+
+    def count(self, value=True):
+        """Number of bits set (or cleared if value is False)"""
+        ones = bin(self._value).count('1')
+        return ones if value else self._number - ones
+
+    def tobytes(self):
+        """Bits packed LSB first"""
+        return self._value.to_bytes((self._number + 7) // 8, 'little')
+
+    def to_int(self):
+        """Bits as an int bitmask (bit i is bit i of the mask)"""
+        return self._value
+
+    def tolist(self):
+        """Bits as a list of bool"""
+        return unpack_bits(self.tobytes(), self._number)
+
+    def to_numpy(self):
+        """Bits as a numpy bool array (need numpy)"""
+        np = _numpy()
+        if np is None:
+            raise ImportError('to_numpy() require numpy')
+        packed = np.frombuffer(self.tobytes(), dtype=np.uint8)
+        return np.unpackbits(packed, count=self._number, bitorder='little').astype(bool)
+
+
+#################
+# registers codec
+#################
+# registers are 16 bits big endian words in frames, a value over many registers has its most
+# significant register first with word order 'big'
+
+# register results format
+REGS_LIST = 'list'  # list of int
+REGS_ARRAY = 'array'  # array('H')
+REGS_NUMPY = 'numpy'  # numpy uint16 array
+# register types: name -> (struct format, numpy type code, size in registers)
+REG_TYPES = {
+    'int16': ('h', 'i2', 1),
+    'uint16': ('H', 'u2', 1),
+    'int32': ('i', 'i4', 2),
+    'uint32': ('I', 'u4', 2),
+    'float32': ('f', 'f4', 2),
+    'int64': ('q', 'i8', 4),
+    'uint64': ('Q', 'u8', 4),
+    'float64': ('d', 'f8', 4),
+}
+
+
+def decode_regs(data, regs_as=REGS_LIST):
+    """Decode big endian registers bytes to a list, an array('H') or a numpy uint16 array
+
+    Result is a copy (data can be a view on a receive buffer), decoded in one step.
+    """
+    if regs_as == REGS_NUMPY:
+        np = _numpy()
+        if np is None:
+            raise ImportError('numpy registers require numpy')
+        return np.frombuffer(data, dtype='>u2').astype(np.uint16)
+    if regs_as == REGS_ARRAY:
+        regs = array('H')
+        regs.frombytes(data)
+        if sys.byteorder == 'little':
+            regs.byteswap()
+        return regs
+    return list(struct.unpack('>%dH' % (len(data) // 2), data))
+
+
+def encode_regs(regs, regs_as=REGS_LIST):
+    """Return a sequence of registers values in regs_as format"""
+    if regs_as == REGS_NUMPY:
+        np = _numpy()
+        if np is None:
+            raise ImportError('numpy registers require numpy')
+        return np.array(regs, dtype=np.uint16)
+    if regs_as == REGS_ARRAY:
+        return array('H', regs)
+    return list(regs)
+
+
+def join_results(results):
+    """Join results of consecutive reads (lists, BitList, arrays or numpy arrays) in one
+
+    Return None if one of them is None (a failed read).
+    """
+    if any(result is None for result in results):
+        return None
+    first = results[0]
+    if isinstance(first, BitList):
+        value = 0
+        number = 0
+        for result in results:
+            value |= result.to_int() << number
+            number += len(result)
+        return BitList(value.to_bytes((number + 7) // 8, 'little'), number)
+    if isinstance(first, array):
+        joined = array(first.typecode)
+        for result in results:
+            joined.extend(result)
+        return joined
+    if _is_ndarray(first):
+        return _numpy().concatenate(results)
+    return list(chain.from_iterable(results))
+
+
+def regs_to_values(regs, reg_type, word_order='big'):
+    """Reinterpret a registers block as values of reg_type ('int32', 'float32', ...)
+
+    Return a list, or a numpy array if regs is one.
+    """
+    (fmt, np_code, size) = _reg_type(reg_type, word_order)
+    if len(regs) % size:
+        raise ValueError('%d registers is not a whole number of %s' % (len(regs), reg_type))
+    if _is_ndarray(regs):
+        np = _numpy()
+        words = regs.astype(np.uint16).reshape(-1, size)
+        if word_order == 'little':
+            words = words[:, ::-1]
+        return words.astype('>u2').view('>' + np_code).astype(np_code).ravel()
+    regs = _word_order(regs, size, word_order)
+    if sys.byteorder == 'little':
+        regs.byteswap()
+    return list(struct.unpack('>%d%s' % (len(regs) // size, fmt), regs))
+
+
+def values_to_regs(values, reg_type, word_order='big'):
+    """Return the registers (a list, or a numpy uint16 array for a numpy array) of values of reg_type"""
+    (fmt, np_code, size) = _reg_type(reg_type, word_order)
+    if _is_ndarray(values):
+        np = _numpy()
+        words = values.astype('>' + np_code).view('>u2').astype(np.uint16).reshape(-1, size)
+        if word_order == 'little':
+            words = words[:, ::-1]
+        return words.ravel()
+    regs = array('H')
+    regs.frombytes(struct.pack('>%d%s' % (len(values), fmt), *values))
+    if sys.byteorder == 'little':
+        regs.byteswap()
+    return _word_order(regs, size, word_order).tolist()
+
+
+def regs_to_ascii(regs, byte_order='big'):
+    """Decode registers holding 2 chars each (first char in high byte with byte_order 'big')
+
+    Trailing NUL chars are removed.
+    """
+    regs = array('H', regs)
+    if (sys.byteorder == 'little') == (byte_order == 'big'):
+        regs.byteswap()
+    return regs.tobytes().rstrip(b'\x00').decode('ascii', errors='replace')
+
+
+def ascii_to_regs(text, number=None, byte_order='big'):
+    """Return the registers of an ASCII string, NUL padded to number registers (if set)"""
+    data = text.encode('ascii')
+    if number is None:
+        number = (len(data) + 1) // 2
+    if len(data) > 2 * number:
+        raise ValueError('text longer than %d registers' % number)
+    regs = array('H')
+    regs.frombytes(data.ljust(2 * number, b'\x00'))
+    if (sys.byteorder == 'little') == (byte_order == 'big'):
+        regs.byteswap()
+    return regs.tolist()
+
+
+def _reg_type(reg_type, word_order):
+    if reg_type not in REG_TYPES:
+        raise ValueError('unknown register type %r' % reg_type)
+    if word_order not in ('big', 'little'):
+        raise ValueError('word_order must be big or little')
+    return REG_TYPES[reg_type]
+
+
+def _word_order(regs, size, word_order):
+    """Return registers as a new array('H'), registers of each value reversed for word_order 'little'"""
+    regs = array('H', regs)
+    if word_order == 'big' or size == 1:
+        return regs
+    swapped = array('H', regs)
+    for i in range(size):
+        swapped[i::size] = regs[size - 1 - i::size]
+    return swapped
@@ -0,0 +1,191 @@
+"""Headless metrics collector: sample host metrics and push them to a ModbusServer
+
+CPU, battery and disks are sampled without blocking at --rate Hz (slow-changing values are
+cached) and written as one registers block per tick (the block shown by Interface). Writes are
+pipelined: a tick don't wait for the response of the previous ones. With --serve the collector
+run its own ModbusServer on host:port and write its DataBank directly.
+
+usage: python collector.py [--host localhost] [--port 502] [--rate 10] [--drives C:,D:,E:]
+                           [--serve] [--duration 0]
+"""
+
+import argparse
+from client import ModbusClient
+from collections import deque
+import constants as const
+import psutil
+from threading import Event
+import time
+
+holding_register_offset = 40000
+
+# metrics block: every metric is in one holding registers block, written (and read back by
+# Interface) with one request per tick (disks keep their 40010-40015 addresses)
+METRICS_ADDR = 10 + holding_register_offset
+METRICS = ('disk_c', 'disk_d', 'disk_e', 'mem_c', 'mem_d', 'mem_e', 'cpu', 'battery', 'plugged')
+# register value of a metric not available on this host (no battery, missing drive)
+NOT_AVAILABLE = 0xFFFF
+# sampled drives (mount points on Linux) for disk_c, disk_d and disk_e
+DRIVES = ('C:', 'D:', 'E:')
+# refresh period (s) of slow-changing metrics
+DISK_PERIOD = 5.0
+BATTERY_PERIOD = 1.0
+
+
+class Sampler:
+    """Non-blocking sampler of host metrics
+
+    CPU usage is measured since the previous sample (no sleep), battery and disks are
+    only read again after BATTERY_PERIOD and DISK_PERIOD s.
+    """
+
+    def __init__(self, drives=DRIVES, disk_period=DISK_PERIOD, battery_period=BATTERY_PERIOD):
+        self.drives = tuple(drives)[:3]
+        self.disk_period = disk_period
+        self.battery_period = battery_period
+        # private
+        self._disk = {}
+        self._disk_time = None
+        self._battery = {}
+        self._battery_time = None
+        # first call start the CPU measure, next ones return usage since the previous one
+        psutil.cpu_percent(interval=None)
+
+    def sample(self):
+        """Return metrics values ordered as METRICS"""
+        now = time.monotonic()
+        if self._battery_time is None or now - self._battery_time >= self.battery_period:
+            self._battery = self.battery_met()
+            self._battery_time = now
+        if self._disk_time is None or now - self._disk_time >= self.disk_period:
+            self._disk = self.disk_met()
+            self._disk_time = now
+        metrics = {}
+        metrics.update(self.cpu_met())
+        metrics.update(self._battery)
+        metrics.update(self._disk)
+        return [metrics.get(name, NOT_AVAILABLE) for name in METRICS]
+
+    def cpu_met(self):
+        return {'cpu': int(psutil.cpu_percent(interval=None))}
+
+    def battery_met(self):
+        battery = psutil.sensors_battery()
+        # no battery on this host
+        if battery is None:
+            return {}
+        return {'battery': int(battery.percent), 'plugged': int(bool(battery.power_plugged))}
+
+    def disk_met(self):
+        metrics = {}
+        for name, drive in zip(('c', 'd', 'e'), self.drives):
+            try:
+                usage = psutil.disk_usage(drive)
+            except OSError:
+                # missing drive
+                continue
+            metrics['disk_' + name] = int(usage.percent)
+            # capacity in GB
+            metrics['mem_' + name] = min(int(usage.total) // 10 ** 9, NOT_AVAILABLE - 1)
+        return metrics
+
+
+class Collector:
+    """Push samples of a Sampler at rate Hz to a server (client) or to a DataBank"""
+
+    def __init__(self, sampler, client=None, data_bank=None, rate=10.0):
+        if (client is None) == (data_bank is None):
+            raise ValueError('need a client or a data bank')
+        self.sampler = sampler
+        self.client = client
+        self.data_bank = data_bank
+        self.rate = rate
+        # counters
+        self.ticks = 0
+        self.writes = 0
+        self.errors = 0
+        self.late = 0  # ticks which missed their deadline
+        # private
+        self._stop = Event()
+        self._futures = deque()  # pipelined writes not checked yet
+
+    def run(self, duration=None):
+        """Sample and push until stop() (or for duration s)"""
+        period = 1.0 / self.rate
+        t_end = None if duration is None else time.monotonic() + duration
+        t_next = time.monotonic()
+        self._stop.clear()
+        while not self._stop.is_set():
+            self.push(self.sampler.sample())
+            self.ticks += 1
+            # fixed schedule: no drift, a late tick is not made up
+            t_next += period
+            now = time.monotonic()
+            if t_end is not None and now >= t_end:
+                break
+            if t_next < now:
+                self.late += 1
+                t_next = now
+            self._stop.wait(t_next - now)
+        if self.client is not None:
+            self.client.flush()
+            self._check_writes()
+
+    def stop(self):
+        self._stop.set()
+
+    def push(self, values):
+        """Write a sample to the server"""
+        if self.data_bank is not None:
+            if self.data_bank.set_words(METRICS_ADDR, values):
+                self.writes += 1
+            else:
+                self.errors += 1
+            return
+        if not (self.client.is_open() or self.client.open()):
+            self.errors += 1
+            return
+        self._futures.append(self.client.submit('write_multiple_registers', METRICS_ADDR, values))
+        self._check_writes()
+
+    def _check_writes(self):
+        """Count results of the completed pipelined writes"""
+        while self._futures and self._futures[0].done():
+            if self._futures.popleft().result() is None:
+                self.errors += 1
+            else:
+                self.writes += 1
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=const.MODBUS_PORT)
+    parser.add_argument('--rate', type=float, default=10.0, help='samples by s')
+    parser.add_argument('--drives', default=','.join(DRIVES), help='drives (mount points) of disk c, d, e')
+    parser.add_argument('--serve', action='store_true', help='run the ModbusServer in this process')
+    parser.add_argument('--duration', type=float, default=0.0, help='s (0 run until interrupted)')
+    args = parser.parse_args()
+    server = None
+    client = None
+    if args.serve:
+        from server import ModbusServer
+        server = ModbusServer(host=args.host, port=args.port, no_block=True)
+        server.start()
+        collector = Collector(Sampler(args.drives.split(',')), data_bank=server.data_bank, rate=args.rate)
+    else:
+        client = ModbusClient(host=args.host, port=args.port)
+        collector = Collector(Sampler(args.drives.split(',')), client=client, rate=args.rate)
+    t_start = time.monotonic()
+    try:
+        collector.run(args.duration or None)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if client is not None:
+            client.close()
+        if server is not None:
+            server.stop()
+    elapsed = time.monotonic() - t_start
+    print('%d samples in %.1f s (%.1f Hz), %d writes, %d errors, %d late ticks' %
+          (collector.ticks, elapsed, collector.ticks / elapsed, collector.writes, collector.errors, collector.late))
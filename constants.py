@@ -1,5 +1,10 @@
 # ModBus/TCP
 MODBUS_PORT = 502
+# server engine
+ENGINE_THREAD = 'thread'
+ENGINE_ASYNCIO = 'asyncio'
+# pending connections queue of the asyncio engine (sized for many clients)
+ASYNCIO_BACKLOG = 1024
 # Modbus function code
 # standard
 READ_COILS = 0x01
@@ -10,6 +15,15 @@ WRITE_SINGLE_COIL = 0x05
 WRITE_SINGLE_REGISTER = 0x06
 WRITE_MULTIPLE_COILS = 0x0F
 WRITE_MULTIPLE_REGISTERS = 0x10
+READ_WRITE_MULTIPLE_REGISTERS = 0x17
+# custom (user defined function code range)
+# subscribe to changes of a range, the server push them with the same function code
+SUBSCRIBE = 0x41
+# subscribe spaces
+SPACE_BITS = 0x00
+SPACE_WORDS = 0x01
+# transaction ID of push frames (never used by requests of subscribers)
+PUSH_TR_ID = 0
 
 # Modbus except code
 EXP_ILLEGAL_FUNCTION = 0x01
@@ -17,5 +31,7 @@ EXP_DATA_ADDRESS = 0x02
 EXP_DATA_VALUE = 0x03
 EXP_SLAVE_DEVICE_FAILURE = 0x04
 EXP_SLAVE_DEVICE_BUSY = 0x06
+EXP_GATEWAY_PATH_UNAVAILABLE = 0x0A
+EXP_GATEWAY_TARGET_DEVICE_FAILED_TO_RESPOND = 0x0B
 
 
@@ -0,0 +1,644 @@
+from array import array
+import asyncio
+from codec import pack_bits, unpack_bits, read_bitset, write_bitset
+from contextlib import contextmanager
+import mmap
+import multiprocessing
+import os
+import sys
+from threading import Lock
+
+# default size of address spaces
+BITS_SPACE_SIZE = 0x20000
+WORDS_SPACE_SIZE = 0x40000
+# address spaces of a DataBank
+SPACES = ('bits', 'words')
+# dirty ranges kept by space, over it they are merged in one range
+MAX_DIRTY = 64
+# default lock stripes size (in bits or words)
+STRIPE_BITS = 0x4000
+STRIPE_WORDS = 0x400
+# lock free read tries before a reader wait for writers
+SEQ_RETRIES = 4
+# process locks of shared stripes, common to all data banks: stripes are hashed on them (a
+# process lock use a memory mapping, a lock by stripe exhaust them in a gateway of many units)
+SHARED_LOCKS = 64
+# sequences by shared mmap, shared stripes of many data banks take their sequences in one
+SEQS_ARENA_SIZE = 0x8000
+
+# shared stripes resources, created on first use (before fork)
+_shared_alloc_lock = Lock()
+_shared_locks = []
+_seqs_arena = None
+_seqs_next = 0  # first free sequence of the arena
+_stripes_next = 0  # shared stripes created: lock hash base of the next ones
+
+
+class DenseBits:
+    """Bits space stored as a bitset in one bytearray (allocated on first write)"""
+
+    def __init__(self, size=BITS_SPACE_SIZE):
+        self.size = size
+        self._bytes = None
+        # writers of different stripes may allocate at the same time
+        self._alloc_lock = Lock()
+
+    def __len__(self):
+        return self.size
+
+    def get(self, address, number):
+        """Return a list of number bits at address"""
+        return unpack_bits(self.get_packed(address, number), number)
+
+    def set(self, address, bit_list):
+        """Write bit_list at address"""
+        self.set_packed(address, pack_bits(bit_list), len(bit_list))
+
+    def get_packed(self, address, number):
+        """Return number bits at address as packed bytes"""
+        if self._bytes is None:
+            return bytes((number + 7) // 8)
+        return read_bitset(self._bytes, address, number)
+
+    def set_packed(self, address, data, number):
+        """Write number packed bits of data at address"""
+        if self._bytes is None:
+            # nothing to allocate for an all False write
+            if not any(data):
+                return
+            with self._alloc_lock:
+                if self._bytes is None:
+                    self._bytes = bytearray((self.size + 7) // 8)
+        write_bitset(self._bytes, address, data, number)
+
+
+class DenseWords:
+    """Words space stored in one array('H') (allocated on first write)
+
+    get() return a memoryview on the live storage, copy it to keep a snapshot.
+    """
+
+    def __init__(self, size=WORDS_SPACE_SIZE):
+        self.size = size
+        self._words = None
+        # writers of different stripes may allocate at the same time
+        self._alloc_lock = Lock()
+
+    def __len__(self):
+        return self.size
+
+    def get(self, address, number):
+        """Return a view of number words at address"""
+        if self._words is None:
+            return memoryview(array('H', bytes(2 * number)))
+        return memoryview(self._words)[address:address + number]
+
+    def set(self, address, word_list):
+        """Write word_list at address"""
+        if self._words is None:
+            # nothing to allocate for an all zero write
+            if not any(word_list):
+                return
+            with self._alloc_lock:
+                if self._words is None:
+                    self._words = array('H', bytes(2 * self.size))
+        self._words[address:address + len(word_list)] = array('H', word_list)
+
+
+class SparseBits:
+    """Bits space split in pages, a page is only allocated when a bit of it is set"""
+
+    def __init__(self, size=BITS_SPACE_SIZE, page_size=2048):
+        if page_size % 8:
+            raise ValueError('page_size must be a multiple of 8')
+        self.size = size
+        self.page_size = page_size
+        self._pages = {}
+
+    def __len__(self):
+        return self.size
+
+    def get(self, address, number):
+        """Return a list of number bits at address"""
+        return unpack_bits(self.get_packed(address, number), number)
+
+    def set(self, address, bit_list):
+        """Write bit_list at address"""
+        self.set_packed(address, pack_bits(bit_list), len(bit_list))
+
+    def get_packed(self, address, number):
+        """Return number bits at address as packed bytes"""
+        value = 0
+        pos = 0
+        for page_i, offset, count in _page_spans(address, number, self.page_size):
+            page = self._pages.get(page_i)
+            if page is not None:
+                value |= int.from_bytes(read_bitset(page, offset, count), 'little') << pos
+            pos += count
+        return value.to_bytes((number + 7) // 8, 'little')
+
+    def set_packed(self, address, data, number):
+        """Write number packed bits of data at address"""
+        value = int.from_bytes(data, 'little')
+        for page_i, offset, count in _page_spans(address, number, self.page_size):
+            chunk = value & ((1 << count) - 1)
+            value >>= count
+            page = self._pages.get(page_i)
+            if page is None:
+                if not chunk:
+                    continue
+                # setdefault is atomic: writers of the page (other stripes) get the same one
+                page = self._pages.setdefault(page_i, bytearray(self.page_size // 8))
+            write_bitset(page, offset, chunk.to_bytes((count + 7) // 8, 'little'), count)
+
+
+class SparseWords:
+    """Words space split in pages, a page is only allocated when a word of it is non zero
+
+    get() return a memoryview on the live page when the read fit in it, otherwise a copy.
+    """
+
+    def __init__(self, size=WORDS_SPACE_SIZE, page_size=256):
+        self.size = size
+        self.page_size = page_size
+        self._pages = {}
+
+    def __len__(self):
+        return self.size
+
+    def get(self, address, number):
+        """Return number words at address"""
+        spans = _page_spans(address, number, self.page_size)
+        # zero copy path: the read stay in one allocated page
+        if len(spans) == 1:
+            page_i, offset, count = spans[0]
+            page = self._pages.get(page_i)
+            if page is not None:
+                return memoryview(page)[offset:offset + count]
+        words = array('H', bytes(2 * number))
+        pos = 0
+        for page_i, offset, count in spans:
+            page = self._pages.get(page_i)
+            if page is not None:
+                words[pos:pos + count] = page[offset:offset + count]
+            pos += count
+        return memoryview(words)
+
+    def set(self, address, word_list):
+        """Write word_list at address"""
+        pos = 0
+        for page_i, offset, count in _page_spans(address, len(word_list), self.page_size):
+            chunk = word_list[pos:pos + count]
+            pos += count
+            page = self._pages.get(page_i)
+            if page is None:
+                if not any(chunk):
+                    continue
+                # setdefault is atomic: writers of the page (other stripes) get the same one
+                page = self._pages.setdefault(page_i, array('H', bytes(2 * self.page_size)))
+            page[offset:offset + count] = array('H', chunk)
+
+
+class SharedBits:
+    """Bits space stored as a bitset in a shared mmap, anonymous or of file path (persistent)
+
+    Processes forked after its creation share it (multi-process server).
+    """
+
+    def __init__(self, size=BITS_SPACE_SIZE, path=None):
+        self.size = size
+        self._bytes = _shared_mmap((size + 7) // 8, path)
+
+    def __len__(self):
+        return self.size
+
+    def get(self, address, number):
+        """Return a list of number bits at address"""
+        return unpack_bits(self.get_packed(address, number), number)
+
+    def set(self, address, bit_list):
+        """Write bit_list at address"""
+        self.set_packed(address, pack_bits(bit_list), len(bit_list))
+
+    def get_packed(self, address, number):
+        """Return number bits at address as packed bytes"""
+        return read_bitset(self._bytes, address, number)
+
+    def set_packed(self, address, data, number):
+        """Write number packed bits of data at address"""
+        write_bitset(self._bytes, address, data, number)
+
+    def flush(self):
+        """Write changes to the file"""
+        self._bytes.flush()
+
+
+class SharedWords:
+    """Words space stored in a shared mmap, anonymous or of file path (persistent)
+
+    Processes forked after its creation share it (multi-process server).
+    get() return a memoryview on the live storage, copy it to keep a snapshot.
+    Words are stored in native byte order.
+    """
+
+    def __init__(self, size=WORDS_SPACE_SIZE, path=None):
+        self.size = size
+        self._mmap = _shared_mmap(2 * size, path)
+        self._words = memoryview(self._mmap).cast('H')
+
+    def __len__(self):
+        return self.size
+
+    def get(self, address, number):
+        """Return a view of number words at address"""
+        return self._words[address:address + number]
+
+    def set(self, address, word_list):
+        """Write word_list at address"""
+        self._words[address:address + len(word_list)] = array('H', word_list)
+
+    def flush(self):
+        """Write changes to the file"""
+        self._mmap.flush()
+
+
+class Stripes:
+    """Locks of an address space split in stripes, with a sequence counter by stripe (seqlock)
+
+    A writer lock the stripes of its range (in address order) and keep their sequence odd
+    while it write: writes to unrelated ranges run in parallel, writes to a range are atomic.
+    Readers take no lock, they copy the range and retry if a writer was in it meanwhile.
+    With shared, sequences are in a shared mmap and locks are process locks: stripes are
+    shared with processes forked after their creation. All shared stripes use the same
+    SHARED_LOCKS process locks, stripe i use lock (base + i) % SHARED_LOCKS (base is different
+    for each Stripes).
+    """
+
+    def __init__(self, size, stripe_size, shared=False):
+        self.stripe_size = stripe_size
+        count = (size + stripe_size - 1) // stripe_size
+        if shared:
+            # created before fork: no lazy creation
+            (self.seqs, self._shared_locks, self._lock_base) = _alloc_shared(count)
+        else:
+            self.seqs = array('Q', bytes(8 * count))
+            self._shared_locks = None
+        # stripe index -> lock, created on first write of the stripe (not shared)
+        self._locks = {}
+
+    def lock(self, i):
+        """Return the lock i (a lock ID of lock_ids())"""
+        if self._shared_locks is not None:
+            return self._shared_locks[i]
+        lock = self._locks.get(i)
+        if lock is None:
+            # setdefault is atomic: two threads get the same lock
+            lock = self._locks.setdefault(i, Lock())
+        return lock
+
+    def lock_ids(self, stripes):
+        """Return the IDs of the locks of stripes, in lock order (stripes are in address order)"""
+        if self._shared_locks is not None:
+            # hashed stripes can share a lock: take it once
+            return sorted(set((self._lock_base + i) % SHARED_LOCKS for i in stripes))
+        return stripes
+
+    def span(self, address, number):
+        """Return the range of stripes of a range of addresses"""
+        return range(address // self.stripe_size, (address + max(number, 1) - 1) // self.stripe_size + 1)
+
+    @contextmanager
+    def write(self, address, number, hold=None):
+        """Context manager for a write of a range
+
+        The stripes of an optional hold (address, number) range are locked too (no writer in
+        it) but readers of it are not disturbed: to read it consistently with the write.
+        """
+        span = self.span(address, number)
+        locked = self.lock_ids(sorted(set(span).union(self.span(*hold))) if hold else span)
+        for i in locked:
+            self.lock(i).acquire()
+        try:
+            for i in span:
+                self.seqs[i] += 1
+            yield
+        finally:
+            for i in span:
+                self.seqs[i] += 1
+            for i in reversed(locked):
+                self.lock(i).release()
+
+    def read(self, address, number, copy):
+        """Return copy() result, with a consistent snapshot of a range"""
+        span = self.span(address, number)
+        for _ in range(SEQ_RETRIES):
+            seqs = self.seqs[span.start:span.stop].tolist()
+            if not any(seq & 1 for seq in seqs):
+                data = copy()
+                if self.seqs[span.start:span.stop].tolist() == seqs:
+                    return data
+        # busy range: wait for writers
+        locked = self.lock_ids(span)
+        for i in locked:
+            self.lock(i).acquire()
+        try:
+            return copy()
+        finally:
+            for i in reversed(locked):
+                self.lock(i).release()
+
+
+def _alloc_shared(count):
+    """Return (sequences, process locks, lock hash base) of count new shared stripes"""
+    global _seqs_arena, _seqs_next, _stripes_next
+    with _shared_alloc_lock:
+        if not _shared_locks:
+            _shared_locks.extend(multiprocessing.Lock() for _ in range(SHARED_LOCKS))
+        if count > SEQS_ARENA_SIZE:
+            seqs = memoryview(mmap.mmap(-1, 8 * count)).cast('Q')
+        else:
+            if _seqs_arena is None or _seqs_next + count > SEQS_ARENA_SIZE:
+                _seqs_arena = memoryview(mmap.mmap(-1, 8 * SEQS_ARENA_SIZE)).cast('Q')
+                _seqs_next = 0
+            seqs = _seqs_arena[_seqs_next:_seqs_next + count]
+            _seqs_next += count
+        base = _stripes_next
+        _stripes_next += count
+    return seqs, _shared_locks, base
+
+
+class Subscription:
+    """Change subscription of a DataBank range
+
+    callback(space, address, number, version) is called after a write which change the range,
+    with the changed part of the range and the new version of the space.
+    """
+
+    __slots__ = ('space', 'address', 'number', 'callback')
+
+    def __init__(self, space, address, number, callback):
+        self.space = space
+        self.address = address
+        self.number = number
+        self.callback = callback
+
+    def overlap(self, address, number):
+        """Return (address, number) of the part of a range in the subscription, None if none"""
+        first = max(address, self.address)
+        end = min(address + number, self.address + self.number)
+        if first >= end:
+            return None
+        return first, end - first
+
+
+class DataBank:
+    """ Data class for thread safe access to bits and words space
+
+    Storage backends are pluggable: DenseBits/DenseWords (default) or SparseBits/SparseWords
+    for large and mostly empty address spaces.
+
+    Each space have a version counter (increased by writes) and a list of dirty ranges, and
+    subscribers are notified of changes (report-by-exception): no need to poll for them.
+
+    Spaces are locked by stripes of stripe_bits bits and stripe_words words (see Stripes):
+    reads never block each other, they return a snapshot (not a view on the live storage).
+
+    A shared DataBank (SharedBits/SharedWords storage by default) is shared with processes
+    forked after its creation. Versions, dirty ranges and subscriptions stay by process.
+
+    With a journal (see journal.open_data_bank()) every write is logged, close() the DataBank
+    to checkpoint its storage.
+    """
+
+    def __init__(self, bits=None, words=None, stripe_bits=STRIPE_BITS, stripe_words=STRIPE_WORDS,
+                 shared=False, journal=None):
+        self.shared = shared
+        self.journal = journal
+        if bits is None:
+            bits = SharedBits() if shared else DenseBits()
+        if words is None:
+            words = SharedWords() if shared else DenseWords()
+        # a byte (or page) of storage must be in one stripe: its writers share the stripe lock
+        if stripe_bits % max(8, getattr(bits, 'page_size', 8)):
+            raise ValueError('stripe_bits must be a multiple of 8 (and of the bits page size)')
+        if stripe_words % getattr(words, 'page_size', 1):
+            raise ValueError('stripe_words must be a multiple of the words page size')
+        self.bits = bits
+        self.bits_stripes = Stripes(len(self.bits), stripe_bits, shared)
+        self.words = words
+        self.words_stripes = Stripes(len(self.words), stripe_words, shared)
+        self.bits_version = 0
+        self.words_version = 0
+        # private
+        # guard versions and dirty ranges
+        self._meta_lock = Lock()
+        self._dirty = {'bits': [], 'words': []}
+        # replaced (not updated) on change: writers iterate it without lock
+        self._subscriptions = ()
+        self._subs_lock = Lock()
+
+    def get_bits(self, address, number=1):
+        if (address >= 0) and (address + number <= len(self.bits)):
+            return self.bits_stripes.read(address, number, lambda: self.bits.get(address, number))
+        else:
+            return None
+
+    def set_bits(self, address, bit_list):
+        return self.set_bits_packed(address, pack_bits(bit_list), len(bit_list))
+
+    def get_bits_packed(self, address, number=1):
+        """Return number bits at address as packed bytes (LSB first, as in frames)"""
+        if (address >= 0) and (address + number <= len(self.bits)):
+            return self.bits_stripes.read(address, number, lambda: self.bits.get_packed(address, number))
+        else:
+            return None
+
+    def set_bits_packed(self, address, data, number):
+        """Write number packed bits of data at address"""
+        if not ((address >= 0) and (address + number <= len(self.bits))):
+            return None
+        with self.bits_stripes.write(address, number):
+            # compare old and new bits only if someone watch them
+            watched = self._watched('bits', address, number)
+            if watched:
+                old = self.bits.get_packed(address, number)
+            self.bits.set_packed(address, data, number)
+            if watched and old == self.bits.get_packed(address, number):
+                return True
+            # logged in write order of the range
+            if self.journal is not None:
+                self.journal.append('bits', address, number, data)
+            with self._meta_lock:
+                self.bits_version += 1
+                version = self.bits_version
+                self._mark_dirty('bits', address, number)
+        if watched:
+            self._notify(watched, 'bits', address, number, version)
+        return True
+
+    def get_words(self, address, number=1):
+        """Return a list of number words at address"""
+        if (address >= 0) and (address + number <= len(self.words)):
+            return self.words_stripes.read(address, number, lambda: self.words.get(address, number).tolist())
+        else:
+            return None
+
+    def get_words_bytes(self, address, number=1):
+        """Return number words at address as big endian bytes (as in frames)"""
+        if (address >= 0) and (address + number <= len(self.words)):
+            return self.words_stripes.read(address, number, lambda: _words_bytes(self.words.get(address, number)))
+        else:
+            return None
+
+    def set_words(self, address, word_list):
+        number = len(word_list)
+        if not ((address >= 0) and (address + number <= len(self.words))):
+            return None
+        with self.words_stripes.write(address, number):
+            (watched, version) = self._write_words(address, word_list)
+        if watched:
+            self._notify(watched, 'words', address, number, version)
+        return True
+
+    def write_read_words(self, w_address, word_list, r_address, r_number):
+        """Write word_list at w_address then read r_number words at r_address, atomically
+
+        No other write can happen between them. Return the list of words read, None if a range
+        is out of the space.
+        """
+        number = len(word_list)
+        if not ((w_address >= 0) and (w_address + number <= len(self.words)) and
+                (r_address >= 0) and (r_address + r_number <= len(self.words))):
+            return None
+        with self.words_stripes.write(w_address, number, hold=(r_address, r_number)):
+            (watched, version) = self._write_words(w_address, word_list)
+            words = self.words.get(r_address, r_number).tolist()
+        if watched:
+            self._notify(watched, 'words', w_address, number, version)
+        return words
+
+    def close(self):
+        """Checkpoint and close the journal (if any)"""
+        if self.journal is not None:
+            self.journal.close()
+
+    def version(self, space):
+        """Return the version of space ('bits' or 'words'), increased by every write to it"""
+        return self.bits_version if space == 'bits' else self.words_version
+
+    def pop_dirty(self, space):
+        """Return the (address, number) ranges of space written since the last call"""
+        with self._meta_lock:
+            dirty, self._dirty[space] = self._dirty[space], []
+        return dirty
+
+    def subscribe(self, callback, space='words', address=0, number=None):
+        """Call callback(space, address, number, version) on changes of a range of space
+
+        number default to the end of space. Callbacks run in the thread of the writer, after
+        the write and out of the space lock: they must be short (or hand over the work).
+        Return the Subscription (for unsubscribe()), None if the range is out of space.
+        """
+        if space not in SPACES:
+            raise ValueError('unknown space %r' % space)
+        size = len(self.bits) if space == 'bits' else len(self.words)
+        if number is None:
+            number = size - address
+        if not ((address >= 0) and (number > 0) and (address + number <= size)):
+            return None
+        subscription = Subscription(space, address, number, callback)
+        with self._subs_lock:
+            self._subscriptions += (subscription,)
+        return subscription
+
+    def subscribe_queue(self, space='words', address=0, number=None, loop=None):
+        """Subscribe to changes of a range with an asyncio queue
+
+        (space, address, number, version) items are put in the queue by loop (the running
+        loop if None). Return (queue, subscription), (None, None) if the range is out of space.
+        """
+        loop = asyncio.get_running_loop() if loop is None else loop
+        changes = asyncio.Queue()
+
+        def callback(*change):
+            loop.call_soon_threadsafe(changes.put_nowait, change)
+
+        subscription = self.subscribe(callback, space, address, number)
+        if subscription is None:
+            return None, None
+        return changes, subscription
+
+    def unsubscribe(self, subscription):
+        """Cancel a subscription"""
+        with self._subs_lock:
+            self._subscriptions = tuple(s for s in self._subscriptions if s is not subscription)
+
+    def _write_words(self, address, word_list):
+        """Write words (range locked by caller), return (subscriptions to notify, version)"""
+        number = len(word_list)
+        # compare old and new words only if someone watch them
+        watched = self._watched('words', address, number)
+        if watched:
+            old = list(self.words.get(address, number))
+        self.words.set(address, word_list)
+        if watched and old == list(self.words.get(address, number)):
+            return (), None
+        # logged in write order of the range
+        if self.journal is not None:
+            self.journal.append('words', address, number, word_list)
+        with self._meta_lock:
+            self.words_version += 1
+            version = self.words_version
+            self._mark_dirty('words', address, number)
+        return watched, version
+
+    def _watched(self, space, address, number):
+        """Return subscriptions of space which overlap a range"""
+        return [s for s in self._subscriptions
+                if s.space == space and s.overlap(address, number) is not None]
+
+    def _mark_dirty(self, space, address, number):
+        dirty = self._dirty[space]
+        dirty.append((address, number))
+        # too many ranges: merge them
+        if len(dirty) > MAX_DIRTY:
+            first = min(r[0] for r in dirty)
+            end = max(r[0] + r[1] for r in dirty)
+            self._dirty[space] = [(first, end - first)]
+
+    @staticmethod
+    def _notify(subscriptions, space, address, number, version):
+        for subscription in subscriptions:
+            (s_address, s_number) = subscription.overlap(address, number)
+            subscription.callback(space, s_address, s_number, version)
+
+
+def _shared_mmap(size, path=None):
+    """Return a shared mmap of size bytes, anonymous or of file path (created or extended)"""
+    if path is None:
+        return mmap.mmap(-1, size)
+    with open(path, 'a+b') as f:
+        if os.fstat(f.fileno()).st_size < size:
+            f.truncate(size)
+        return mmap.mmap(f.fileno(), size)
+
+
+def _words_bytes(words):
+    """Return words read from a storage (an array or a view on it) as big endian bytes"""
+    w_array = array('H')
+    w_array.frombytes(words.cast('B') if isinstance(words, memoryview) else words.tobytes())
+    if sys.byteorder == 'little':
+        w_array.byteswap()
+    return w_array.tobytes()
+
+
+def _page_spans(address, number, page_size):
+    """Split an address range in (page index, offset in page, count) items"""
+    spans = []
+    while number > 0:
+        page_i, offset = divmod(address, page_size)
+        count = min(number, page_size - offset)
+        spans.append((page_i, offset, count))
+        address += count
+        number -= count
+    return spans
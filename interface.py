@@ -1,9 +1,30 @@
-import psutil
+from collector import METRICS, METRICS_ADDR, NOT_AVAILABLE, Sampler
+import queue
+from regmap import RegisterMap
+import threading
 from tkinter import *
+import time
 
-discret_input_offset = 10000
-input_reg_offset = 30000
-holding_register_offset = 40000
+# metrics block (see collector.py): written and read back with one request per tick
+METRICS_PLAN = RegisterMap({name: {'table': 'holding_register', 'address': METRICS_ADDR + i}
+                            for i, name in enumerate(METRICS)}).compile()
+# metric -> (label, text format)
+METRICS_LABELS = {
+    'cpu': ('cpu_label', ' {}%'),
+    'battery': ('bat_label', ' {}%'),
+    'plugged': ('plug_label', ' {}'),
+    'disk_c': ('disk_c_label', ' {}%'),
+    'disk_d': ('disk_d_label', ' {}%'),
+    'disk_e': ('disk_e_label', ' {}%'),
+    'mem_c': ('disk_c_mem', ' {} GB'),
+    'mem_d': ('disk_d_mem', ' {} GB'),
+    'mem_e': ('disk_e_mem', ' {} GB'),
+}
+# read the block back after write: labels show what the server hold
+READ_BACK = True
+# acquisition period of the worker (s) and render tick of the UI (ms)
+ACQUIRE_PERIOD = 0.2
+RENDER_TICK = 200
 
 
 class Interface:
@@ -19,6 +40,13 @@ class Interface:
         self.bat_label = None
         self.cpu_label = None
         self.master = master
+        # label name -> text, produced by the acquisition worker
+        self._texts = queue.Queue()
+        # text currently shown by each label
+        self._shown = {}
+        self._stop = threading.Event()
+        self._worker = None
+        self._sampler = None
 
     def init_windows(self):
         self.master.title("Monitorizare resurse SO")
@@ -61,55 +89,58 @@ class Interface:
         digi7.place(x=590, y=265)
         digi8 = Label(self.master, text="Capacity E:", font="arial 24 bold", bg='midnight blue', fg="white")
         digi8.place(x=590, y=345)
-        self.cpu_met()
-        self.battery_met()
-        self.disk_met()
+        # sampling and modbus I/O run in the worker, the UI only render results
+        self._stop.clear()
+        self._worker = threading.Thread(target=self._acquire, daemon=True)
+        self._worker.start()
+        self._render()
         self.master.mainloop()
+        self._stop.set()
+        self._worker.join()
 
-    def cpu_met(self):
-        self.c.write_single_register(100 + input_reg_offset, int(psutil.cpu_percent(interval=1)))
-        self.cpu_label.config(text=' {}%'.format(int(self.c.read_input_registers(100 + input_reg_offset, 1)[0])))
-        self.cpu_label.after(200, self.cpu_met)
+    def _acquire(self):
+        """Acquisition worker: sample metrics, exchange them with the server, queue label texts"""
+        self._sampler = Sampler()
+        while not self._stop.is_set():
+            t_start = time.monotonic()
+            if self.c.is_open() or self.c.open():
+                texts = self._exchange(self.sample())
+                if texts:
+                    self._texts.put(texts)
+            self._stop.wait(max(0.0, ACQUIRE_PERIOD - (time.monotonic() - t_start)))
 
-    def battery_met(self):
-        battery = psutil.sensors_battery().power_plugged
-        self.c.write_single_coil(1, battery)
-        self.c.write_single_register(1 + holding_register_offset, int(psutil.sensors_battery().percent))
-        self.bat_label.config(text=' {}%'.format(int(self.c.read_holding_registers(1 + holding_register_offset, 1)[0])))
-        self.bat_label.after(200, self.battery_met)
-        self.plug_label.config(text=' {}'.format(self.c.read_coils(1, 1)[0]))
-        self.plug_label.after(200, self.battery_met)
+    def _render(self):
+        """UI render tick: show the last texts, only touch labels whose text changed"""
+        texts = {}
+        while True:
+            try:
+                texts.update(self._texts.get_nowait())
+            except queue.Empty:
+                break
+        for name, text in texts.items():
+            if self._shown.get(name) != text:
+                getattr(self, name).config(text=text)
+                self._shown[name] = text
+        self.master.after(RENDER_TICK, self._render)
 
-    def disk_met(self):
-        mem_e = 0
-        mem_d = 0
-        mem_c = 0
-        self.c.write_multiple_registers(10 + holding_register_offset,
-                                        [int(psutil.disk_usage('C:').percent), int(psutil.disk_usage('D:').percent)])
-        self.c.write_single_register(12 + holding_register_offset, int(psutil.disk_usage('E:').percent))
-        aux_e = int(psutil.disk_usage('E:').total)
-        aux_c = int(psutil.disk_usage('C:').total)
-        aux_d = int(psutil.disk_usage('D:').total)
-        for i in range(0, 9):
-            mem_e = aux_e // 10
-            aux_e = mem_e
-            mem_d = aux_d // 10
-            aux_d = mem_d
-            mem_c = aux_c // 10
-            aux_c = mem_c
-        self.c.write_single_register(13 + holding_register_offset, mem_c)
-        self.c.write_single_register(14 + holding_register_offset, mem_d)
-        self.c.write_single_register(15 + holding_register_offset, mem_e)
+    def sample(self):
+        """Return metrics values ordered as METRICS"""
+        return self._sampler.sample()
 
-        self.disk_c_label.config(
-            text=' {}%'.format(int(self.c.read_holding_registers(10 + holding_register_offset, 1)[0])))
-        self.disk_d_label.config(
-            text=' {}%'.format(int(self.c.read_holding_registers(11 + holding_register_offset, 1)[0])))
-        self.disk_e_label.config(
-            text=' {}%'.format(int(self.c.read_holding_registers(12 + holding_register_offset, 1)[0])))
-        self.disk_e_mem.config(
-            text=' {} GB'.format(int(self.c.read_holding_registers(15 + holding_register_offset, 1)[0])))
-        self.disk_c_mem.config(
-            text=' {} GB'.format(int(self.c.read_holding_registers(13 + holding_register_offset, 1)[0])))
-        self.disk_d_mem.config(
-            text=' {} GB'.format(int(self.c.read_holding_registers(14 + holding_register_offset, 1)[0])))
+    def _exchange(self, values):
+        """Write the metrics block and read it back (one transaction), return label texts"""
+        if READ_BACK:
+            regs = self.c.write_read_multiple_registers(METRICS_ADDR, values, METRICS_ADDR, len(METRICS))
+            # on read error keep labels, retry next period
+            if regs is None:
+                return {}
+            metrics = METRICS_PLAN.decode([regs])
+        else:
+            self.c.write_multiple_registers(METRICS_ADDR, values)
+            metrics = dict(zip(METRICS, values))
+        texts = {}
+        for name, value in metrics.items():
+            if value != NOT_AVAILABLE:
+                label, text_format = METRICS_LABELS[name]
+                texts[label] = text_format.format(bool(value) if name == 'plugged' else value)
+        return texts
@@ -0,0 +1,153 @@
+from array import array
+from databank import DataBank, SharedBits, SharedWords, BITS_SPACE_SIZE, WORDS_SPACE_SIZE
+import os
+import struct
+from threading import Event, Lock, Thread
+import zlib
+
+# fsync policy of the journal
+FSYNC_ALWAYS = 'always'  # every write (durable, add a disk sync to each write)
+FSYNC_INTERVAL = 'interval'  # every fsync_interval s by the journal thread
+FSYNC_NEVER = 'never'  # let the OS write it
+# record: space, address, number, then data and CRC32 of head and data
+RECORD_HEAD = struct.Struct('<BII')
+RECORD_CRC = struct.Struct('<I')
+# space -> id in records
+SPACE_IDS = {'bits': 0, 'words': 1}
+
+
+class Journal:
+    """Append-only journal of DataBank writes
+
+    Writes are appended to a buffered file, the journal thread flush it (fsync by policy) and
+    compact it: storage mmaps are written to their files (checkpoint) and the journal restart
+    empty. On open, replay() apply the journal of the last run to the storage.
+    """
+
+    def __init__(self, path, fsync=FSYNC_INTERVAL, fsync_interval=1.0, compact_interval=60.0,
+                 max_size=64 * 1024 * 1024):
+        if fsync not in (FSYNC_ALWAYS, FSYNC_INTERVAL, FSYNC_NEVER):
+            raise ValueError('unknown fsync policy %r' % fsync)
+        # public
+        self.path = path
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.compact_interval = compact_interval
+        self.max_size = max_size  # compact before compact_interval over this size
+        # private
+        self._storages = []
+        self._file = None
+        self._lock = Lock()  # guard _file
+        self._compact_lock = Lock()
+        self._stop = Event()
+        self._thread = None
+
+    def open(self, bits, words):
+        """Replay the journal on bits and words storage, checkpoint and start the journal thread"""
+        self._storages = [bits, words]
+        self.replay(bits, words)
+        self._file = open(self.path, 'ab')
+        self.compact()
+        self._stop.clear()
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def replay(self, bits, words):
+        """Apply records of the journal (and of an interrupted compaction) to the storage
+
+        Return the number of records applied, a torn record end the replay of a file.
+        """
+        applied = 0
+        for path in (self.path + '.old', self.path):
+            if not os.path.exists(path):
+                continue
+            with open(path, 'rb') as f:
+                data = f.read()
+            pos = 0
+            while pos + RECORD_HEAD.size <= len(data):
+                (space_id, address, number) = RECORD_HEAD.unpack_from(data, pos)
+                size = (number + 7) // 8 if space_id == SPACE_IDS['bits'] else 2 * number
+                end = pos + RECORD_HEAD.size + size
+                if end + RECORD_CRC.size > len(data):
+                    break
+                if RECORD_CRC.unpack_from(data, end)[0] != zlib.crc32(data[pos:end]):
+                    break
+                payload = data[pos + RECORD_HEAD.size:end]
+                if space_id == SPACE_IDS['bits']:
+                    bits.set_packed(address, payload, number)
+                else:
+                    words.set(address, array('H', payload))
+                pos = end + RECORD_CRC.size
+                applied += 1
+        return applied
+
+    def append(self, space, address, number, data):
+        """Log a write (data: packed bits or words)"""
+        if space == 'words':
+            data = data.tobytes() if isinstance(data, array) else array('H', data).tobytes()
+        else:
+            data = bytes(data[:(number + 7) // 8])
+        record = RECORD_HEAD.pack(SPACE_IDS[space], address, number) + data
+        record += RECORD_CRC.pack(zlib.crc32(record))
+        with self._lock:
+            self._file.write(record)
+            if self.fsync == FSYNC_ALWAYS:
+                self._file.flush()
+                os.fsync(self._file.fileno())
+
+    def compact(self):
+        """Checkpoint storage to its files and restart an empty journal"""
+        with self._compact_lock:
+            with self._lock:
+                self._file.close()
+                # every write logged in it is already in the storage
+                os.replace(self.path, self.path + '.old')
+                self._file = open(self.path, 'ab')
+            for storage in self._storages:
+                storage.flush()
+            os.remove(self.path + '.old')
+
+    def close(self):
+        """Stop the journal thread, checkpoint and close"""
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        self.compact()
+        with self._lock:
+            self._file.close()
+
+    def _run(self):
+        """Journal thread: flush (and fsync) the journal, compact it"""
+        last_compact = 0.0
+        while not self._stop.wait(self.fsync_interval):
+            with self._lock:
+                self._file.flush()
+                fileno = self._file.fileno()
+                size = self._file.tell()
+            if self.fsync == FSYNC_INTERVAL:
+                try:
+                    os.fsync(fileno)
+                except OSError:
+                    # file replaced by a compaction meanwhile
+                    pass
+            last_compact += self.fsync_interval
+            if last_compact >= self.compact_interval or size >= self.max_size:
+                self.compact()
+                last_compact = 0.0
+
+
+def open_data_bank(path, bits_size=BITS_SPACE_SIZE, words_size=WORDS_SPACE_SIZE, **journal_kwargs):
+    """Open (or create) a persistent DataBank in directory path
+
+    Bits and words are memory-mapped from bits.dat and words.dat, writes are logged in
+    journal.log (keywords args are passed to Journal). Close the DataBank to stop its journal.
+    A persistent DataBank is for a single process server.
+    """
+    os.makedirs(path, exist_ok=True)
+    bits = SharedBits(bits_size, os.path.join(path, 'bits.dat'))
+    words = SharedWords(words_size, os.path.join(path, 'words.dat'))
+    journal = Journal(os.path.join(path, 'journal.log'), **journal_kwargs)
+    journal.open(bits, words)
+    return DataBank(bits, words, journal=journal)
@@ -0,0 +1,380 @@
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+import time
+
+# histograms sub buckets: 2**SUB_BITS by power of 2 (relative error under 1/2**SUB_BITS)
+SUB_BITS = 5
+SUB_COUNT = 1 << SUB_BITS
+# exported quantiles of latency summaries
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+# default port of the Prometheus exporter
+METRICS_PORT = 9502
+
+
+class Histogram:
+    """Log-linear histogram of int values (HDR style), sparse: only used buckets are stored"""
+
+    __slots__ = ('counts', 'count', 'total')
+
+    def __init__(self):
+        self.counts = {}  # bucket index -> count
+        self.count = 0
+        self.total = 0
+
+    def record(self, value):
+        """Add a value (int >= 0)"""
+        if value < 2 * SUB_COUNT:
+            index = value
+        else:
+            shift = value.bit_length() - SUB_BITS - 1
+            index = shift * SUB_COUNT + (value >> shift)
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+
+    def merge(self, other):
+        """Add values of another histogram"""
+        for index, count in dict(other.counts).items():
+            self.counts[index] = self.counts.get(index, 0) + count
+        self.count += other.count
+        self.total += other.total
+
+    def percentile(self, q):
+        """Return the q (0.0 to 1.0) percentile (highest value of its bucket), 0 if empty"""
+        if not self.count:
+            return 0
+        rank = max(1, q * self.count)
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                return bucket_value(index)
+        return bucket_value(max(self.counts))
+
+
+def bucket_value(index):
+    """Return the highest value of a histogram bucket"""
+    if index < 2 * SUB_COUNT:
+        return index
+    shift, sub = divmod(index - SUB_COUNT, SUB_COUNT)
+    return ((SUB_COUNT + sub + 1) << shift) - 1
+
+
+class ConnectionStats:
+    """Stats of a connection, only updated by the thread (or task) which serve it"""
+
+    __slots__ = ('peer', 'opened', 'requests', 'bytes_in', 'bytes_out', 'latency', 'exceptions')
+
+    def __init__(self, peer=None):
+        self.peer = peer
+        self.opened = time.time()
+        self.requests = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.latency = {}  # function code -> Histogram of handling time (us)
+        self.exceptions = {}  # (function code, except code) -> count
+
+    def record(self, fc, micros, bytes_in, bytes_out, exp_code=None):
+        self.requests += 1
+        self.bytes_in += bytes_in
+        self.bytes_out += bytes_out
+        histogram = self.latency.get(fc)
+        if histogram is None:
+            histogram = self.latency[fc] = Histogram()
+        histogram.record(micros)
+        if exp_code is not None:
+            key = (fc, exp_code)
+            self.exceptions[key] = self.exceptions.get(key, 0) + 1
+
+    def merge(self, other):
+        """Add stats of another connection"""
+        self.requests += other.requests
+        self.bytes_in += other.bytes_in
+        self.bytes_out += other.bytes_out
+        for fc, histogram in dict(other.latency).items():
+            self.latency.setdefault(fc, Histogram()).merge(histogram)
+        for key, count in dict(other.exceptions).items():
+            self.exceptions[key] = self.exceptions.get(key, 0) + count
+
+
+class ServerMetrics:
+    """Instrumentation of a ModbusServer (pass it as metrics arg)
+
+    Requests are counted in stats of their connection without lock, reads merge them:
+    cheap enough to stay on. Requests handled in slow_threshold s or more are kept in
+    slow_log as (time, peer, unit ID, function code, duration, except code) items.
+    """
+
+    def __init__(self, slow_threshold=0.1, slow_log_size=1000):
+        # public
+        self.slow_threshold = slow_threshold
+        self.slow_log = deque(maxlen=slow_log_size)
+        self.total_connections = 0
+        # private
+        self._live = set()
+        self._closed = ConnectionStats()  # stats of closed connections
+        self._lock = Lock()
+        self._exporter = None
+
+    def open_connection(self, peer):
+        """Return the stats of a new connection"""
+        stats = ConnectionStats(peer)
+        with self._lock:
+            self._live.add(stats)
+            self.total_connections += 1
+        return stats
+
+    def close_connection(self, stats):
+        with self._lock:
+            self._live.discard(stats)
+            self._closed.merge(stats)
+
+    def record(self, stats, unit_id, fc, duration, bytes_in, bytes_out, exp_code=None):
+        """Account a request of a connection (duration in s)"""
+        stats.record(fc, int(duration * 1e6), bytes_in, bytes_out, exp_code)
+        if duration >= self.slow_threshold:
+            self.slow_log.append((time.time(), stats.peer, unit_id, fc, duration, exp_code))
+
+    @property
+    def active_connections(self):
+        return len(self._live)
+
+    def connections(self):
+        """Return stats of active connections"""
+        with self._lock:
+            return list(self._live)
+
+    def totals(self):
+        """Return stats of all connections merged"""
+        totals = ConnectionStats()
+        with self._lock:
+            totals.merge(self._closed)
+            for stats in self._live:
+                totals.merge(stats)
+        return totals
+
+    def snapshot(self):
+        """Return metrics as a dict"""
+        totals = self.totals()
+        return {
+            'active_connections': self.active_connections,
+            'total_connections': self.total_connections,
+            'requests': totals.requests,
+            'bytes_in': totals.bytes_in,
+            'bytes_out': totals.bytes_out,
+            'functions': {fc: {'requests': h.count,
+                               'latency_us': {q: h.percentile(q) for q in QUANTILES}}
+                          for fc, h in sorted(totals.latency.items())},
+            'exceptions': dict(totals.exceptions),
+            'connections': [{'peer': s.peer, 'opened': s.opened, 'requests': s.requests,
+                             'bytes_in': s.bytes_in, 'bytes_out': s.bytes_out}
+                            for s in self.connections()],
+            'slow_requests': len(self.slow_log),
+        }
+
+    def prometheus(self):
+        """Return metrics in Prometheus text exposition format"""
+        totals = self.totals()
+        lines = ['# HELP modbus_connections Active client connections',
+                 '# TYPE modbus_connections gauge',
+                 'modbus_connections %d' % self.active_connections,
+                 '# TYPE modbus_connections_total counter',
+                 'modbus_connections_total %d' % self.total_connections,
+                 '# TYPE modbus_received_bytes_total counter',
+                 'modbus_received_bytes_total %d' % totals.bytes_in,
+                 '# TYPE modbus_sent_bytes_total counter',
+                 'modbus_sent_bytes_total %d' % totals.bytes_out,
+                 '# HELP modbus_requests_total Requests by function code',
+                 '# TYPE modbus_requests_total counter']
+        for fc, h in sorted(totals.latency.items()):
+            lines.append('modbus_requests_total{fc="%d"} %d' % (fc, h.count))
+        lines += ['# HELP modbus_exceptions_total Except responses by function and except code',
+                  '# TYPE modbus_exceptions_total counter']
+        for (fc, code), count in sorted(totals.exceptions.items()):
+            lines.append('modbus_exceptions_total{fc="%d",code="%d"} %d' % (fc, code, count))
+        lines += ['# HELP modbus_request_duration_seconds Request handling time',
+                  '# TYPE modbus_request_duration_seconds summary']
+        for fc, h in sorted(totals.latency.items()):
+            for q in QUANTILES:
+                lines.append('modbus_request_duration_seconds{fc="%d",quantile="%s"} %.6f' %
+                             (fc, q, h.percentile(q) / 1e6))
+            lines.append('modbus_request_duration_seconds_sum{fc="%d"} %.6f' % (fc, h.total / 1e6))
+            lines.append('modbus_request_duration_seconds_count{fc="%d"} %d' % (fc, h.count))
+        lines += ['# TYPE modbus_slow_requests gauge',
+                  'modbus_slow_requests %d' % len(self.slow_log)]
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port=METRICS_PORT, host='127.0.0.1'):
+        """Serve prometheus() on http://host:port/metrics (in a daemon thread)"""
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._exporter = ThreadingHTTPServer((host, port), MetricsHandler)
+        Thread(target=self._exporter.serve_forever, daemon=True).start()
+        return self._exporter
+
+    def stop(self):
+        """Stop the exporter"""
+        if self._exporter is not None:
+            self._exporter.shutdown()
+            self._exporter.server_close()
+            self._exporter = None
+
+
+class CallTrace:
+    """Timing of a ModbusClient call: perf_counter() timestamps of its phases
+
+    start (build of the request), serialized (frame ready), sent, received (response
+    frame read) and done (response decoded). A phase not reached stay None.
+    """
+
+    __slots__ = ('name', 'fc', 'start', 'serialized', 'sent', 'received', 'done', 'cached', 'ok',
+                 'exp_code')
+
+    def __init__(self, name, fc, start):
+        self.name = name
+        self.fc = fc
+        self.start = start
+        self.serialized = None
+        self.sent = None
+        self.received = None
+        self.done = None
+        self.cached = False  # served by the client cache
+        self.ok = False
+        self.exp_code = None  # except code of an except response
+
+    @property
+    def serialize(self):
+        """Request build and framing time (s)"""
+        return _elapsed(self.start, self.serialized)
+
+    @property
+    def send(self):
+        return _elapsed(self.serialized, self.sent)
+
+    @property
+    def wait(self):
+        """Time from request sent to response received: network and device (s)"""
+        return _elapsed(self.sent, self.received)
+
+    @property
+    def decode(self):
+        return _elapsed(self.received, self.done)
+
+    @property
+    def total(self):
+        return _elapsed(self.start, self.done)
+
+
+def _elapsed(t_from, t_to):
+    if t_from is None or t_to is None:
+        return None
+    return t_to - t_from
+
+
+class Tracer:
+    """Hooks of a ModbusClient (pass it as tracer arg), override the ones you need"""
+
+    def on_connect(self, host, port, duration, ok):
+        """Called after a connect attempt (duration in s)"""
+
+    def on_call(self, trace):
+        """Called at end of a call with its CallTrace"""
+
+
+# phases of a CallTrace
+CALL_PHASES = ('serialize', 'send', 'wait', 'decode', 'total')
+
+
+class FunctionStats:
+    """Aggregated calls of a client function"""
+
+    __slots__ = ('calls', 'errors', 'cached', 'exceptions', 'phases')
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0  # calls without result (except responses included)
+        self.cached = 0
+        self.exceptions = {}  # except code -> count
+        self.phases = {phase: Histogram() for phase in CALL_PHASES}  # phase -> Histogram (us)
+
+
+class ClientMetrics(Tracer):
+    """Tracer which aggregate calls of one or many clients
+
+    Count calls, errors and except responses by function and keep a histogram of each
+    phase duration: a slow wait is the network or the device, a slow decode is us.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.connects = 0
+            self.connect_errors = 0
+            self.connect_time = Histogram()  # us
+            self.functions = {}  # function name -> FunctionStats
+
+    def on_connect(self, host, port, duration, ok):
+        with self._lock:
+            self.connects += 1
+            if not ok:
+                self.connect_errors += 1
+            self.connect_time.record(int(duration * 1e6))
+
+    def on_call(self, trace):
+        with self._lock:
+            stats = self.functions.get(trace.name)
+            if stats is None:
+                stats = self.functions[trace.name] = FunctionStats()
+            stats.calls += 1
+            if not trace.ok:
+                stats.errors += 1
+            if trace.exp_code is not None:
+                stats.exceptions[trace.exp_code] = stats.exceptions.get(trace.exp_code, 0) + 1
+            if trace.cached:
+                stats.cached += 1
+                return
+            for phase in CALL_PHASES:
+                duration = getattr(trace, phase)
+                if duration is not None:
+                    stats.phases[phase].record(int(duration * 1e6))
+
+    def snapshot(self):
+        """Return metrics as a dict (phase durations in us)"""
+        with self._lock:
+            return {
+                'connects': self.connects,
+                'connect_errors': self.connect_errors,
+                'connect_us': _summary(self.connect_time),
+                'functions': {name: {'calls': s.calls, 'errors': s.errors, 'cached': s.cached,
+                                     'exceptions': dict(s.exceptions),
+                                     'phases_us': {phase: _summary(h) for phase, h in s.phases.items()}}
+                              for name, s in sorted(self.functions.items())},
+            }
+
+
+def _summary(histogram):
+    """Return count, mean and quantiles of a histogram as a dict"""
+    summary = {'count': histogram.count,
+               'mean': histogram.total / histogram.count if histogram.count else 0.0}
+    for q in QUANTILES:
+        summary[q] = histogram.percentile(q)
+    return summary
@@ -0,0 +1,331 @@
+import constants as const
+from codec import BitList, REGS_LIST, decode_regs, pack_bits, unpack_bits
+from collections import namedtuple
+from functools import partial
+import struct
+
+# precompiled frame codecs
+MBAP_HEAD = struct.Struct('>HHHB')
+MBAP_FC = struct.Struct('>HHHBB')
+ADDR_COUNT = struct.Struct('>HH')
+ADDR_COUNT_BYTES = struct.Struct('>HHB')
+COIL_VALUE = struct.Struct('>HBB')
+READ_WRITE_HEAD = struct.Struct('>HHHHB')
+# precompiled codecs of whole request bodies by number of registers (filled on first use)
+WRITE_REGS_CODECS = {}  # address, number, byte count and registers
+READ_WRITE_REGS_CODECS = {}  # read address and number, write address, number, byte count and registers
+SPACE_ADDR_COUNT = struct.Struct('>BHH')
+
+# subscribe spaces: name -> id in frames
+SPACE_IDS = {'bits': const.SPACE_BITS, 'words': const.SPACE_WORDS}
+
+# a request ready to send: function code, data following it and decoder of the response data
+Request = namedtuple('Request', 'fc body decode')
+
+
+class PduError(Exception):
+    """Invalid request parameter or invalid response frame"""
+
+
+def mbap_frame(tr_id, unit_id, fc, body):
+    """Build a modbus/TCP frame: MBAP header, function code and body"""
+    return MBAP_FC.pack(tr_id, 0, len(body) + 2, unit_id, fc) + body
+
+
+def mbap_frame_into(buffer, tr_id, unit_id, fc, body):
+    """Build a modbus/TCP frame at start of buffer (a bytearray), return its size"""
+    size = MBAP_FC.size + len(body)
+    # buffer don't grow: it can have exported views
+    if size > len(buffer):
+        raise PduError('mbap_frame_into(): frame size (%d) over buffer size (%d)' % (size, len(buffer)))
+    MBAP_FC.pack_into(buffer, 0, tr_id, 0, len(body) + 2, unit_id, fc)
+    buffer[MBAP_FC.size:size] = body
+    return size
+
+
+def decode_mbap(rx_head, unit_id, offset=0):
+    """Return (transaction ID, length) of a response MBAP header (at offset of rx_head), None if it
+    is inconsistent"""
+    (rx_hd_tr_id, rx_hd_pr_id,
+     rx_hd_length, rx_hd_unit_id) = MBAP_HEAD.unpack_from(rx_head, offset)
+    if not ((rx_hd_pr_id == 0) and
+            (2 < rx_hd_length < 256) and
+            (rx_hd_unit_id == unit_id)):
+        return None
+    return rx_hd_tr_id, rx_hd_length
+
+
+def except_code(rx_pdu):
+    """Return the except code of a response PDU, None if it isn't an except"""
+    if rx_pdu[0] > 0x80:
+        return rx_pdu[1]
+    return None
+
+
+def read_coils(bit_addr, bit_nb=1, packed=False):
+    """Build a READ_COILS (0x01) request"""
+    return _read_bits('read_coils', const.READ_COILS, bit_addr, bit_nb, packed)
+
+
+def read_discrete_inputs(bit_addr, bit_nb=1, packed=False):
+    """Build a READ_DISCRETE_INPUTS (0x02) request"""
+    return _read_bits('read_discrete_inputs', const.READ_DISCRETE_INPUTS, bit_addr, bit_nb, packed)
+
+
+def read_holding_registers(reg_addr, reg_nb=1, regs_as=REGS_LIST):
+    """Build a READ_HOLDING_REGISTERS (0x03) request"""
+    return _read_regs('read_holding_registers', const.READ_HOLDING_REGISTERS, reg_addr, reg_nb, regs_as)
+
+
+def read_input_registers(reg_addr, reg_nb=1, regs_as=REGS_LIST):
+    """Build a READ_INPUT_REGISTERS (0x04) request"""
+    return _read_regs('read_input_registers', const.READ_INPUT_REGISTERS, reg_addr, reg_nb, regs_as)
+
+
+def write_single_coil(bit_addr, bit_value):
+    """Build a WRITE_SINGLE_COIL (0x05) request"""
+    # check params
+    if not (0 <= int(bit_addr) <= 65535):
+        raise PduError('write_single_coil(): bit_addr out of range')
+    # build frame
+    bit_value = 0xFF if bit_value else 0x00
+    return Request(const.WRITE_SINGLE_COIL, COIL_VALUE.pack(bit_addr, bit_value, 0),
+                   partial(_decode_write_single_coil, bit_addr, bit_value))
+
+
+def write_single_register(reg_addr, reg_value):
+    """Build a WRITE_SINGLE_REGISTER (0x06) request"""
+    # check params
+    if not (0 <= int(reg_addr) <= 65535):
+        raise PduError('write_single_register(): reg_addr out of range')
+    if not (0 <= int(reg_value) <= 65535):
+        raise PduError('write_single_register(): reg_value out of range')
+    return Request(const.WRITE_SINGLE_REGISTER, ADDR_COUNT.pack(reg_addr, reg_value),
+                   partial(_decode_write_single_register, reg_addr, reg_value))
+
+
+def write_multiple_coils(bits_addr, bits_value):
+    """Build a WRITE_MULTIPLE_COILS (0x0F) request"""
+    # number of bits to write
+    bits_nb = len(bits_value)
+    # check params
+    if not (0x0000 <= int(bits_addr) <= 0xffff):
+        raise PduError('write_multiple_coils(): bits_addr out of range')
+    if not (0x0001 <= int(bits_nb) <= 0x07b0):
+        raise PduError('write_multiple_coils(): number of bits out of range')
+    if (int(bits_addr) + int(bits_nb)) > 0x10000:
+        raise PduError('write_multiple_coils(): write after ad 65535')
+    # format bits value string
+    bits_val_str = pack_bits(bits_value)
+    # format modbus frame body
+    body = ADDR_COUNT_BYTES.pack(bits_addr, bits_nb, len(bits_val_str)) + bits_val_str
+    return Request(const.WRITE_MULTIPLE_COILS, body,
+                   partial(_decode_write_multiple, 'write_multiple_coils', bits_addr))
+
+
+def write_multiple_registers(regs_addr, regs_value):
+    """Build a WRITE_MULTIPLE_REGISTERS (0x10) request"""
+    # number of registers to write
+    regs_nb = len(regs_value)
+    # check params
+    if not (0x0000 <= int(regs_addr) <= 0xffff):
+        raise PduError('write_multiple_registers(): regs_addr out of range')
+    if not (0x0001 <= int(regs_nb) <= 0x007b):
+        raise PduError('write_multiple_registers(): number of registers out of range')
+    if (int(regs_addr) + int(regs_nb)) > 0x10000:
+        raise PduError('write_multiple_registers(): write after ad 65535')
+    # format modbus frame body (head and registers in one pack)
+    codec = _regs_codec(WRITE_REGS_CODECS, '>HHB%dH', regs_nb)
+    body = _pack_regs('write_multiple_registers', codec, (regs_addr, regs_nb, 2 * regs_nb), regs_value)
+    return Request(const.WRITE_MULTIPLE_REGISTERS, body,
+                   partial(_decode_write_multiple, 'write_multiple_registers', regs_addr))
+
+
+def write_read_multiple_registers(write_addr, write_values, read_addr, read_nb=1, regs_as=REGS_LIST):
+    """Build a READ_WRITE_MULTIPLE_REGISTERS (0x17) request (the server write before it read)"""
+    # number of registers to write
+    write_nb = len(write_values)
+    # check params
+    if not (0x0000 <= int(write_addr) <= 0xffff):
+        raise PduError('write_read_multiple_registers(): write_addr out of range')
+    if not (0x0001 <= int(write_nb) <= 0x0079):
+        raise PduError('write_read_multiple_registers(): number of registers to write out of range')
+    if (int(write_addr) + int(write_nb)) > 0x10000:
+        raise PduError('write_read_multiple_registers(): write after ad 65535')
+    if not (0x0000 <= int(read_addr) <= 0xffff):
+        raise PduError('write_read_multiple_registers(): read_addr out of range')
+    if not (0x0001 <= int(read_nb) <= 0x007d):
+        raise PduError('write_read_multiple_registers(): read_nb out of range')
+    if (int(read_addr) + int(read_nb)) > 0x10000:
+        raise PduError('write_read_multiple_registers(): read after ad 65535')
+    # format modbus frame body (read range first)
+    codec = _regs_codec(READ_WRITE_REGS_CODECS, '>HHHHB%dH', write_nb)
+    body = _pack_regs('write_read_multiple_registers', codec,
+                      (read_addr, read_nb, write_addr, write_nb, 2 * write_nb), write_values)
+    return Request(const.READ_WRITE_MULTIPLE_REGISTERS, body,
+                   partial(_decode_regs, 'write_read_multiple_registers', read_nb, regs_as))
+
+
+def subscribe(space, address, number):
+    """Build a SUBSCRIBE (custom 0x41) request
+
+    Ask the server to push changes of number items of space ('bits' or 'words') at address,
+    a number of 0 cancel the subscriptions to space.
+    """
+    # check params
+    if space not in SPACE_IDS:
+        raise PduError('subscribe(): unknown space')
+    if not (0 <= int(address) <= 0xffff):
+        raise PduError('subscribe(): address out of range')
+    if not (0 <= int(number) <= 0xffff):
+        raise PduError('subscribe(): number out of range')
+    body = SPACE_ADDR_COUNT.pack(SPACE_IDS[space], address, number)
+    return Request(const.SUBSCRIBE, body, partial(_decode_subscribe, body))
+
+
+def decode_push(rx_pdu):
+    """Return (space, address, values) of a pushed change PDU"""
+    if len(rx_pdu) < 1 + SPACE_ADDR_COUNT.size:
+        raise PduError('push frame under min size')
+    (space_id, address, number) = SPACE_ADDR_COUNT.unpack_from(rx_pdu, 1)
+    data = rx_pdu[1 + SPACE_ADDR_COUNT.size:]
+    if space_id == const.SPACE_BITS and len(data) == (number + 7) // 8:
+        return 'bits', address, unpack_bits(data, number)
+    if space_id == const.SPACE_WORDS and len(data) == 2 * number:
+        return 'words', address, list(struct.unpack('>%dH' % number, data))
+    raise PduError('push frame format error')
+
+
+# client functions name -> request builder
+FUNCTIONS = {
+    'read_coils': read_coils,
+    'read_discrete_inputs': read_discrete_inputs,
+    'read_holding_registers': read_holding_registers,
+    'read_input_registers': read_input_registers,
+    'write_single_coil': write_single_coil,
+    'write_single_register': write_single_register,
+    'write_multiple_coils': write_multiple_coils,
+    'write_multiple_registers': write_multiple_registers,
+    'write_read_multiple_registers': write_read_multiple_registers,
+}
+# functions with a packed bits option
+BITS_READ_FUNCTIONS = ('read_coils', 'read_discrete_inputs')
+# functions with a registers format option (see codec.REGS_LIST)
+REGS_READ_FUNCTIONS = ('read_holding_registers', 'read_input_registers', 'write_read_multiple_registers')
+
+
+def _regs_codec(codecs, fmt, regs_nb):
+    """Return the Struct of fmt for regs_nb registers, compiled on first use"""
+    codec = codecs.get(regs_nb)
+    if codec is None:
+        codec = codecs[regs_nb] = struct.Struct(fmt % regs_nb)
+    return codec
+
+
+def _pack_regs(name, codec, head, regs_value):
+    """Pack head fields and registers values with codec"""
+    try:
+        return codec.pack(*head, *regs_value)
+    except struct.error:
+        pass
+    # not int values (ex: float): convert them
+    try:
+        return codec.pack(*head, *map(int, regs_value))
+    except struct.error:
+        raise PduError(name + '(): register value out of range')
+
+
+def _read_bits(name, fc, bit_addr, bit_nb, packed):
+    # check params
+    if not (0 <= int(bit_addr) <= 65535):
+        raise PduError(name + '(): bit_addr out of range')
+    if not (1 <= int(bit_nb) <= 2000):
+        raise PduError(name + '(): bit_nb out of range')
+    if (int(bit_addr) + int(bit_nb)) > 65536:
+        raise PduError(name + '(): read after ad 65535')
+    return Request(fc, ADDR_COUNT.pack(bit_addr, bit_nb), partial(_decode_bits, name, bit_nb, packed))
+
+
+def _read_regs(name, fc, reg_addr, reg_nb, regs_as):
+    # check params
+    if not (0 <= int(reg_addr) <= 65535):
+        raise PduError(name + '(): reg_addr out of range')
+    if not (1 <= int(reg_nb) <= 125):
+        raise PduError(name + '(): reg_nb out of range')
+    if (int(reg_addr) + int(reg_nb)) > 65536:
+        raise PduError(name + '(): read after ad 65535')
+    return Request(fc, ADDR_COUNT.pack(reg_addr, reg_nb), partial(_decode_regs, name, reg_nb, regs_as))
+
+
+def _decode_bits(name, bit_nb, packed, f_body):
+    # check min frame body size
+    if len(f_body) < 2:
+        raise PduError(name + '(): rx frame under min size')
+    # extract field "byte count"
+    rx_byte_count = f_body[0]
+    # frame with bits value
+    f_bits = f_body[1:]
+    # check rx_byte_count: match nb of bits request and check buffer size
+    if not ((rx_byte_count >= (bit_nb + 7) // 8) and
+            (rx_byte_count == len(f_bits))):
+        raise PduError(name + '(): rx byte count mismatch')
+    # return bits as a packed BitList or a bits list
+    if packed:
+        return BitList(f_bits, bit_nb)
+    return unpack_bits(f_bits, bit_nb)
+
+
+def _decode_regs(name, reg_nb, regs_as, f_body):
+    # check min frame body size
+    if len(f_body) < 2:
+        raise PduError(name + '(): rx frame under min size')
+    # extract field "byte count"
+    rx_byte_count = f_body[0]
+    # frame with regs value
+    f_regs = f_body[1:]
+    # check rx_byte_count: buffer size must be consistent and have at least the requested number of registers
+    if not ((rx_byte_count >= 2 * reg_nb) and
+            (rx_byte_count == len(f_regs))):
+        raise PduError(name + '(): rx byte count mismatch')
+    # return registers as a list, an array or a numpy array
+    return decode_regs(f_regs[:2 * reg_nb], regs_as)
+
+
+def _decode_write_single_coil(bit_addr, bit_value, f_body):
+    # check fix frame size
+    if len(f_body) != 4:
+        raise PduError('write_single_coil(): rx frame size error')
+    # register extract
+    (rx_bit_addr, rx_bit_value, rx_padding) = COIL_VALUE.unpack(f_body)
+    # check bit write
+    is_ok = (rx_bit_addr == bit_addr) and (rx_bit_value == bit_value)
+    return True if is_ok else None
+
+
+def _decode_write_single_register(reg_addr, reg_value, f_body):
+    # check fix frame size
+    if len(f_body) != 4:
+        raise PduError('write_single_register(): rx frame size error')
+    # register extract
+    rx_reg_addr, rx_reg_value = ADDR_COUNT.unpack(f_body)
+    # check register write
+    is_ok = (rx_reg_addr == reg_addr) and (rx_reg_value == reg_value)
+    return True if is_ok else None
+
+
+def _decode_subscribe(body, f_body):
+    # response echo the request
+    if f_body != body:
+        raise PduError('subscribe(): rx frame error')
+    return True
+
+
+def _decode_write_multiple(name, addr, f_body):
+    # check fix frame size
+    if len(f_body) != 4:
+        raise PduError(name + '(): rx frame size error')
+    # register extract
+    (rx_addr, rx_nb) = ADDR_COUNT.unpack(f_body)
+    # check write
+    is_ok = (rx_addr == addr)
+    return True if is_ok else None
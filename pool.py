@@ -0,0 +1,197 @@
+import constants as const
+from client import ModbusClient, RANGE_FUNCTIONS, is_host, split_range
+from codec import join_results
+from contextlib import contextmanager
+from threading import Condition, Lock, Thread
+import time
+
+
+class ModbusClientPool:
+    """Thread safe pool of ModbusClient connections to one modbus server
+
+    At most size connections are opened to the server, threads check out a client with
+    acquire() (or the connection() context manager) and give it back with release().
+    A client is never shared by two threads at the same time. An idle client is checked on
+    check out (is_alive(): no request, detect a connection closed by the server) and
+    reconnected if it's down.
+    """
+
+    def __init__(self, host='localhost', port=const.MODBUS_PORT, size=4, timeout=30.0,
+                 probe=None, probe_interval=30.0):
+        """Constructor
+
+        timeout is the socket timeout of clients. probe(client) is an optional (opt-in) deeper
+        health check, return False if the server don't answer (ex: a read request), it's called
+        on check out of a client idle for more than probe_interval s. A client which fail it is
+        reconnected.
+        """
+        # clients are created later: check host now
+        if not is_host(host):
+            raise ValueError('host must be an IPv4/IPv6 address or a hostname')
+        # public
+        self.host = host
+        self.port = port
+        self.size = size
+        self.timeout = timeout
+        self.probe = probe
+        self.probe_interval = probe_interval
+        # private
+        self._cond = Condition()
+        self._idle = []  # (client, release time), last released at end
+        self._created = 0
+        self._closed = False
+
+    def acquire(self, timeout=None):
+        """Check out a connected client
+
+        Wait up to timeout s (forever if None) for a free client.
+        Return None on timeout, connect error or if pool is closed.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while True:
+                if self._closed:
+                    return None
+                # reuse the most recently used client: its socket is the most likely alive
+                if self._idle:
+                    client, released_at = self._idle.pop()
+                    break
+                if self._created < self.size:
+                    self._created += 1
+                    client, released_at = None, None
+                    break
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if (remaining is not None) and (remaining <= 0):
+                    return None
+                self._cond.wait(remaining)
+        # connect and check outside of the lock
+        if client is None:
+            client = ModbusClient(host=self.host, port=self.port, timeout=self.timeout)
+        elif client.is_open() and not client.is_alive():
+            # closed by the server while idle
+            client.close()
+        elif client.is_open() and self.probe and (time.monotonic() - released_at > self.probe_interval):
+            if not self.probe(client):
+                client.close()
+        if not (client.is_open() or client.open()):
+            self.release(client)
+            return None
+        return client
+
+    def release(self, client):
+        """Give back a client to the pool"""
+        # no response of a pipelined request should be left to the next user
+        client.flush()
+        with self._cond:
+            if self._closed:
+                client.close()
+                self._created -= 1
+            else:
+                self._idle.append((client, time.monotonic()))
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self, timeout=None):
+        """Context manager that check out a client (None on error) and give it back"""
+        client = self.acquire(timeout)
+        try:
+            yield client
+        finally:
+            if client is not None:
+                self.release(client)
+
+    def read_range(self, name, address, number, timeout=None):
+        """Run a range read of ModbusClient (ex: 'read_holding_range') over the pool connections
+
+        The range is split in one part by connection (each pipelined by its client), parts
+        run in parallel. Return one joined result, None on error.
+        """
+        parts = self._split(name, address, number)
+        return join_results(self._run_parts([(name, part_addr, part_nb) for part_addr, part_nb in parts],
+                                            timeout))
+
+    def write_range(self, name, address, values, timeout=None):
+        """Run a range write of ModbusClient (ex: 'write_registers_range') over the pool connections
+
+        Parts run in parallel: no write order between them. Return True, None on error.
+        """
+        parts = self._split(name, address, len(values))
+        results = self._run_parts([(name, part_addr, values[part_addr - address:part_addr - address + part_nb])
+                                   for part_addr, part_nb in parts], timeout)
+        return True if all(results) else None
+
+    def _split(self, name, address, number):
+        """Split a range in one part of whole chunks by connection"""
+        max_nb = RANGE_FUNCTIONS[name][1]
+        # nothing to split: the client reject it
+        if number < 1:
+            return [(address, number)]
+        chunks = -(-number // max_nb)
+        return split_range(address, number, -(-chunks // self.size) * max_nb)
+
+    def _run_parts(self, calls, timeout):
+        """Run (client function name, *args) calls in parallel on pool clients, return their results"""
+        results = [None] * len(calls)
+
+        def run(i, name, *args):
+            with self.connection(timeout) as client:
+                if client is not None:
+                    results[i] = getattr(client, name)(*args)
+
+        threads = [Thread(target=run, args=(i,) + call) for i, call in enumerate(calls)]
+        for th in threads:
+            th.start()
+        for th in threads:
+            th.join()
+        return results
+
+    def close(self):
+        """Close idle connections, clients in use are closed when released"""
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._created -= len(idle)
+            self._cond.notify_all()
+        for client, released_at in idle:
+            client.close()
+
+    @property
+    def in_use(self):
+        """Number of clients checked out"""
+        with self._cond:
+            return self._created - len(self._idle)
+
+
+class ModbusPoolManager:
+    """Pools of connections, one per server host/port
+
+    size is the default pool size, sizes a {(host, port): size} dict for servers which
+    need another one. Others keyword args are passed to ModbusClientPool.
+    """
+
+    def __init__(self, size=4, sizes=None, **pool_kwargs):
+        self.size = size
+        self.sizes = dict(sizes or {})
+        self._pool_kwargs = pool_kwargs
+        self._pools = {}
+        self._lock = Lock()
+
+    def pool(self, host, port=const.MODBUS_PORT):
+        """Return the pool of server host/port (created on first call)"""
+        with self._lock:
+            pool = self._pools.get((host, port))
+            if pool is None:
+                size = self.sizes.get((host, port), self.size)
+                pool = self._pools[(host, port)] = ModbusClientPool(host, port, size, **self._pool_kwargs)
+            return pool
+
+    def connection(self, host, port=const.MODBUS_PORT, timeout=None):
+        """Context manager that check out a client of server host/port"""
+        return self.pool(host, port).connection(timeout)
+
+    def close(self):
+        """Close all pools"""
+        with self._lock:
+            pools, self._pools = list(self._pools.values()), {}
+        for pool in pools:
+            pool.close()
@@ -0,0 +1,126 @@
+import asyncio
+from codec import REG_TYPES, regs_to_values
+from collections import namedtuple
+
+# tables: name -> (client read function, max items per request, is a bits table)
+TABLES = {
+    'coil': ('read_coils', 2000, True),
+    'discrete_input': ('read_discrete_inputs', 2000, True),
+    'holding_register': ('read_holding_registers', 125, False),
+    'input_register': ('read_input_registers', 125, False),
+}
+# tag types: 'bool' (bits tables) and the register types of codec.REG_TYPES
+
+# a tag: where to read it and how to decode it (word_order 'big': first register is most significant)
+Tag = namedtuple('Tag', 'name table address type scale word_order')
+# a read request of the plan and the tags it serve
+Block = namedtuple('Block', 'table address count tags')
+
+
+class RegisterMap:
+    """Declarative map of tags (name -> table, address, type, scale)
+
+    tags is a {name: {'table': ..., 'address': ..., 'type': ..., 'scale': ...}} dict,
+    type default to 'uint16' ('bool' for coil and discrete_input) and scale to 1.
+    """
+
+    def __init__(self, tags=None):
+        self.tags = {}
+        for name, fields in (tags or {}).items():
+            self.add(name, **fields)
+
+    def add(self, name, table, address, type=None, scale=1, word_order='big'):
+        """Add (or replace) a tag"""
+        if table not in TABLES:
+            raise ValueError('unknown table %r' % table)
+        is_bits = TABLES[table][2]
+        if type is None:
+            type = 'bool' if is_bits else 'uint16'
+        if (type != 'bool' and type not in REG_TYPES) or (is_bits != (type == 'bool')):
+            raise ValueError('bad type %r for table %r' % (type, table))
+        if word_order not in ('big', 'little'):
+            raise ValueError('word_order must be big or little')
+        if not (0 <= address and address + _type_size(type) <= 0x10000):
+            raise ValueError('address out of range')
+        self.tags[name] = Tag(name, table, address, type, scale, word_order)
+
+    def compile(self, max_gap=8, max_bit_gap=256):
+        """Return the ReadPlan of the map
+
+        Tags of a table are merged in the same request when at most max_gap unused registers
+        (max_bit_gap unused bits) separate them and the request stay under protocol limits.
+        """
+        blocks = []
+        for table, (func, max_count, is_bits) in TABLES.items():
+            gap = max_bit_gap if is_bits else max_gap
+            tags = sorted((tag for tag in self.tags.values() if tag.table == table),
+                          key=lambda tag: tag.address)
+            block_tags = []
+            start = end = 0
+            for tag in tags:
+                tag_end = tag.address + _type_size(tag.type)
+                # extend current block or close it
+                if block_tags and tag.address - end <= gap and max(end, tag_end) - start <= max_count:
+                    block_tags.append(tag)
+                    end = max(end, tag_end)
+                    continue
+                if block_tags:
+                    blocks.append(Block(table, start, end - start, tuple(block_tags)))
+                block_tags = [tag]
+                start, end = tag.address, tag_end
+            if block_tags:
+                blocks.append(Block(table, start, end - start, tuple(block_tags)))
+        return ReadPlan(blocks)
+
+
+class ReadPlan:
+    """Compiled read plan of a RegisterMap: few requests, results decoded to a tag dict"""
+
+    def __init__(self, blocks):
+        self.blocks = blocks
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def requests(self):
+        """Return the plan requests as (client function name, address, count) items"""
+        return [(TABLES[block.table][0], block.address, block.count) for block in self.blocks]
+
+    def read(self, client):
+        """Run the plan with a ModbusClient (requests are pipelined), return {tag name: value}"""
+        return self.decode(client.batch(self.requests()))
+
+    async def read_async(self, client):
+        """Run the plan with an AsyncModbusClient, return {tag name: value}"""
+        results = await asyncio.gather(*[getattr(client, func)(address, count)
+                                         for func, address, count in self.requests()])
+        return self.decode(results)
+
+    def decode(self, results):
+        """Decode the results of requests() to {tag name: value} (None for a tag of a failed read)"""
+        values = {}
+        for block, items in zip(self.blocks, results):
+            for tag in block.tags:
+                if items is None:
+                    values[tag.name] = None
+                    continue
+                offset = tag.address - block.address
+                values[tag.name] = _decode_tag(tag, items[offset:offset + _type_size(tag.type)])
+        return values
+
+
+def _type_size(type):
+    """Size of a tag type (in bits or registers)"""
+    return 1 if type == 'bool' else REG_TYPES[type][2]
+
+
+def _decode_tag(tag, items):
+    """Decode the bits or registers of a tag to its value"""
+    if tag.type == 'bool':
+        value = bool(items[0])
+    else:
+        # registers of any read format (list, array, numpy) decoded as a list
+        value = regs_to_values(list(items), tag.type, tag.word_order)[0]
+    if tag.scale != 1:
+        value *= tag.scale
+    return value
@@ -1,229 +1,235 @@
 import constants as const
-from utils import test_bit, set_bit
+from databank import DataBank
+from array import array
+import asyncio
+from collections import namedtuple
+from functools import partial
+import multiprocessing
+import queue
+import signal
 import socket
 import struct
-from threading import Lock, Thread
+import sys
+from threading import current_thread, Event, Lock, Thread
+import time
 
 from socketserver import BaseRequestHandler, ThreadingTCPServer
 
+# precompiled frame codecs
+MBAP_HEAD = struct.Struct('>HHHB')
+EXCEPT_PDU = struct.Struct('BB')
+FC_BYTE_COUNT = struct.Struct('BB')
+FC_ADDR_VALUE = struct.Struct('>BHH')
+ADDR_COUNT = struct.Struct('>HH')
+ADDR_VALUE = ADDR_COUNT
+ADDR_COUNT_BYTES = struct.Struct('>HHB')
+READ_WRITE_HEAD = struct.Struct('>HHHHB')
+SPACE_ADDR_COUNT = struct.Struct('>BHH')
+PUSH_HEAD = struct.Struct('>BBHH')
 
-class DataBank:
-    """ Data class for thread safe access to bits and words space """
+# subscribe spaces: id in frames -> DataBank space
+SPACES = {const.SPACE_BITS: 'bits', const.SPACE_WORDS: 'words'}
+SPACE_IDS = {name: space_id for space_id, name in SPACES.items()}
+# max items pushed in a frame
+PUSH_MAX_BITS = 1920
+PUSH_MAX_WORDS = 120
+# max frames queued for a subscriber (thread engine), a slower one is disconnected
+PUSH_QUEUE_SIZE = 1024
+# max bytes in the transport buffer of a subscriber (asyncio engine), a slower one is disconnected
+PUSH_BUFFER_SIZE = 256 * 1024
 
-    bits_lock = Lock()
-    bits = [False] * 0x20000
-    words_lock = Lock()
-    words = [0] * 0x40000
+# a slave device of a gateway: data bank of coils and holding registers, data bank of
+# discrete inputs and input registers
+Unit = namedtuple('Unit', 'data_bank input_bank')
+# function codes served by the input bank of a unit
+INPUT_FUNCTIONS = (const.READ_DISCRETE_INPUTS, const.READ_INPUT_REGISTERS)
+# receive buffer size of a connection (many pipelined frames, a frame is at most 261 bytes)
+RX_BUFFER_SIZE = 4096
 
-    @classmethod
-    def get_bits(cls, address, number=1):
-        with cls.bits_lock:
-            if (address >= 0) and (address + number <= len(cls.bits)):
-                return cls.bits[address: number + address]
-            else:
-                return None
 
-    @classmethod
-    def set_bits(cls, address, bit_list):
-        with cls.bits_lock:
-            if (address >= 0) and (address + len(bit_list) <= len(cls.bits)):
-                cls.bits[address: address + len(bit_list)] = bit_list
-                return True
-            else:
-                return None
+class ModbusServer(object):
+    """Modbus TCP server"""
 
-    @classmethod
-    def get_words(cls, address, number=1):
-        with cls.words_lock:
-            if (address >= 0) and (address + number <= len(cls.words)):
-                return cls.words[address: number + address]
-            else:
-                return None
+    class ModbusService(BaseRequestHandler):
 
-    @classmethod
-    def set_words(cls, address, word_list):
-        with cls.words_lock:
-            if (address >= 0) and (address + len(word_list) <= len(cls.words)):
-                cls.words[address: address + len(word_list)] = word_list
-                return True
-            else:
+        def recv_frame(self):
+            """Receive a frame, return (MBAP, body) or None to close connection
+
+            body is a memoryview on the receive buffer: only valid until the next call.
+            """
+            # buffer empty: restart at its beginning
+            if self.rx_start == self.rx_end:
+                self.rx_start = self.rx_end = 0
+            # close connection if no standard 7 bytes header
+            if not self._fill(7):
                 return None
+            # decode header
+            mbap = ModbusServer._decode_mbap(self.rx_buffer, self.rx_start)
+            # close connection if frame header content inconsistency
+            if mbap is None:
+                return None
+            # close connection if lack of bytes in frame body
+            if not self._fill(6 + mbap[2]):
+                return None
+            # (the partial frame may have moved)
+            end = self.rx_start + 6 + mbap[2]
+            rx_body = self.rx_view[self.rx_start + 7:end]
+            self.rx_start = end
+            return mbap, rx_body
 
+        def _fill(self, size):
+            """Receive until size bytes are buffered from rx_start, return False if connection closed"""
+            while self.rx_end - self.rx_start < size:
+                if self.rx_start + size > len(self.rx_buffer):
+                    # move the partial frame at the beginning
+                    pending = self.rx_end - self.rx_start
+                    self.rx_buffer[:pending] = self.rx_buffer[self.rx_start:self.rx_end]
+                    self.rx_start, self.rx_end = 0, pending
+                # take everything available: next pipelined frames come with this one
+                try:
+                    count = self.request.recv_into(self.rx_view[self.rx_end:])
+                except OSError:
+                    return False
+                if not count:
+                    return False
+                self.rx_end += count
+            return True
 
-class ModbusServer(object):
-    """Modbus TCP server"""
+        def setup(self):
+            self.send_lock = Lock()
+            # receive buffer, frames are decoded in place
+            self.rx_buffer = bytearray(RX_BUFFER_SIZE)
+            self.rx_view = memoryview(self.rx_buffer)
+            self.rx_start = 0
+            self.rx_end = 0
+            # register connection (to end it on worker stop)
+            self.thread = current_thread()
+            mb_server = self.server.mb_server
+            with mb_server._handlers_lock:
+                if mb_server._closing:
+                    self.drop()
+                else:
+                    mb_server._handlers.add(self)
 
-    class ModbusService(BaseRequestHandler):
+        def finish(self):
+            mb_server = self.server.mb_server
+            with mb_server._handlers_lock:
+                mb_server._handlers.discard(self)
 
-        def recv_all(self, size):
-            if hasattr(socket, "MSG_WAITALL"):
-                data = self.request.recv(size, socket.MSG_WAITALL)
-            else:
-                # Windows lacks MSG_WAITALL
-                data = b''
-                while len(data) < size:
-                    data += self.request.recv(size - len(data))
-            return data
+        def send(self, frame):
+            # pushes of the link sender thread and responses share the socket
+            with self.send_lock:
+                self.request.sendall(frame)
+
+        def drop(self):
+            """Close a connection which can't follow its pushes (the handler end it)"""
+            try:
+                self.request.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
 
         def handle(self):
+            mb_server = self.server.mb_server
+            link = None
+            if mb_server.subscriptions:
+                # pushes are queued: a slow subscriber don't block the writers
+                link = _Link(self.send, PUSH_QUEUE_SIZE, self.drop)
+            stats = None
+            if mb_server.metrics is not None:
+                stats = mb_server.metrics.open_connection(self.client_address)
+            try:
+                self._serve_link(mb_server, link, stats)
+            finally:
+                if link is not None:
+                    link.close()
+                if stats is not None:
+                    mb_server.metrics.close_connection(stats)
+                self.request.close()
+
+        def _serve_link(self, mb_server, link, stats):
             while True:
-                rx_head = self.recv_all(7)
-                # close connection if no standard 7 bytes header
-                if not (rx_head and len(rx_head) == 7):
-                    break
-                # decode header
-                (rx_hd_tr_id, rx_hd_pr_id,
-                 rx_hd_length, rx_hd_unit_id) = struct.unpack('>HHHB', rx_head)
-                # close connection if frame header content inconsistency
-                if not ((rx_hd_pr_id == 0) and (2 < rx_hd_length < 256)):
-                    break
-                # receive body
-                rx_body = self.recv_all(rx_hd_length - 1)
-                # close connection if lack of bytes in frame body
-                if not (rx_body and (len(rx_body) == rx_hd_length - 1)):
+                frame = self.recv_frame()
+                if frame is None:
                     break
-                # body decode: function code
-                rx_bd_fc = struct.unpack('B', rx_body[0:1])[0]
-                # close connection if function code is inconsistent
-                if rx_bd_fc > 0x7F:
+                (mbap, rx_body) = frame
+                t_start = time.perf_counter()
+                # process request
+                tx_frame = mb_server._process_frame(mbap, rx_body, link)
+                if tx_frame is None:
                     break
-                # default except status
-                exp_status = 0
-                # functions Read Coils (0x01) or Read Discrete Inputs (0x02)
-                if rx_bd_fc in (const.READ_COILS, const.READ_DISCRETE_INPUTS):
-                    (b_address, b_count) = struct.unpack('>HH', rx_body[1:])
-                    # check quantity of requested bits
-                    if 0x0001 <= b_count <= 0x07D0:
-                        bits_l = DataBank.get_bits(b_address, b_count)
-                        if bits_l:
-                            # allocate bytes list
-                            b_size = int(b_count / 8)
-                            b_size += 1 if (b_count % 8) else 0
-                            bytes_l = [0] * b_size
-                            # populate bytes list with data bank bits
-                            for i, item in enumerate(bits_l):
-                                if item:
-                                    byte_i = int(i / 8)
-                                    bytes_l[byte_i] = set_bit(bytes_l[byte_i], i % 8)
-                            # format body of frame with bits
-                            tx_body = struct.pack('BB', rx_bd_fc, len(bytes_l))
-                            # add bytes with bits
-                            for byte in bytes_l:
-                                tx_body += struct.pack('B', byte)
-                        else:
-                            exp_status = const.EXP_DATA_ADDRESS
-                    else:
-                        exp_status = const.EXP_DATA_VALUE
-                # functions Read Holding Registers (0x03) or Read Input Registers (0x04)
-                elif rx_bd_fc in (const.READ_HOLDING_REGISTERS, const.READ_INPUT_REGISTERS):
-                    (w_address, w_count) = struct.unpack('>HH', rx_body[1:])
-                    # check quantity of requested words
-                    if 0x0001 <= w_count <= 0x007D:
-                        words_l = DataBank.get_words(w_address, w_count)
-                        if words_l:
-                            # format body of frame with words
-                            tx_body = struct.pack('BB', rx_bd_fc, w_count * 2)
-                            for word in words_l:
-                                tx_body += struct.pack('>H', word)
-                        else:
-                            exp_status = const.EXP_DATA_ADDRESS
-                    else:
-                        exp_status = const.EXP_DATA_VALUE
-                # function Write Single Coil (0x05)
-                elif rx_bd_fc is const.WRITE_SINGLE_COIL:
-                    (b_address, b_value) = struct.unpack('>HH', rx_body[1:])
-                    f_b_value = bool(b_value == 0xFF00)
-                    if DataBank.set_bits(b_address, [f_b_value]):
-                        # send write ok frame
-                        tx_body = struct.pack('>BHH', rx_bd_fc, b_address, b_value)
-                    else:
-                        exp_status = const.EXP_DATA_ADDRESS
-                # function Write Single Register (0x06)
-                elif rx_bd_fc is const.WRITE_SINGLE_REGISTER:
-                    (w_address, w_value) = struct.unpack('>HH', rx_body[1:])
-                    if DataBank.set_words(w_address, [w_value]):
-                        # send write ok frame
-                        tx_body = struct.pack('>BHH', rx_bd_fc, w_address, w_value)
+                # send frame (whole: a partial send would desync the client)
+                try:
+                    if link is None:
+                        self.request.sendall(tx_frame)
                     else:
-                        exp_status = const.EXP_DATA_ADDRESS
-                # function Write Multiple Coils (0x0F)
-                elif rx_bd_fc is const.WRITE_MULTIPLE_COILS:
-                    (b_address, b_count, byte_count) = struct.unpack('>HHB', rx_body[1:6])
-                    # check quantity of updated coils
-                    if (0x0001 <= b_count <= 0x07B0) and (byte_count >= (b_count / 8)):
-                        # allocate bits list
-                        bits_l = [False] * b_count
-                        # populate bits list with bits from rx frame
-                        for i, item in enumerate(bits_l):
-                            b_bit_pos = int(i / 8) + 6
-                            b_bit_val = struct.unpack('B', rx_body[b_bit_pos:b_bit_pos + 1])[0]
-                            bits_l[i] = test_bit(b_bit_val, i % 8)
-                        # write words to data bank
-                        if DataBank.set_bits(b_address, bits_l):
-                            # send write ok frame
-                            tx_body = struct.pack('>BHH', rx_bd_fc, b_address, b_count)
-                        else:
-                            exp_status = const.EXP_DATA_ADDRESS
-                    else:
-                        exp_status = const.EXP_DATA_VALUE
-                # function Write Multiple Registers (0x10)
-                elif rx_bd_fc is const.WRITE_MULTIPLE_REGISTERS:
-                    (w_address, w_count, byte_count) = struct.unpack('>HHB', rx_body[1:6])
-                    # check quantity of updated words
-                    if (0x0001 <= w_count <= 0x007B) and (byte_count == w_count * 2):
-                        # allocate words list
-                        words_l = [0] * w_count
-                        # populate words list with words from rx frame
-                        for i, item in enumerate(words_l):
-                            w_offset = i * 2 + 6
-                            words_l[i] = struct.unpack('>H', rx_body[w_offset:w_offset + 2])[0]
-                        # write words to data bank
-                        if DataBank.set_words(w_address, words_l):
-                            # send write ok frame
-                            tx_body = struct.pack('>BHH', rx_bd_fc, w_address, w_count)
-                        else:
-                            exp_status = const.EXP_DATA_ADDRESS
-                    else:
-                        exp_status = const.EXP_DATA_VALUE
-                else:
-                    exp_status = const.EXP_ILLEGAL_FUNCTION
-                # check exception
-                if exp_status != 0:
-                    # format body of frame with exception status 0x80=128
-                    tx_body = struct.pack('BB', rx_bd_fc + 0x80, exp_status)
-                # build frame header
-                tx_head = struct.pack('>HHHB', rx_hd_tr_id, rx_hd_pr_id, len(tx_body) + 1, rx_hd_unit_id)
-                # send frame
-                self.request.send(tx_head + tx_body)
-            self.request.close()
+                        self.send(tx_frame)
+                except OSError:
+                    break
+                if stats is not None:
+                    mb_server._record(stats, mbap, rx_body, tx_frame, t_start)
+
+    def __init__(self, host='localhost', port=const.MODBUS_PORT, no_block=False, engine=const.ENGINE_THREAD,
+                 data_bank=None, subscriptions=False, processes=1, no_delay=True, metrics=None):
+        """Constructor
 
-    def __init__(self, host='localhost', port=const.MODBUS_PORT, no_block=False):
-        """Constructor"""
+        engine select how connections are served: ENGINE_THREAD (one OS thread per
+        client) or ENGINE_ASYNCIO (all clients multiplexed on one event loop).
+        data_bank is the DataBank served (a new one with default storage if None) to every
+        unit ID, unless units are added with add_unit() (gateway mode).
+        subscriptions enable the custom SUBSCRIBE function: clients subscribe to ranges and the
+        server push their changes (frames with transaction ID PUSH_TR_ID) instead of being polled.
+        processes > 1 fork worker processes which accept connections on the same port
+        (SO_REUSEPORT) and serve shared data banks (DataBank with shared=True, units must be
+        added before start()). Subscribers only get changes written by their worker.
+        no_delay set TCP_NODELAY on client connections (compare with bench.py --no-delay off).
+        metrics is an optional metrics.ServerMetrics which account requests (single process
+        server only: workers would update their own copy of it).
+        """
+        if engine not in (const.ENGINE_THREAD, const.ENGINE_ASYNCIO):
+            raise ValueError('unknown server engine %r' % engine)
+        if processes > 1 and not hasattr(socket, 'SO_REUSEPORT'):
+            raise ValueError('multi-process server need SO_REUSEPORT')
+        if processes > 1 and data_bank is not None and not data_bank.shared:
+            raise ValueError('multi-process server need a shared DataBank')
+        if processes > 1 and metrics is not None:
+            raise ValueError('server metrics are not available for a multi-process server')
         # public
         self.host = host
         self.port = port
         self.no_block = no_block
+        self.engine = engine
+        self.processes = processes
+        self.no_delay = no_delay
+        self.metrics = metrics
+        self.data_bank = DataBank(shared=processes > 1) if data_bank is None else data_bank
+        self.functions = dict(FUNCTIONS)
+        self.subscriptions = subscriptions
         # private
         self._running = False
         self._service = None
         self._serve_th = None
+        self._loop = None
+        self._writers = set()
+        self._stopped = Event()
+        self._units = {}  # unit ID -> Unit
+        self._workers = []  # worker processes
+        self._stop_workers = None  # event set to stop worker processes
+        self._reuse_port = False
+        self._handlers = set()  # ModbusService of connections (thread engine)
+        self._handlers_lock = Lock()
+        self._closing = False
 
     def start(self):
         """Start the server."""
         if not self.is_run:
-            # set class attribute
-            ThreadingTCPServer.address_family = socket.AF_INET
-            ThreadingTCPServer.daemon_threads = True
-            # init server
-            self._service = ThreadingTCPServer((self.host, self.port), self.ModbusService, bind_and_activate=False)
-            # set socket options
-            self._service.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            self._service.socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
-            # TODO test no_delay with bench
-            self._service.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-            # bind and activate
-            self._service.server_bind()
-            self._service.server_activate()
+            if self.processes > 1:
+                self._start_processes()
+                return
+            if self.engine == const.ENGINE_ASYNCIO:
+                self._start_asyncio()
+            else:
+                self._start_thread()
+            self._stopped.clear()
             # serve request
             if self.no_block:
                 self._serve_th = Thread(target=self._serve)
@@ -233,28 +239,561 @@ class ModbusServer(object):
                 self._serve()
 
     def stop(self):
-        """Stop the server."""
+        """Stop the server and end its client connections."""
         if self.is_run:
-            self._service.shutdown()
-            self._service.server_close()
+            if self._workers:
+                self._stop_processes()
+            elif self.engine == const.ENGINE_ASYNCIO:
+                self._loop.call_soon_threadsafe(self._loop.stop)
+                # like shutdown(), wait the end of serve loop (unless called from it)
+                if not self._in_loop():
+                    self._stopped.wait()
+            else:
+                self._service.shutdown()
+                self._service.server_close()
+                self._close_connections()
 
     @property
     def is_run(self):
         """Return True if server running."""
         return self._running
 
+    def _start_thread(self):
+        self._closing = False
+        # set class attribute
+        ThreadingTCPServer.address_family = socket.AF_INET
+        ThreadingTCPServer.daemon_threads = True
+        # init server
+        self._service = ThreadingTCPServer((self.host, self.port), self.ModbusService, bind_and_activate=False)
+        self._service.mb_server = self
+        # set socket options
+        self._service.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._service.socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if self._reuse_port:
+            self._service.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        # accepted sockets inherit it
+        self._service.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, int(self.no_delay))
+        # bind and activate
+        self._service.server_bind()
+        self._service.server_activate()
+
+    def _start_asyncio(self):
+        # listen socket with the same options as the threading engine
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            if self._reuse_port:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, int(self.no_delay))
+            sock.bind((self.host, self.port))
+        except socket.error:
+            sock.close()
+            raise
+        # the loop is run by _serve(), possibly in another thread
+        self._loop = asyncio.new_event_loop()
+        try:
+            self._service = self._loop.run_until_complete(
+                asyncio.start_server(self._handle_stream, sock=sock, backlog=const.ASYNCIO_BACKLOG))
+        except:
+            self._loop.close()
+            sock.close()
+            raise
+
+    def _start_processes(self):
+        # workers are forked: they inherit the shared data banks and units
+        context = multiprocessing.get_context('fork')
+        self._stop_workers = context.Event()
+        self._workers = [context.Process(target=self._serve_worker, args=(self._stop_workers,), daemon=True)
+                         for _ in range(self.processes)]
+        for worker in self._workers:
+            worker.start()
+        self._running = True
+        self._stopped.clear()
+        if not self.no_block:
+            # workers ignore SIGINT: stop them on KeyboardInterrupt
+            try:
+                for worker in self._workers:
+                    worker.join()
+            finally:
+                self._stop_processes()
+
+    def _stop_processes(self):
+        # no terminate(): a worker killed in a write would keep its stripe locks
+        workers, self._workers = self._workers, []
+        self._stop_workers.set()
+        for worker in workers:
+            worker.join()
+        self._running = False
+        self._stopped.set()
+
+    def _serve_worker(self, stop):
+        """Worker process: serve connections of the shared port with the selected engine until stop
+        is set."""
+        # Ctrl-C could interrupt a write (its stripe locks are shared): the parent stop workers
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        self.processes = 1
+        self.no_block = True
+        self._reuse_port = True
+        self._workers = []
+        self.start()
+        stop.wait()
+        self.stop()
+
+    def _close_connections(self):
+        """End client connections of the thread engine, after their request in progress"""
+        with self._handlers_lock:
+            self._closing = True
+            handlers = list(self._handlers)
+        for handler in handlers:
+            handler.drop()
+        for handler in handlers:
+            # (stop() may be called by a request handler)
+            if handler.thread is not current_thread():
+                handler.thread.join()
+
     def _serve(self):
         try:
             self._running = True
-            self._service.serve_forever()
+            if self.engine == const.ENGINE_ASYNCIO:
+                self._loop.run_forever()
+            else:
+                self._service.serve_forever()
         except:
-            self._service.server_close()
+            if self.engine == const.ENGINE_THREAD:
+                self._service.server_close()
             raise
         finally:
             self._running = False
+            if self.engine == const.ENGINE_ASYNCIO:
+                self._close_loop()
+            self._stopped.set()
+
+    def _close_loop(self):
+        self._loop.run_until_complete(self._shutdown())
+        self._loop.close()
+
+    async def _shutdown(self):
+        """Close the listen socket and every client connection."""
+        self._service.close()
+        for i in range(10):
+            # let connections accepted just before close() register their writer
+            await asyncio.sleep(0)
+            for writer in list(self._writers):
+                # a client which don't read keep its buffer (and its task waiting in drain())
+                if i == 0:
+                    writer.close()
+                else:
+                    writer.transport.abort()
+            tasks = asyncio.all_tasks() - {asyncio.current_task()}
+            if not tasks:
+                break
+            await asyncio.wait(tasks, timeout=0.1)
+        await self._service.wait_closed()
+
+    @staticmethod
+    def _push_stream(writer, frame):
+        """Send a push frame on the asyncio engine (in the loop), drop a subscriber which don't
+        follow (same policy as the thread engine queue)"""
+        transport = writer.transport
+        if transport.is_closing():
+            return
+        if transport.get_write_buffer_size() > PUSH_BUFFER_SIZE:
+            transport.abort()
+            return
+        writer.write(frame)
+
+    def _in_loop(self):
+        """Return True if called from the asyncio engine loop."""
+        try:
+            return asyncio.get_running_loop() is self._loop
+        except RuntimeError:
+            return False
+
+    async def _handle_stream(self, reader, writer):
+        """Serve a client connection on the asyncio engine."""
+        self._writers.add(writer)
+        stats = None
+        if self.metrics is not None:
+            stats = self.metrics.open_connection(writer.get_extra_info('peername'))
+        link = None
+        if self.subscriptions:
+            # pushes may come from others threads
+            link = _Link(partial(self._loop.call_soon_threadsafe, self._push_stream, writer))
+        try:
+            while True:
+                rx_head = await reader.readexactly(7)
+                # decode header
+                mbap = self._decode_mbap(rx_head)
+                # close connection if frame header content inconsistency
+                if mbap is None:
+                    break
+                # receive body
+                rx_body = await reader.readexactly(mbap[2] - 1)
+                t_start = time.perf_counter()
+                # process request
+                tx_frame = self._process_frame(mbap, rx_body, link)
+                if tx_frame is None:
+                    break
+                # send frame
+                writer.write(tx_frame)
+                await writer.drain()
+                if stats is not None:
+                    self._record(stats, mbap, rx_body, tx_frame, t_start)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            if link is not None:
+                link.close()
+            if stats is not None:
+                self.metrics.close_connection(stats)
+            self._writers.discard(writer)
+            writer.close()
+
+    def add_unit(self, unit_id, data_bank=None, input_bank=None):
+        """Add (or replace) a slave device, return its Unit.
+
+        Once a unit is added the server act as a gateway: each unit have its own address
+        spaces and requests to others unit IDs get a gateway except. data_bank (coils and holding
+        registers) and input_bank (discrete inputs and input registers) default to new DataBank,
+        their storage is allocated on first write (at creation for a multi-process server).
+        """
+        if not (0 <= unit_id <= 255):
+            raise ValueError('unit ID out of range')
+        shared = self.processes > 1
+        if shared and not all(bank.shared for bank in (data_bank, input_bank) if bank is not None):
+            raise ValueError('multi-process server need a shared DataBank')
+        unit = Unit(DataBank(shared=shared) if data_bank is None else data_bank,
+                    DataBank(shared=shared) if input_bank is None else input_bank)
+        self._units[unit_id] = unit
+        return unit
+
+    def remove_unit(self, unit_id):
+        """Remove a slave device"""
+        self._units.pop(unit_id, None)
+
+    def unit(self, unit_id):
+        """Return the Unit of a slave device, None if there is no such unit"""
+        return self._units.get(unit_id)
+
+    def register_function(self, fc, handler):
+        """Add (or replace) the handler of a function code.
+
+        handler(data_bank, fc, data) get the data bank of the unit (input bank for discrete
+        inputs and input registers reads), the request data following the function code and
+        return the response PDU (bytes starting with fc) or a Modbus except code (int).
+        """
+        if not (0x01 <= fc <= 0x7F):
+            raise ValueError('function code out of range')
+        self.functions[fc] = handler
+
+    def _record(self, stats, mbap, rx_body, tx_frame, t_start):
+        """Account a request of a connection in metrics."""
+        # except code of an except response
+        exp_code = tx_frame[8] if tx_frame[7] > 0x80 else None
+        self.metrics.record(stats, mbap[3], rx_body[0], time.perf_counter() - t_start,
+                            7 + len(rx_body), len(tx_frame), exp_code)
+
+    @staticmethod
+    def _decode_mbap(rx_head, offset=0):
+        """Decode a 7 bytes MBAP header (at offset of rx_head), return None if it is inconsistent."""
+        (rx_hd_tr_id, rx_hd_pr_id,
+         rx_hd_length, rx_hd_unit_id) = MBAP_HEAD.unpack_from(rx_head, offset)
+        if not ((rx_hd_pr_id == 0) and (2 < rx_hd_length < 256)):
+            return None
+        return rx_hd_tr_id, rx_hd_pr_id, rx_hd_length, rx_hd_unit_id
+
+    def _process_frame(self, mbap, rx_body, link=None):
+        """Process a request, return the response frame or None to close connection.
+
+        link is the _Link of the connection if subscriptions are enabled.
+        """
+        (rx_hd_tr_id, rx_hd_pr_id, rx_hd_length, rx_hd_unit_id) = mbap
+        # body decode: function code
+        rx_bd_fc = rx_body[0]
+        # close connection if function code is inconsistent
+        if rx_bd_fc > 0x7F:
+            return None
+        handler = self.functions.get(rx_bd_fc)
+        # subscribe need the connection
+        if (rx_bd_fc == const.SUBSCRIBE) and (link is not None):
+            handler = partial(_subscribe, link, rx_hd_unit_id)
+        # data bank of the unit and table
+        if self._units:
+            unit = self._units.get(rx_hd_unit_id)
+            if unit is None:
+                data_bank = None
+            elif rx_bd_fc in INPUT_FUNCTIONS:
+                data_bank = unit.input_bank
+            else:
+                data_bank = unit.data_bank
+        else:
+            # one device: every unit ID and table share data_bank
+            data_bank = self.data_bank
+        if data_bank is None:
+            # gateway without this device
+            tx_pdu = const.EXP_GATEWAY_TARGET_DEVICE_FAILED_TO_RESPOND
+        elif handler is None:
+            tx_pdu = const.EXP_ILLEGAL_FUNCTION
+        else:
+            try:
+                tx_pdu = handler(data_bank, rx_bd_fc, memoryview(rx_body)[1:])
+            except struct.error:
+                # request data too short or too long for this function
+                tx_pdu = const.EXP_DATA_VALUE
+        # check exception
+        if isinstance(tx_pdu, int):
+            # format body of frame with exception status 0x80=128
+            tx_pdu = EXCEPT_PDU.pack(rx_bd_fc + 0x80, tx_pdu)
+        # build frame header
+        return MBAP_HEAD.pack(rx_hd_tr_id, rx_hd_pr_id, len(tx_pdu) + 1, rx_hd_unit_id) + tx_pdu
+
+
+class _Link:
+    """Server side of a connection with change subscriptions (report-by-exception)
+
+    send(frame) must be thread safe: changes are pushed by the thread of the writer. With a
+    queue_size, frames are queued by the writer and sent by a sender thread of the link,
+    on_overflow() is called (once) if the subscriber don't follow: a push can't be dropped.
+    """
+
+    def __init__(self, send, queue_size=0, on_overflow=None):
+        self.send = send
+        self.subscriptions = []  # (data bank, subscription)
+        # private
+        self._queue = queue.Queue(queue_size) if queue_size else None
+        self._on_overflow = on_overflow
+        self._sender = None
+        self._closed = False
+
+    def subscribe(self, data_bank, space, address, number, unit_id):
+        """Push changes of a range, return False if it's out of space"""
+        subscription = data_bank.subscribe(partial(self._push, data_bank, unit_id), space, address, number)
+        if subscription is None:
+            return False
+        self.subscriptions.append((data_bank, subscription))
+        if self._queue is not None and self._sender is None:
+            self._sender = Thread(target=self._send_queued, daemon=True)
+            self._sender.start()
+        return True
+
+    def unsubscribe(self, data_bank=None, space=None):
+        """Cancel subscriptions to space of data_bank (all if None)"""
+        for item in [(bank, s) for bank, s in self.subscriptions
+                     if data_bank in (None, bank) and space in (None, s.space)]:
+            item[0].unsubscribe(item[1])
+            self.subscriptions.remove(item)
+
+    def close(self):
+        self.unsubscribe()
+        self._closed = True
+        if self._sender is not None:
+            # a full queue is not waited: the sender see _closed after its next frame
+            try:
+                self._queue.put_nowait(None)
+            except queue.Full:
+                pass
+
+    def _send_queued(self):
+        """Sender thread: send queued frames until close()"""
+        while True:
+            frame = self._queue.get()
+            if frame is None or self._closed:
+                return
+            try:
+                self.send(frame)
+            except OSError:
+                # connection lost: its handler will close the link
+                return
+
+    def _send_push(self, frame):
+        """Send a push frame (or queue it), return False if the link can't take it"""
+        if self._queue is None:
+            self.send(frame)
+            return True
+        try:
+            self._queue.put_nowait(frame)
+            return True
+        except queue.Full:
+            pass
+        # the subscriber miss changes: close its connection (once)
+        if not self._closed:
+            self._closed = True
+            if self._on_overflow is not None:
+                self._on_overflow()
+        return False
+
+    def _push(self, data_bank, unit_id, space, address, number, version):
+        """Send the values of a changed range (in frames under the PDU size limit)"""
+        if self._closed:
+            return
+        max_nb = PUSH_MAX_BITS if space == 'bits' else PUSH_MAX_WORDS
+        end = address + number
+        for c_address in range(address, end, max_nb):
+            c_number = min(max_nb, end - c_address)
+            if space == 'bits':
+                data = data_bank.get_bits_packed(c_address, c_number)
+            else:
+                data = data_bank.get_words_bytes(c_address, c_number)
+            tx_pdu = PUSH_HEAD.pack(const.SUBSCRIBE, SPACE_IDS[space], c_address, c_number) + data
+            try:
+                if not self._send_push(MBAP_HEAD.pack(const.PUSH_TR_ID, 0, len(tx_pdu) + 1, unit_id) + tx_pdu):
+                    return
+            except OSError:
+                # connection lost: its handler will close the link
+                return
+
+
+def _subscribe(link, unit_id, data_bank, fc, data):
+    """Function Subscribe (custom 0x41): push changes of a range to the connection
+
+    Request and response data are space (SPACE_BITS/SPACE_WORDS), address and number,
+    a number of 0 cancel every subscription of the connection to space (of this unit).
+    """
+    (space_id, address, number) = SPACE_ADDR_COUNT.unpack(data)
+    space = SPACES.get(space_id)
+    if space is None:
+        return const.EXP_DATA_VALUE
+    if number == 0:
+        link.unsubscribe(data_bank, space)
+    elif not link.subscribe(data_bank, space, address, number, unit_id):
+        return const.EXP_DATA_ADDRESS
+    # send subscribe ok frame
+    return bytes([fc]) + SPACE_ADDR_COUNT.pack(space_id, address, number)
+
+
+def _read_bits(data_bank, fc, data):
+    """Functions Read Coils (0x01) or Read Discrete Inputs (0x02)"""
+    (b_address, b_count) = ADDR_COUNT.unpack(data)
+    # check quantity of requested bits
+    if not (0x0001 <= b_count <= 0x07D0):
+        return const.EXP_DATA_VALUE
+    b_bytes = data_bank.get_bits_packed(b_address, b_count)
+    if b_bytes is None:
+        return const.EXP_DATA_ADDRESS
+    # format body of frame with packed bits
+    return FC_BYTE_COUNT.pack(fc, len(b_bytes)) + b_bytes
+
+
+def _read_words(data_bank, fc, data):
+    """Functions Read Holding Registers (0x03) or Read Input Registers (0x04)"""
+    (w_address, w_count) = ADDR_COUNT.unpack(data)
+    # check quantity of requested words
+    if not (0x0001 <= w_count <= 0x007D):
+        return const.EXP_DATA_VALUE
+    words_b = data_bank.get_words_bytes(w_address, w_count)
+    if words_b is None:
+        return const.EXP_DATA_ADDRESS
+    # format body of frame with words (one bulk copy)
+    return FC_BYTE_COUNT.pack(fc, w_count * 2) + words_b
+
+
+def _write_single_coil(data_bank, fc, data):
+    """Function Write Single Coil (0x05)"""
+    (b_address, b_value) = ADDR_VALUE.unpack(data)
+    f_b_value = bool(b_value == 0xFF00)
+    if not data_bank.set_bits(b_address, [f_b_value]):
+        return const.EXP_DATA_ADDRESS
+    # send write ok frame
+    return FC_ADDR_VALUE.pack(fc, b_address, b_value)
+
+
+def _write_single_register(data_bank, fc, data):
+    """Function Write Single Register (0x06)"""
+    (w_address, w_value) = ADDR_VALUE.unpack(data)
+    if not data_bank.set_words(w_address, [w_value]):
+        return const.EXP_DATA_ADDRESS
+    # send write ok frame
+    return FC_ADDR_VALUE.pack(fc, w_address, w_value)
+
+
+def _write_multiple_coils(data_bank, fc, data):
+    """Function Write Multiple Coils (0x0F)"""
+    (b_address, b_count, byte_count) = ADDR_COUNT_BYTES.unpack_from(data)
+    b_bytes = data[ADDR_COUNT_BYTES.size:]
+    # check quantity of updated coils
+    if not ((0x0001 <= b_count <= 0x07B0) and (byte_count >= (b_count + 7) // 8) and
+            (len(b_bytes) == byte_count)):
+        return const.EXP_DATA_VALUE
+    # write bits to data bank
+    if not data_bank.set_bits_packed(b_address, b_bytes, b_count):
+        return const.EXP_DATA_ADDRESS
+    # send write ok frame
+    return FC_ADDR_VALUE.pack(fc, b_address, b_count)
+
+
+def _write_multiple_registers(data_bank, fc, data):
+    """Function Write Multiple Registers (0x10)"""
+    (w_address, w_count, byte_count) = ADDR_COUNT_BYTES.unpack_from(data)
+    w_bytes = data[ADDR_COUNT_BYTES.size:]
+    # check quantity of updated words
+    if not ((0x0001 <= w_count <= 0x007B) and (byte_count == w_count * 2) and
+            (len(w_bytes) == byte_count)):
+        return const.EXP_DATA_VALUE
+    # write words to data bank
+    if not data_bank.set_words(w_address, bytes_to_words(w_bytes)):
+        return const.EXP_DATA_ADDRESS
+    # send write ok frame
+    return FC_ADDR_VALUE.pack(fc, w_address, w_count)
+
+
+def _write_read_registers(data_bank, fc, data):
+    """Function Read/Write Multiple Registers (0x17): write then read in one atomic step"""
+    (r_address, r_count, w_address, w_count, byte_count) = READ_WRITE_HEAD.unpack_from(data)
+    w_bytes = data[READ_WRITE_HEAD.size:]
+    # check quantities of read and written words
+    if not ((0x0001 <= r_count <= 0x007D) and (0x0001 <= w_count <= 0x0079) and
+            (byte_count == w_count * 2) and (len(w_bytes) == byte_count)):
+        return const.EXP_DATA_VALUE
+    words_l = data_bank.write_read_words(w_address, bytes_to_words(w_bytes), r_address, r_count)
+    if words_l is None:
+        return const.EXP_DATA_ADDRESS
+    # format body of frame with read words
+    return FC_BYTE_COUNT.pack(fc, r_count * 2) + words_to_bytes(words_l)
+
+
+def words_to_bytes(words):
+    """Return a sequence of words as big endian bytes"""
+    w_array = array('H')
+    if isinstance(words, memoryview):
+        w_array.frombytes(words.cast('B'))
+    else:
+        w_array.extend(words)
+    if sys.byteorder == 'little':
+        w_array.byteswap()
+    return w_array.tobytes()
+
+
+def bytes_to_words(data):
+    """Return big endian bytes as an array('H') of words"""
+    w_array = array('H')
+    w_array.frombytes(data)
+    if sys.byteorder == 'little':
+        w_array.byteswap()
+    return w_array
+
 
+# default function codes dispatch table (function code -> handler)
+FUNCTIONS = {
+    const.READ_COILS: _read_bits,
+    const.READ_DISCRETE_INPUTS: _read_bits,
+    const.READ_HOLDING_REGISTERS: _read_words,
+    const.READ_INPUT_REGISTERS: _read_words,
+    const.WRITE_SINGLE_COIL: _write_single_coil,
+    const.WRITE_SINGLE_REGISTER: _write_single_register,
+    const.WRITE_MULTIPLE_COILS: _write_multiple_coils,
+    const.WRITE_MULTIPLE_REGISTERS: _write_multiple_registers,
+    const.READ_WRITE_MULTIPLE_REGISTERS: _write_read_registers,
+}
 
 if __name__ == '__main__':
+    from journal import open_data_bank
+    # registers are kept in the data directory given as argument (if any)
+    persistent_bank = open_data_bank(sys.argv[1]) if len(sys.argv) > 1 else None
     # start modbus server
-    server = ModbusServer(host='localhost', port=502)
-    server.start()
+    server = ModbusServer(host='localhost', port=502, data_bank=persistent_bank)
+    try:
+        server.start()
+    finally:
+        if persistent_bank is not None:
+            persistent_bank.close()
@@ -0,0 +1,86 @@
+import asyncio
+import socket
+import threading
+import unittest
+
+from async_client import AsyncModbusClient
+import constants as const
+import pdu
+from server import ModbusServer
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+
+class PushCallbackTest(unittest.TestCase):
+
+    def setUp(self):
+        self.port = _free_port()
+        self.server = ModbusServer(host='localhost', port=self.port, no_block=True, subscriptions=True)
+        self.server.start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_callback_error(self):
+        async def run():
+            client = AsyncModbusClient(port=self.port, timeout=2.0)
+            self.assertTrue(await client.open())
+
+            def callback(space, address, values):
+                raise RuntimeError('bad callback')
+
+            self.assertTrue(await client.subscribe('words', 0, 4, callback))
+            self.assertTrue(await client.write_single_register(1, 5))
+            # the receive loop survive the callback
+            self.assertEqual(await client.read_holding_registers(0, 2, timeout=1.0), [0, 5])
+            await client.close()
+
+        asyncio.run(run())
+
+    def test_rx_loop_error(self):
+        # a server which push a change before the response of the first request
+        listener = socket.create_server(('localhost', 0))
+        port = listener.getsockname()[1]
+
+        def fake_server():
+            conn, addr = listener.accept()
+            with conn:
+                conn.recv(12)
+                body = pdu.SPACE_ADDR_COUNT.pack(const.SPACE_WORDS, 0, 1) + b'\x00\x05'
+                conn.sendall(pdu.mbap_frame(const.PUSH_TR_ID, 1, const.SUBSCRIBE, body))
+                # no response: wait the client close
+                conn.recv(12)
+
+        server_th = threading.Thread(target=fake_server, daemon=True)
+        server_th.start()
+
+        async def run():
+            client = AsyncModbusClient(port=port, timeout=5.0)
+            self.assertTrue(await client.open())
+
+            def dispatch(rx_pdu):
+                raise ValueError('dispatch error')
+
+            client._dispatch_push = dispatch
+            # the push kill the receive loop: the link is dropped, the pending call end now
+            loop = asyncio.get_running_loop()
+            t_start = loop.time()
+            self.assertIsNone(await client.read_holding_registers(0, 2))
+            self.assertLess(loop.time() - t_start, 1.0)
+            self.assertFalse(client.is_open())
+            with self.assertRaises(ValueError):
+                await client._rx_task
+            await client.close()
+
+        try:
+            asyncio.run(run())
+        finally:
+            listener.close()
+        server_th.join(5.0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+import socket
+import unittest
+
+from cache import RegisterCache
+from client import ModbusClient
+from server import ModbusServer
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+
+class ClientCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        port = _free_port()
+        self.server = ModbusServer(host='localhost', port=port, no_block=True)
+        self.server.start()
+        self.client = ModbusClient(host='localhost', port=port, cache=RegisterCache(ttl=60.0))
+        self.assertTrue(self.client.open())
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+
+    def test_read_after_pipelined_write(self):
+        self.assertTrue(self.client.write_single_register(1, 5))
+        self.assertEqual(self.client.read_holding_registers(1, 1), [5])
+        write = self.client.submit('write_single_register', 1, 6)
+        read = self.client.submit('read_holding_registers', 1, 1)
+        self.assertEqual(read.result(), [6])
+        self.assertTrue(write.result())
+
+    def test_blocking_read_after_pipelined_write(self):
+        self.assertTrue(self.client.write_multiple_registers(1, [5, 5]))
+        self.assertEqual(self.client.read_holding_registers(1, 2), [5, 5])
+        self.client.submit('write_multiple_registers', 2, [6])
+        self.assertEqual(self.client.read_holding_registers(1, 2), [5, 6])
+
+    def test_cache_by_unit_id(self):
+        cache = self.client.cache()
+        self.assertTrue(self.client.write_single_register(1, 5))
+        self.client.unit_id(2)
+        self.assertIsNone(cache.get('holding_register', 1, 1, unit_id=2))
+        self.client.unit_id(1)
+        self.assertEqual(cache.get('holding_register', 1, 1, unit_id=1), [5])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,189 @@
+import socket
+import struct
+from threading import Thread
+import time
+import unittest
+
+from client import ModbusClient, split_range
+from pool import ModbusClientPool
+from server import ModbusServer
+
+
+class HostTest(unittest.TestCase):
+
+    def test_valid_hosts(self):
+        client = ModbusClient()
+        for hostname in ('127.0.0.1', '::1', 'fe80::1%1', 'plc1.example', 'plc-1.example.', 'localhost'):
+            self.assertEqual(client.host(hostname), hostname)
+
+    def test_invalid_hosts(self):
+        client = ModbusClient(host='plc1.example')
+        for hostname in ('', 'plc 1', '-plc.example', 'plc..example', 'a' * 64, ':::1'):
+            self.assertIsNone(client.host(hostname))
+        self.assertEqual(client.host(), 'plc1.example')
+
+    def test_constructors(self):
+        self.assertEqual(ModbusClient(host='::1').host(), '::1')
+        self.assertEqual(ModbusClientPool(host='plc1.example').host, 'plc1.example')
+        with self.assertRaises(ValueError):
+            ModbusClient(host='plc 1')
+        with self.assertRaises(ValueError):
+            ModbusClientPool(host='plc 1')
+
+
+class PoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.listener = socket.create_server(('localhost', 0))
+        self.port = self.listener.getsockname()[1]
+
+    def tearDown(self):
+        self.listener.close()
+
+    def test_is_alive(self):
+        client = ModbusClient(host='localhost', port=self.port)
+        self.assertFalse(client.is_alive())
+        self.assertTrue(client.open())
+        conn, addr = self.listener.accept()
+        self.assertTrue(client.is_alive())
+        # FIN of the server
+        conn.close()
+        time.sleep(0.1)
+        self.assertTrue(client.is_open())
+        self.assertFalse(client.is_alive())
+        client.close()
+
+    def test_reconnect_closed_idle_client(self):
+        pool = ModbusClientPool(host='localhost', port=self.port, size=1)
+        client = pool.acquire()
+        conn, addr = self.listener.accept()
+        pool.release(client)
+        conn.close()
+        time.sleep(0.1)
+        # same client, new connection
+        self.assertIs(pool.acquire(timeout=1.0), client)
+        self.assertTrue(client.is_alive())
+        pool.release(client)
+        pool.close()
+
+    def test_in_use_after_close(self):
+        pool = ModbusClientPool(host='localhost', port=self.port, size=2)
+        clients = [pool.acquire(), pool.acquire()]
+        pool.release(clients[0])
+        self.assertEqual(pool.in_use, 1)
+        pool.close()
+        self.assertEqual(pool.in_use, 1)
+        pool.release(clients[1])
+        self.assertEqual(pool.in_use, 0)
+        self.assertFalse(clients[1].is_open())
+
+
+class PipelineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.listener = socket.create_server(('localhost', 0))
+        self.port = self.listener.getsockname()[1]
+
+    def tearDown(self):
+        self.listener.close()
+
+    def _reverse_server(self, n_requests):
+        # fake server: read n read holding registers requests, respond in reverse order
+        # with registers values = address + index
+        conn, addr = self.listener.accept()
+        with conn:
+            rx = conn.makefile('rb')
+            requests = [struct.unpack('>HHHBBHH', rx.read(12)) for _ in range(n_requests)]
+            for (tr_id, _, _, unit_id, fc, address, number) in reversed(requests):
+                regs = struct.pack('>%dH' % number, *range(address, address + number))
+                conn.sendall(struct.pack('>HHHBBB', tr_id, 0, 3 + len(regs), unit_id, fc, len(regs)) + regs)
+            rx.read(1)
+
+    def test_out_of_order_responses(self):
+        server = Thread(target=self._reverse_server, args=(3,), daemon=True)
+        server.start()
+        client = ModbusClient(host='localhost', port=self.port, timeout=5.0)
+        self.assertTrue(client.open())
+        futures = [client.submit('read_holding_registers', address, 2) for address in (0, 100, 200)]
+        # first response received is the one of the last request
+        self.assertEqual(futures[0].result(), [0, 1])
+        self.assertTrue(all(future.done() for future in futures))
+        self.assertEqual([future.result() for future in futures], [[0, 1], [100, 101], [200, 201]])
+        client.close()
+        server.join(5.0)
+
+
+class RangeTest(unittest.TestCase):
+
+    def setUp(self):
+        with socket.socket() as sock:
+            sock.bind(('localhost', 0))
+            port = sock.getsockname()[1]
+        self.server = ModbusServer(host='localhost', port=port, no_block=True)
+        self.server.start()
+        self.client = ModbusClient(host='localhost', port=port)
+        self.assertTrue(self.client.open())
+        # (address, number) of the requests sent for a range
+        self.chunks = []
+        submit = self.client.submit
+
+        def chunk_submit(name, address, arg):
+            self.chunks.append((address, arg if isinstance(arg, int) else len(arg)))
+            return submit(name, address, arg)
+
+        self.client.submit = chunk_submit
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+
+    def test_split_range(self):
+        self.assertEqual(split_range(0, 125, 125), [(0, 125)])
+        self.assertEqual(split_range(0, 126, 125), [(0, 125), (125, 1)])
+        self.assertEqual(split_range(10, 250, 125), [(10, 125), (135, 125)])
+        self.assertEqual(split_range(0xFFFF, 1, 125), [(0xFFFF, 1)])
+
+    def test_read_holding_range(self):
+        self.server.data_bank.set_words(0, [i & 0xFFFF for i in range(0x10000)])
+        for (address, number, chunks) in ((0, 125, [(0, 125)]),
+                                          (0, 126, [(0, 125), (125, 1)]),
+                                          (3, 251, [(3, 125), (128, 125), (253, 1)]),
+                                          (0x10000 - 250, 250, [(0x10000 - 250, 125), (0x10000 - 125, 125)])):
+            with self.subTest(address=address, number=number):
+                self.chunks.clear()
+                self.assertEqual(self.client.read_holding_range(address, number),
+                                 list(range(address, address + number)))
+                self.assertEqual(self.chunks, chunks)
+
+    def test_read_coils_range(self):
+        bits = [bool(i % 3) for i in range(4002)]
+        self.server.data_bank.set_bits(0, bits)
+        for (address, number, chunks) in ((0, 2000, [(0, 2000)]),
+                                          (0, 2001, [(0, 2000), (2000, 1)]),
+                                          (1, 4001, [(1, 2000), (2001, 2000), (4001, 1)])):
+            with self.subTest(address=address, number=number):
+                self.chunks.clear()
+                self.assertEqual(self.client.read_coils_range(address, number), bits[address:address + number])
+                self.assertEqual(self.chunks, chunks)
+
+    def test_write_ranges(self):
+        # up to the last address
+        values = list(range(247))
+        address = 0x10000 - 247
+        self.assertTrue(self.client.write_registers_range(address, values))
+        self.assertEqual(self.chunks, [(address, 123), (address + 123, 123), (0xFFFF, 1)])
+        self.assertEqual(self.server.data_bank.get_words(address, 247), values)
+        bits = [bool(i % 2) for i in range(1969)]
+        self.chunks.clear()
+        self.assertTrue(self.client.write_coils_range(5, bits))
+        self.assertEqual(self.chunks, [(5, 1968), (1973, 1)])
+        self.assertEqual(self.server.data_bank.get_bits(5, 1969), bits)
+
+    def test_out_of_address_space(self):
+        self.assertIsNone(self.client.read_holding_range(0x10000 - 125, 126))
+        self.assertIsNone(self.client.read_coils_range(0, 0))
+        self.assertIsNone(self.client.write_registers_range(0xFFFF, [1, 2]))
+        self.assertEqual(self.chunks, [])
+
+if __name__ == '__main__':
+    unittest.main()
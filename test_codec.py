@@ -0,0 +1,51 @@
+import unittest
+
+import codec
+
+# (type, values, registers big word order, registers little word order)
+VECTORS = [
+    ('int16', [-2, 0x1234], [0xFFFE, 0x1234], [0xFFFE, 0x1234]),
+    ('uint32', [0x12345678, 1], [0x1234, 0x5678, 0, 1], [0x5678, 0x1234, 1, 0]),
+    ('int32', [-2], [0xFFFF, 0xFFFE], [0xFFFE, 0xFFFF]),
+    ('float32', [1.0, -2.5], [0x3F80, 0, 0xC020, 0], [0, 0x3F80, 0, 0xC020]),
+    ('uint64', [0x0001000200030004], [1, 2, 3, 4], [4, 3, 2, 1]),
+    ('int64', [-2], [0xFFFF, 0xFFFF, 0xFFFF, 0xFFFE], [0xFFFE, 0xFFFF, 0xFFFF, 0xFFFF]),
+    ('float64', [1.0], [0x3FF0, 0, 0, 0], [0, 0, 0, 0x3FF0]),
+]
+
+
+class WordOrderTest(unittest.TestCase):
+
+    def test_list(self):
+        for (reg_type, values, big_regs, little_regs) in VECTORS:
+            with self.subTest(reg_type=reg_type):
+                self.assertEqual(codec.values_to_regs(values, reg_type), big_regs)
+                self.assertEqual(codec.values_to_regs(values, reg_type, 'little'), little_regs)
+                self.assertEqual(codec.regs_to_values(big_regs, reg_type), values)
+                self.assertEqual(codec.regs_to_values(little_regs, reg_type, 'little'), values)
+
+    @unittest.skipUnless(codec.has_numpy(), 'need numpy')
+    def test_numpy(self):
+        import numpy as np
+        for (reg_type, values, big_regs, little_regs) in VECTORS:
+            np_code = codec.REG_TYPES[reg_type][1]
+            with self.subTest(reg_type=reg_type):
+                for (word_order, regs) in (('big', big_regs), ('little', little_regs)):
+                    np_regs = codec.values_to_regs(np.array(values, dtype=np_code), reg_type, word_order)
+                    self.assertEqual(np_regs.dtype, np.uint16)
+                    self.assertEqual(np_regs.tolist(), regs)
+                    np_values = codec.regs_to_values(np.array(regs, dtype=np.uint16), reg_type, word_order)
+                    self.assertEqual(np_values.dtype, np.dtype(np_code))
+                    self.assertEqual(np_values.tolist(), values)
+
+    def test_bad_args(self):
+        with self.assertRaises(ValueError):
+            codec.regs_to_values([1, 2, 3], 'uint32')
+        with self.assertRaises(ValueError):
+            codec.regs_to_values([1, 2], 'uint32', 'middle')
+        with self.assertRaises(ValueError):
+            codec.values_to_regs([1], 'uint24')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,165 @@
+import sys
+from threading import Barrier, Event, Thread
+import unittest
+
+from databank import (DataBank, DenseBits, DenseWords, SHARED_LOCKS, SparseBits, SparseWords, STRIPE_BITS,
+                      STRIPE_WORDS)
+
+
+def _run_threads(targets):
+    threads = [Thread(target=target) for target in targets]
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join()
+
+
+class FirstWriteTest(unittest.TestCase):
+    """First writes of threads in different stripes must all land (lazy storage allocation)"""
+
+    THREADS = 8
+    TRIALS = 100
+
+    def setUp(self):
+        self._interval = sys.getswitchinterval()
+        # switch threads often: widen the allocation race
+        sys.setswitchinterval(1e-6)
+
+    def tearDown(self):
+        sys.setswitchinterval(self._interval)
+
+    def _check_words(self, make_words):
+        for _ in range(self.TRIALS):
+            data_bank = DataBank(words=make_words())
+            barrier = Barrier(self.THREADS)
+
+            def writer(i):
+                barrier.wait()
+                data_bank.set_words(i * STRIPE_WORDS, [i + 1])
+
+            _run_threads([lambda i=i: writer(i) for i in range(self.THREADS)])
+            for i in range(self.THREADS):
+                self.assertEqual(data_bank.get_words(i * STRIPE_WORDS, 1), [i + 1])
+
+    def _check_bits(self, make_bits):
+        for _ in range(self.TRIALS):
+            data_bank = DataBank(bits=make_bits())
+            barrier = Barrier(self.THREADS)
+
+            def writer(i):
+                barrier.wait()
+                data_bank.set_bits(i * STRIPE_BITS, [True])
+
+            _run_threads([lambda i=i: writer(i) for i in range(self.THREADS)])
+            for i in range(self.THREADS):
+                self.assertEqual(data_bank.get_bits(i * STRIPE_BITS, 1), [True])
+
+    def test_dense_words(self):
+        self._check_words(DenseWords)
+
+    def test_dense_bits(self):
+        self._check_bits(DenseBits)
+
+    def test_sparse_words(self):
+        self._check_words(SparseWords)
+
+    def test_sparse_bits(self):
+        self._check_bits(SparseBits)
+
+
+class StripeSizeTest(unittest.TestCase):
+
+    def test_stripe_bits_byte_aligned(self):
+        with self.assertRaises(ValueError):
+            DataBank(stripe_bits=100)
+
+    def test_stripe_bits_page_aligned(self):
+        with self.assertRaises(ValueError):
+            DataBank(bits=SparseBits(page_size=2048), stripe_bits=1024)
+
+    def test_stripe_words_page_aligned(self):
+        with self.assertRaises(ValueError):
+            DataBank(words=SparseWords(page_size=256), stripe_words=100)
+        DataBank(words=SparseWords(page_size=256), stripe_words=512)
+
+
+class SeqlockReadTest(unittest.TestCase):
+
+    def test_no_torn_read(self):
+        # writes across a stripe boundary, lock free reads must see them whole
+        data_bank = DataBank(stripe_words=16)
+        stop = Event()
+        torn = []
+
+        def writer():
+            n = 0
+            while not stop.is_set():
+                n = (n + 1) & 0xFFFF
+                data_bank.set_words(10, [n] * 12)
+
+        def reader():
+            for _ in range(20000):
+                words = data_bank.get_words(10, 12)
+                if len(set(words)) != 1:
+                    torn.append(words)
+
+        writer_th = Thread(target=writer)
+        writer_th.start()
+        try:
+            _run_threads([reader, reader])
+        finally:
+            stop.set()
+            writer_th.join()
+        self.assertEqual(torn, [])
+
+    def test_words_types(self):
+        data_bank = DataBank()
+        self.assertEqual(data_bank.get_words(0, 2), [0, 0])
+        self.assertTrue(data_bank.set_words(0, [1, 0x1234]))
+        self.assertEqual(data_bank.get_words(0, 2), [1, 0x1234])
+        self.assertEqual(data_bank.get_words_bytes(0, 2), b'\x00\x01\x12\x34')
+        self.assertIsNone(data_bank.get_words_bytes(len(data_bank.words), 1))
+
+    def test_write_read_words(self):
+        data_bank = DataBank()
+        self.assertEqual(data_bank.write_read_words(5, [1, 2], 4, 4), [0, 1, 2, 0])
+        self.assertIsNone(data_bank.write_read_words(len(data_bank.words), [1], 0, 1))
+
+
+class SharedStripesTest(unittest.TestCase):
+
+    def test_hashed_locks(self):
+        # 8192 stripes of words on SHARED_LOCKS process locks
+        data_bank = DataBank(shared=True, stripe_words=8)
+        self.assertEqual(len(data_bank.words_stripes.lock_ids(range(8192))), SHARED_LOCKS)
+        # a write over stripes of the same lock (and the lock of a held range) take it once
+        address = 8 * SHARED_LOCKS - 4
+        self.assertTrue(data_bank.set_words(address, list(range(16))))
+        self.assertEqual(data_bank.write_read_words(address + 8, [7], address, 16),
+                         list(range(8)) + [7] + list(range(9, 16)))
+
+    def test_common_locks(self):
+        # shared data banks use one set of process locks, stripes 0 of two banks are hashed apart
+        bank_a = DataBank(shared=True)
+        bank_b = DataBank(shared=True)
+        self.assertIs(bank_a.words_stripes._shared_locks, bank_b.bits_stripes._shared_locks)
+        self.assertEqual(len(bank_a.words_stripes._shared_locks), SHARED_LOCKS)
+        self.assertNotEqual(bank_a.words_stripes.lock_ids([0]), bank_b.words_stripes.lock_ids([0]))
+        self.assertTrue(bank_a.set_words(0, [1]))
+        self.assertTrue(bank_b.set_words(0, [2]))
+        self.assertEqual((bank_a.get_words(0, 1), bank_b.get_words(0, 1)), ([1], [2]))
+
+    def test_concurrent_writes(self):
+        data_bank = DataBank(shared=True, stripe_words=8)
+
+        def writer(i):
+            for n in range(200):
+                data_bank.set_words(i * 8 * SHARED_LOCKS, [n] * 24)
+
+        _run_threads([lambda i=i: writer(i) for i in range(4)])
+        for i in range(4):
+            self.assertEqual(data_bank.get_words(i * 8 * SHARED_LOCKS, 24), [199] * 24)
+
+
+if __name__ == '__main__':
+    unittest.main()
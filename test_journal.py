@@ -0,0 +1,78 @@
+from array import array
+import os
+import tempfile
+import unittest
+import zlib
+
+from journal import Journal, RECORD_CRC, RECORD_HEAD, SPACE_IDS, open_data_bank
+
+
+def _record(space, address, number, data):
+    # a journal record as Journal.append() write it
+    record = RECORD_HEAD.pack(SPACE_IDS[space], address, number) + data
+    return record + RECORD_CRC.pack(zlib.crc32(record))
+
+
+def _words_record(address, values):
+    return _record('words', address, len(values), array('H', values).tobytes())
+
+
+class ReplayTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.path = self._tmp.name
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def _write(self, name, data):
+        with open(os.path.join(self.path, name), 'wb') as f:
+            f.write(data)
+
+    def test_replay_after_crash(self):
+        # crash during a compaction: journal.log.old is left, then a write is torn in journal.log
+        self._write('journal.log.old', _words_record(0, [1, 2, 3]) + _record('bits', 0, 3, b'\x05'))
+        torn = _words_record(10, [0xDEAD, 0xBEEF])
+        self._write('journal.log', _words_record(1, [20]) + torn[:-3])
+        data_bank = open_data_bank(self.path, bits_size=1024, words_size=1024, compact_interval=3600.0)
+        try:
+            # records of journal.log apply over those of journal.log.old, not the torn one
+            self.assertEqual(data_bank.get_words(0, 3), [1, 20, 3])
+            self.assertEqual(data_bank.get_bits(0, 3), [True, False, True])
+            self.assertEqual(data_bank.get_words(10, 2), [0, 0])
+            # checkpoint at open: the old journal is removed and the new one is empty
+            self.assertFalse(os.path.exists(os.path.join(self.path, 'journal.log.old')))
+            self.assertEqual(os.path.getsize(os.path.join(self.path, 'journal.log')), 0)
+        finally:
+            data_bank.close()
+
+    def test_corrupt_record_end_replay(self):
+        bad = bytearray(_words_record(5, [7]))
+        bad[-1] ^= 0xFF
+        self._write('journal.log', _words_record(4, [6]) + bytes(bad) + _words_record(6, [8]))
+        data_bank = open_data_bank(self.path, bits_size=1024, words_size=1024, compact_interval=3600.0)
+        try:
+            self.assertEqual(data_bank.get_words(4, 3), [6, 0, 0])
+        finally:
+            data_bank.close()
+
+    def test_reopen(self):
+        data_bank = open_data_bank(self.path, bits_size=1024, words_size=1024, compact_interval=3600.0)
+        self.assertTrue(data_bank.set_words(100, [1, 2]))
+        self.assertTrue(data_bank.set_bits(7, [True, True]))
+        data_bank.close()
+        data_bank = open_data_bank(self.path, bits_size=1024, words_size=1024)
+        try:
+            self.assertEqual(data_bank.get_words(100, 2), [1, 2])
+            self.assertEqual(data_bank.get_bits(6, 4), [False, True, True, False])
+        finally:
+            data_bank.close()
+
+    def test_fsync_policy(self):
+        with self.assertRaises(ValueError):
+            Journal(os.path.join(self.path, 'journal.log'), fsync='sometimes')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+import unittest
+
+import pdu
+from client import TX_BUFFER_SIZE
+
+
+class WriteRegistersLimitTest(unittest.TestCase):
+
+    def test_max_registers_frame(self):
+        buffer = bytearray(TX_BUFFER_SIZE)
+        view = memoryview(buffer)
+        request = pdu.write_multiple_registers(0, [0x1234] * 123)
+        size = pdu.mbap_frame_into(buffer, 1, 1, request.fc, request.body)
+        self.assertEqual(bytes(view[:size]), pdu.mbap_frame(1, 1, request.fc, request.body))
+
+    def test_over_max_registers(self):
+        for regs_nb in (124, 128, 255):
+            with self.assertRaisesRegex(pdu.PduError, 'number of registers'):
+                pdu.write_multiple_registers(0, [0] * regs_nb)
+
+    def test_frame_over_buffer(self):
+        buffer = bytearray(16)
+        view = memoryview(buffer)
+        with self.assertRaises(pdu.PduError):
+            pdu.mbap_frame_into(buffer, 1, 1, 0x10, bytes(10))
+        self.assertEqual(len(view), 16)
+
+
+class WriteReadLimitTest(unittest.TestCase):
+
+    def test_max_quantities(self):
+        request = pdu.write_read_multiple_registers(0, [1] * 121, 0, 125)
+        self.assertEqual(request.fc, 0x17)
+        # read range first, then write range and byte count
+        self.assertEqual(request.body[:9], bytes([0, 0, 0, 125, 0, 0, 0, 121, 242]))
+        self.assertEqual(len(request.body), 9 + 242)
+
+    def test_over_max_quantities(self):
+        with self.assertRaisesRegex(pdu.PduError, 'to write out of range'):
+            pdu.write_read_multiple_registers(0, [1] * 122, 0, 1)
+        with self.assertRaisesRegex(pdu.PduError, 'read_nb out of range'):
+            pdu.write_read_multiple_registers(0, [1], 0, 126)
+        with self.assertRaises(pdu.PduError):
+            pdu.write_read_multiple_registers(0, [], 0, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,36 @@
+import unittest
+
+import codec
+from regmap import RegisterMap
+
+
+class DecodeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.plan = RegisterMap({
+            'flow': {'table': 'holding_register', 'address': 0, 'type': 'float32', 'word_order': 'little'},
+            'temp': {'table': 'holding_register', 'address': 2, 'type': 'int16', 'scale': 0.5},
+            'count': {'table': 'holding_register', 'address': 3, 'type': 'uint32'},
+            'run': {'table': 'coil', 'address': 3},
+        }).compile()
+
+    def test_requests(self):
+        self.assertEqual(self.plan.requests(), [('read_coils', 3, 1), ('read_holding_registers', 0, 5)])
+
+    def test_decode(self):
+        regs = (codec.values_to_regs([1.5], 'float32', 'little') + [0xFFFE] +
+                codec.values_to_regs([70000], 'uint32'))
+        expected = {'run': True, 'flow': 1.5, 'temp': -1.0, 'count': 70000}
+        self.assertEqual(self.plan.decode([[True], regs]), expected)
+        self.assertEqual(self.plan.decode([[True], codec.encode_regs(regs, codec.REGS_ARRAY)]), expected)
+        self.assertEqual(self.plan.decode([None, regs])['run'], None)
+
+    def test_bad_type(self):
+        with self.assertRaises(ValueError):
+            RegisterMap({'x': {'table': 'coil', 'address': 0, 'type': 'uint16'}})
+        with self.assertRaises(ValueError):
+            RegisterMap({'x': {'table': 'holding_register', 'address': 0, 'type': 'float16'}})
+
+
+if __name__ == '__main__':
+    unittest.main()
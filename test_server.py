@@ -0,0 +1,320 @@
+import socket
+import struct
+import threading
+import time
+import unittest
+
+import constants as const
+import pdu
+from client import ModbusClient
+from databank import DataBank, DenseBits, DenseWords
+from metrics import ServerMetrics
+from server import ModbusServer, PUSH_QUEUE_SIZE
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+
+def _raw_request(port, fc, body, unit_id=1):
+    # send one request frame, return the response PDU (function code and data)
+    with socket.create_connection(('localhost', port), timeout=5.0) as sock:
+        sock.sendall(pdu.mbap_frame(1, unit_id, fc, body))
+        rx = sock.makefile('rb')
+        (_, _, length, _) = struct.unpack('>HHHB', rx.read(7))
+        return rx.read(length - 1)
+
+
+class SlowSubscriberTest(unittest.TestCase):
+
+    ENGINE = const.ENGINE_THREAD
+
+    def setUp(self):
+        self.port = _free_port()
+        self.server = ModbusServer(host='localhost', port=self.port, no_block=True, subscriptions=True,
+                                   engine=self.ENGINE)
+        self.server.start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_writer_not_blocked(self):
+        # a subscriber which never read its pushes
+        sock = socket.socket()
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        sock.connect(('localhost', self.port))
+        request = pdu.subscribe('words', 0, 120)
+        sock.sendall(pdu.mbap_frame(1, 1, request.fc, request.body))
+        sock.settimeout(5.0)
+        self.assertEqual(len(sock.recv(12)), 12)
+        # writes go on (socket buffers full), until the link is dropped
+        data_bank = self.server.data_bank
+        writer_done = threading.Event()
+
+        def writer():
+            for i in range(16 * PUSH_QUEUE_SIZE):
+                data_bank.set_words(0, [i & 0xFFFF] * 120)
+            writer_done.set()
+
+        threading.Thread(target=writer, daemon=True).start()
+        self.assertTrue(writer_done.wait(10.0))
+        # the slow subscriber is disconnected
+        t_end = time.monotonic() + 5.0
+        received = b'x'
+        while received and time.monotonic() < t_end:
+            try:
+                received = sock.recv(65536)
+            except ConnectionResetError:
+                received = b''
+        self.assertEqual(received, b'')
+        sock.close()
+
+    def test_stop_with_stuck_client(self):
+        # a client which send requests and never read the responses
+        sock = socket.socket()
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        sock.connect(('localhost', self.port))
+        request = pdu.read_holding_registers(0, 125)
+        frame = pdu.mbap_frame(1, 1, request.fc, request.body)
+        sock.settimeout(0.5)
+        try:
+            for _ in range(100000):
+                sock.sendall(frame)
+        except socket.timeout:
+            pass
+        self.server.stop()
+        # every connection task ended (asyncio engine): none is left waiting in drain()
+        self.assertEqual(self.server._writers, set())
+        sock.close()
+
+
+class AsyncSlowSubscriberTest(SlowSubscriberTest):
+
+    ENGINE = const.ENGINE_ASYNCIO
+
+
+class FunctionsTest(unittest.TestCase):
+
+    ENGINE = const.ENGINE_THREAD
+
+    def setUp(self):
+        self.port = _free_port()
+        # small spaces: out of space addresses are in the modbus address range
+        data_bank = DataBank(bits=DenseBits(0x1000), words=DenseWords(0x1000))
+        self.server = ModbusServer(host='localhost', port=self.port, no_block=True, engine=self.ENGINE,
+                                   data_bank=data_bank)
+        self.server.start()
+        self.client = ModbusClient(host='localhost', port=self.port)
+        self.assertTrue(self.client.open())
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+
+    def test_bits(self):
+        client = self.client
+        self.assertTrue(client.write_single_coil(0, True))
+        self.assertTrue(client.write_multiple_coils(1, [False, True, True]))
+        self.assertEqual(client.read_coils(0, 5), [True, False, True, True, False])
+        # without units, inputs are read from the same data bank
+        self.assertEqual(client.read_discrete_inputs(0, 5), [True, False, True, True, False])
+
+    def test_words(self):
+        client = self.client
+        self.assertTrue(client.write_single_register(0, 0x1234))
+        self.assertTrue(client.write_multiple_registers(1, [1, 2, 3]))
+        self.assertEqual(client.read_holding_registers(0, 5), [0x1234, 1, 2, 3, 0])
+        self.assertEqual(client.read_input_registers(0, 5), [0x1234, 1, 2, 3, 0])
+        # write is done before read
+        self.assertEqual(client.write_read_multiple_registers(3, [7, 8], 2, 3), [2, 7, 8])
+
+    def test_exceptions(self):
+        self.assertEqual(_raw_request(self.port, 0x2B, b'\x00\x00'),
+                         bytes([0x2B | 0x80, const.EXP_ILLEGAL_FUNCTION]))
+        body = struct.pack('>HH', 0x0FFF, 2)
+        self.assertEqual(_raw_request(self.port, const.READ_HOLDING_REGISTERS, body),
+                         bytes([const.READ_HOLDING_REGISTERS | 0x80, const.EXP_DATA_ADDRESS]))
+        body = struct.pack('>HH', 0, 0x7E)
+        self.assertEqual(_raw_request(self.port, const.READ_HOLDING_REGISTERS, body),
+                         bytes([const.READ_HOLDING_REGISTERS | 0x80, const.EXP_DATA_VALUE]))
+
+    def test_stop(self):
+        self.server.stop()
+        self.assertFalse(self.server.is_run)
+        # open connections are closed, new ones refused
+        self.assertIsNone(self.client.read_holding_registers(0, 1))
+        self.assertFalse(self.client.open())
+        # restart
+        self.server.start()
+        self.assertTrue(self.client.open())
+        self.assertEqual(self.client.read_holding_registers(0, 1), [0])
+
+
+class AsyncFunctionsTest(FunctionsTest):
+
+    ENGINE = const.ENGINE_ASYNCIO
+
+
+class RegisterFunctionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.port = _free_port()
+        self.server = ModbusServer(host='localhost', port=self.port, no_block=True)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_custom_function(self):
+        # user defined 0x64: echo request data reversed, a null first byte is an except
+        def echo(data_bank, fc, data):
+            if data[0] == 0:
+                return const.EXP_DATA_VALUE
+            return bytes([fc]) + bytes(data)[::-1]
+
+        self.server.register_function(0x64, echo)
+        self.server.start()
+        self.assertEqual(_raw_request(self.port, 0x64, b'\x01\x02\x03'), b'\x64\x03\x02\x01')
+        self.assertEqual(_raw_request(self.port, 0x64, b'\x00\x01'), bytes([0x64 | 0x80, const.EXP_DATA_VALUE]))
+
+    def test_replace_function(self):
+        # handler get the data bank of the unit
+        def read_first(data_bank, fc, data):
+            return bytes([fc, 2]) + data_bank.get_words_bytes(0, 1)
+
+        self.server.register_function(const.READ_HOLDING_REGISTERS, read_first)
+        self.server.data_bank.set_words(0, [0x1234])
+        self.server.start()
+        body = struct.pack('>HH', 10, 5)
+        self.assertEqual(_raw_request(self.port, const.READ_HOLDING_REGISTERS, body), b'\x03\x02\x12\x34')
+
+    def test_out_of_range(self):
+        for fc in (0x00, 0x80):
+            with self.assertRaises(ValueError):
+                self.server.register_function(fc, lambda data_bank, fc, data: const.EXP_ILLEGAL_FUNCTION)
+
+
+class WriteReadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.port = _free_port()
+        self.server = ModbusServer(host='localhost', port=self.port, no_block=True)
+        self.server.start()
+        self.client = ModbusClient(host='localhost', port=self.port)
+        self.assertTrue(self.client.open())
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+
+    def test_max_quantities(self):
+        # 121 words written, 125 read over them
+        values = list(range(1, 122))
+        self.assertEqual(self.client.write_read_multiple_registers(2, values, 0, 125),
+                         [0, 0] + values + [0, 0])
+        self.assertEqual(self.client.read_holding_registers(2, 121), values)
+
+    def test_over_max_quantities(self):
+        # rejected by the client
+        self.assertIsNone(self.client.write_read_multiple_registers(0, [1] * 122, 0, 1))
+        self.assertIsNone(self.client.write_read_multiple_registers(0, [1], 0, 126))
+        # rejected by the server, nothing written
+        except_pdu = bytes([const.READ_WRITE_MULTIPLE_REGISTERS | 0x80, const.EXP_DATA_VALUE])
+        for (r_count, w_count, byte_count) in ((1, 122, 244), (126, 1, 2), (1, 2, 2), (0, 1, 2)):
+            body = struct.pack('>HHHHB', 0, r_count, 0, w_count, byte_count) + b'\x00\x01' * w_count
+            self.assertEqual(_raw_request(self.port, const.READ_WRITE_MULTIPLE_REGISTERS, body), except_pdu)
+        self.assertEqual(self.client.read_holding_registers(0, 2), [0, 0])
+
+
+class WorkersStopTest(unittest.TestCase):
+
+    def test_clean_stop(self):
+        port = _free_port()
+        data_bank = DataBank(shared=True)
+        server = ModbusServer(host='localhost', port=port, no_block=True, data_bank=data_bank, processes=2)
+        server.start()
+        workers = list(server._workers)
+        client = ModbusClient(host='localhost', port=port)
+        t_end = time.monotonic() + 5.0
+        while not client.open() and time.monotonic() < t_end:
+            time.sleep(0.05)
+        self.assertTrue(client.write_multiple_registers(0, [1, 2, 3]))
+        # stop with a connection still open: workers end it and exit
+        server.stop()
+        self.assertFalse(server.is_run)
+        self.assertEqual([worker.exitcode for worker in workers], [0, 0])
+        self.assertIsNone(client.read_holding_registers(0, 3))
+        client.close()
+        # no stripe lock left held
+        with data_bank.words_stripes.write(0, 3):
+            pass
+        self.assertEqual(data_bank.get_words(0, 3), [1, 2, 3])
+
+
+class UnitsTest(unittest.TestCase):
+
+    def test_multi_process_need_shared_banks(self):
+        server = ModbusServer(data_bank=DataBank(shared=True), processes=2)
+        with self.assertRaises(ValueError):
+            server.add_unit(1, data_bank=DataBank())
+        with self.assertRaises(ValueError):
+            server.add_unit(1, input_bank=DataBank())
+        unit = server.add_unit(1, input_bank=DataBank(shared=True))
+        self.assertTrue(unit.data_bank.shared and unit.input_bank.shared)
+
+    def test_gateway(self):
+        port = _free_port()
+        server = ModbusServer(host='localhost', port=port, no_block=True)
+        unit_1 = server.add_unit(1)
+        server.add_unit(2)
+        unit_1.input_bank.set_words(0, [0x11])
+        server.start()
+        client = ModbusClient(host='localhost', port=port, unit_id=1)
+        try:
+            self.assertTrue(client.open())
+            # units have their own spaces, inputs are in the input bank
+            self.assertTrue(client.write_single_register(0, 0x22))
+            self.assertEqual(client.read_holding_registers(0, 1), [0x22])
+            self.assertEqual(client.read_input_registers(0, 1), [0x11])
+            client.unit_id(2)
+            self.assertEqual(client.read_holding_registers(0, 1), [0])
+            # unknown unit
+            client.unit_id(3)
+            self.assertIsNone(client.read_holding_registers(0, 1))
+            body = struct.pack('>HH', 0, 1)
+            self.assertEqual(_raw_request(port, const.READ_HOLDING_REGISTERS, body, unit_id=3),
+                             bytes([const.READ_HOLDING_REGISTERS | 0x80,
+                                    const.EXP_GATEWAY_TARGET_DEVICE_FAILED_TO_RESPOND]))
+            # removed unit
+            server.remove_unit(2)
+            self.assertEqual(_raw_request(port, const.READ_HOLDING_REGISTERS, body, unit_id=2)[1],
+                             const.EXP_GATEWAY_TARGET_DEVICE_FAILED_TO_RESPOND)
+        finally:
+            client.close()
+            server.stop()
+
+class MetricsTest(unittest.TestCase):
+
+    def test_requests_count(self):
+        port = _free_port()
+        metrics = ServerMetrics()
+        server = ModbusServer(host='localhost', port=port, no_block=True, metrics=metrics)
+        server.start()
+        client = ModbusClient(host='localhost', port=port)
+        try:
+            self.assertTrue(client.open())
+            for _ in range(7):
+                self.assertEqual(client.read_holding_registers(0, 2), [0, 0])
+        finally:
+            client.close()
+            server.stop()
+        self.assertEqual(metrics.snapshot()['requests'], 7)
+
+    def test_multi_process_rejected(self):
+        with self.assertRaises(ValueError):
+            ModbusServer(data_bank=DataBank(shared=True), processes=2, metrics=ServerMetrics())
+
+
+if __name__ == '__main__':
+    unittest.main()